@@ -0,0 +1,462 @@
+#!/usr/bin/env python2
+"""Back up and restore the database and blob storage while the server runs.
+
+    python backup.py backup BACKUP_DIR [--rate BYTES_PER_SECOND]
+    python backup.py verify BACKUP_DIR
+    python backup.py restore BACKUP_DIR [--snapshot NAME] [--force]
+
+Each backup takes a consistent snapshot of snap.sqlite, a few pages at a
+time so that the server's writes are only held up briefly, and then copies
+the blobs that snapshot refers to. Blobs are stored under keys derived
+from their contents and never change, so blobs already in the backup are
+not copied again; BACKUP_DIR/manifest.jsonl lists each blob with its size
+and sha1.
+The layout of the backup directory is
+
+    manifest.jsonl
+    blobs/<key>
+    snapshots/<name>/snap.sqlite   or one file for each database
+    snapshots/<name>/keys.txt      the blobs the snapshot refers to
+
+Blobs written after the snapshot are left for the next backup. A content
+blob the tiering job moved between hot and cold storage after the snapshot
+is copied from where it went. A blob deleted between the snapshot and the
+copy, by thinning running at the same time, is reported as missing, and
+the snapshot is not finished; the next backup takes a new one.
+
+With shards, every database in SNAP_SHARDS is snapshotted, one after the
+other, and the directory last, so that it places every row the shard
+snapshots hold. --database, given once for each database, overrides this
+for backup and restore alike.
+
+A restore checks the snapshot and every blob it needs against the
+manifest, writes the blobs to storage and then moves the database into
+place, so the database never refers to a blob that is not there. The
+server must not be running during a restore.
+"""
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import time
+
+import blobstore
+
+
+DATABASE = 'snap.sqlite'
+SHARDS = [url for url in os.environ.get('SNAP_SHARDS', '').split(',')
+          if url]
+DIRECTORY_URL = os.environ.get('SNAP_DIRECTORY',
+                               'sqlite:///directory.sqlite')
+STORAGE_URL = os.environ.get('SNAP_STORAGE_URL', 'storage')
+COLD_STORAGE_URL = os.environ.get('SNAP_COLD_STORAGE_URL',
+                                  os.path.join('storage', 'cold'))
+PAGES_PER_STEP = 256
+# Times the stepped copy may be restarted by concurrent writes before the
+# rest is copied in a single step.
+MAX_RESTARTS = 3
+# Offset of the file change counter in the SQLite database header, which
+# each commit in rollback journal mode, the server's, changes.
+CHANGE_COUNTER = slice(24, 28)
+SNAPSHOT_FORMAT = '%Y%m%dT%H%M%SZ'
+# The keys server.py stores blobs under.
+LEGACY_SUFFIXES = ('.segments', '.revision.gz', '.revision')
+
+
+class BackupError(Exception):
+    pass
+
+
+def sqlitePath(url):
+    if not url.startswith('sqlite:///'):
+        raise BackupError('Only SQLite databases can be backed up, '
+                          'not {0}'.format(url))
+    return url[len('sqlite:///'):]
+
+
+def configuredDatabases():
+    """Return the databases the server uses, as configured by SNAP_SHARDS
+    and SNAP_DIRECTORY; the directory comes last."""
+    if not SHARDS:
+        return [DATABASE]
+    return [sqlitePath(url) for url in SHARDS + [DIRECTORY_URL]]
+
+
+def snapshotFiles(databases):
+    """Return the name each database has in a snapshot."""
+    names = [os.path.basename(database) for database in databases]
+    if len(set(names)) != len(names):
+        raise BackupError('The databases must have different file names')
+    return names
+
+
+class Throttle(object):
+    """Sleeps as needed to keep the bytes passed to consume under rate a
+    second; a rate of 0 means no limit."""
+
+    def __init__(self, rate=0):
+        self.rate = rate
+        self.start = time.time()
+        self.consumed = 0
+
+    def consume(self, size):
+        if not self.rate:
+            return
+        self.consumed += size
+        ahead = self.consumed / float(self.rate) - (time.time() - self.start)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+class _Restarted(Exception):
+    pass
+
+
+def snapshotDatabase(source, target, throttle):
+    """Copy the database at source to target as of a single moment."""
+    conn = sqlite3.connect(source)
+    try:
+        if hasattr(conn, 'backup'):
+            backupDatabase(conn, target, throttle)
+        else:
+            copyDatabase(conn, source, target, throttle)
+    finally:
+        conn.close()
+
+
+def backupDatabase(conn, target, throttle):
+    """Copy with the online backup API, a few pages at a time so that
+    writers are only held up briefly. A write by another connection
+    restarts the copy; after MAX_RESTARTS the rest is copied at once."""
+    pageSize = conn.execute('PRAGMA page_size').fetchone()[0]
+    state = {'remaining': None, 'restarts': 0}
+
+    def progress(status, remaining, total):
+        if state['remaining'] is not None and \
+                remaining >= state['remaining']:
+            state['restarts'] += 1
+            if state['restarts'] > MAX_RESTARTS:
+                raise _Restarted()
+        state['remaining'] = remaining
+        throttle.consume(PAGES_PER_STEP * pageSize)
+
+    dest = sqlite3.connect(target)
+    try:
+        try:
+            conn.backup(dest, pages=PAGES_PER_STEP, progress=progress)
+        except _Restarted:
+            conn.backup(dest)
+    finally:
+        dest.close()
+
+
+def copyDatabase(conn, source, target, throttle):
+    """Copy the file the way backupDatabase does, for Pythons without the
+    backup API: each step copies PAGES_PER_STEP pages under a read lock,
+    and a commit between steps, seen in the file change counter, restarts
+    the copy."""
+    conn.isolation_level = None
+    stepSize = PAGES_PER_STEP * \
+        conn.execute('PRAGMA page_size').fetchone()[0]
+    restarts = 0
+    counter = None
+    offset = 0
+    with open(source, 'rb') as src, open(target, 'wb') as dest:
+        while True:
+            conn.execute('BEGIN')
+            try:
+                conn.execute('SELECT count(*) FROM sqlite_master').fetchone()
+                src.seek(0)
+                header = src.read(CHANGE_COUNTER.stop)
+                if counter is not None and \
+                        header[CHANGE_COUNTER] != counter:
+                    restarts += 1
+                    offset = 0
+                    dest.seek(0)
+                    dest.truncate()
+                counter = header[CHANGE_COUNTER]
+                size = os.fstat(src.fileno()).st_size
+                src.seek(offset)
+                if restarts > MAX_RESTARTS:
+                    data = src.read(size - offset)
+                else:
+                    data = src.read(min(stepSize, size - offset))
+            finally:
+                conn.execute('ROLLBACK')
+            dest.write(data)
+            offset += len(data)
+            throttle.consume(len(data))
+            if offset >= size:
+                return
+
+
+def referencedBlobs(database, hot):
+    """Yield (store, key) for each blob the database refers to, where store
+    is 'hot' or 'cold'; the shard directory refers to none."""
+    conn = sqlite3.connect(database)
+    try:
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' "
+                        "AND name = 'contents'").fetchone() is None:
+            return
+        for contentHash, cold in conn.execute(
+                'SELECT contentHash, cold FROM contents'):
+            if cold:
+                yield 'cold', contentHash + '.cold'
+            else:
+                yield 'hot', contentHash + '.segments'
+        for mediaHash, in conn.execute('SELECT mediaHash FROM media'):
+            yield 'hot', mediaHash + '.media.gz'
+        for revId, in conn.execute(
+                'SELECT revId FROM revisions WHERE contentHash IS NULL'):
+            keys = [revId + suffix for suffix in LEGACY_SUFFIXES]
+            found = [key for key in keys if hot.exists(key)]
+            yield 'hot', found[0] if found else keys[0]
+    finally:
+        conn.close()
+
+
+def otherCopy(store, key):
+    """Return the (store, key) a content blob has once the tiering job has
+    moved it between hot and cold storage, or None for other blobs."""
+    if store == 'hot' and key.endswith('.segments'):
+        return 'cold', key[:-len('.segments')] + '.cold'
+    if store == 'cold' and key.endswith('.cold'):
+        return 'hot', key[:-len('.cold')] + '.segments'
+    return None
+
+
+def readManifest(backupDir):
+    manifest = {}
+    path = os.path.join(backupDir, 'manifest.jsonl')
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    manifest[entry['key']] = entry
+    return manifest
+
+
+def copyBlob(source, key, target, throttle):
+    """Copy a blob between stores; return its size and sha1."""
+    digest = hashlib.sha1()
+    size = [0]
+
+    def chunks():
+        for chunk in source.read_stream(key):
+            digest.update(chunk)
+            size[0] += len(chunk)
+            throttle.consume(len(chunk))
+            yield chunk
+
+    target.write_stream(key, chunks())
+    return size[0], digest.hexdigest()
+
+
+def backup(backupDir, stores, databases=(DATABASE,), rate=0,
+           out=sys.stdout):
+    throttle = Throttle(rate)
+    name = datetime.datetime.utcnow().strftime(SNAPSHOT_FORMAT)
+    snapshotDir = os.path.join(backupDir, 'snapshots', name)
+    files = snapshotFiles(databases)
+    os.makedirs(snapshotDir)
+    refs = []
+    seen = set()
+    for database, fileName in zip(databases, files):
+        snapshot = os.path.join(snapshotDir, fileName)
+        snapshotDatabase(database, snapshot, throttle)
+        # Shards share contents and media, each counting its own uses.
+        for ref in referencedBlobs(snapshot, stores['hot']):
+            if ref not in seen:
+                seen.add(ref)
+                refs.append(ref)
+    manifest = readManifest(backupDir)
+    copies = blobstore.LocalStore(os.path.join(backupDir, 'blobs'))
+    copied = copiedBytes = 0
+    missing = []
+    found = []
+    with open(os.path.join(backupDir, 'manifest.jsonl'), 'a') as log:
+        for ref in refs:
+            candidates = [ref] + [other for other in [otherCopy(*ref)]
+                                  if other is not None]
+            for store, key in candidates:
+                if key in manifest:
+                    found.append((store, key))
+                    break
+                try:
+                    size, sha1 = copyBlob(stores[store], key, copies,
+                                          throttle)
+                except blobstore.BlobNotFound:
+                    continue
+                manifest[key] = {'key': key, 'store': store, 'size': size,
+                                 'sha1': sha1}
+                log.write(json.dumps(manifest[key], sort_keys=True) + '\n')
+                log.flush()
+                found.append((store, key))
+                copied += 1
+                copiedBytes += size
+                break
+            else:
+                missing.append(ref[1])
+    print('Snapshot {0}: {1} blobs, {2} new ({3} bytes), {4} missing'.format(
+        name, len(refs), copied, copiedBytes, len(missing)), file=out)
+    for key in missing:
+        print('  missing {0}'.format(key), file=out)
+    if missing:
+        # A snapshot is only finished once it has keys.txt.
+        shutil.rmtree(snapshotDir)
+        print('Snapshot {0} is incomplete and was removed'.format(name),
+              file=out)
+        return name, missing
+    with open(os.path.join(snapshotDir, 'keys.txt'), 'w') as f:
+        for store, key in sorted(set(found)):
+            f.write('{0} {1}\n'.format(store, key))
+    return name, missing
+
+
+def snapshotNames(backupDir):
+    """Return the names of the finished snapshots, oldest first."""
+    root = os.path.join(backupDir, 'snapshots')
+    return sorted(name for name in os.listdir(root)
+                  if os.path.exists(os.path.join(root, name, 'keys.txt')))
+
+
+def snapshotDatabases(snapshotDir):
+    return sorted(name for name in os.listdir(snapshotDir)
+                  if name.endswith('.sqlite'))
+
+
+def snapshotKeys(snapshotDir):
+    with open(os.path.join(snapshotDir, 'keys.txt')) as f:
+        return [tuple(line.split()) for line in f if line.strip()]
+
+
+def checkDatabase(path):
+    conn = sqlite3.connect(path)
+    try:
+        result = conn.execute('PRAGMA integrity_check').fetchone()[0]
+    finally:
+        conn.close()
+    if result != 'ok':
+        raise BackupError('{0} is damaged: {1}'.format(path, result))
+
+
+def checkedBlob(copies, manifest, key):
+    """Return a blob from the backup after checking it against the
+    manifest."""
+    entry = manifest.get(key)
+    if entry is None:
+        raise BackupError('{0} is not in the backup'.format(key))
+    try:
+        data = copies.get(key)
+    except blobstore.BlobNotFound:
+        raise BackupError('{0} is missing from the backup'.format(key))
+    if len(data) != entry['size'] or \
+            hashlib.sha1(data).hexdigest() != entry['sha1']:
+        raise BackupError('{0} does not match the manifest'.format(key))
+    return data
+
+
+def verify(backupDir, name=None, out=sys.stdout):
+    """Check a snapshot, by default the latest, and every blob it needs;
+    return the number of problems found."""
+    names = [name] if name else snapshotNames(backupDir)[-1:]
+    manifest = readManifest(backupDir)
+    copies = blobstore.LocalStore(os.path.join(backupDir, 'blobs'))
+    problems = 0
+    for name in names:
+        snapshotDir = os.path.join(backupDir, 'snapshots', name)
+        for fileName in snapshotDatabases(snapshotDir):
+            try:
+                checkDatabase(os.path.join(snapshotDir, fileName))
+            except BackupError as e:
+                print(e, file=out)
+                problems += 1
+        for store, key in snapshotKeys(snapshotDir):
+            try:
+                checkedBlob(copies, manifest, key)
+            except BackupError as e:
+                print(e, file=out)
+                problems += 1
+        print('Snapshot {0}: {1} problems'.format(name, problems), file=out)
+    return problems
+
+
+def restore(backupDir, stores, databases=(DATABASE,), name=None,
+            force=False, rate=0, out=sys.stdout):
+    """Restore a snapshot, by default the latest, into stores and
+    databases."""
+    for database in databases:
+        if os.path.exists(database) and not force:
+            raise BackupError('{0} exists; pass --force to replace it'
+                              .format(database))
+    name = name or snapshotNames(backupDir)[-1]
+    snapshotDir = os.path.join(backupDir, 'snapshots', name)
+    snapshots = [os.path.join(snapshotDir, fileName)
+                 for fileName in snapshotFiles(databases)]
+    for snapshot in snapshots:
+        if not os.path.exists(snapshot):
+            raise BackupError('Snapshot {0} has no {1}'.format(
+                name, os.path.basename(snapshot)))
+        checkDatabase(snapshot)
+    manifest = readManifest(backupDir)
+    copies = blobstore.LocalStore(os.path.join(backupDir, 'blobs'))
+    throttle = Throttle(rate)
+    keys = snapshotKeys(snapshotDir)
+    for store, key in keys:
+        data = checkedBlob(copies, manifest, key)
+        stores[store].put(key, data)
+        throttle.consume(len(data))
+    for store, key in keys:
+        if not stores[store].exists(key):
+            raise BackupError('{0} was not restored'.format(key))
+    for database, snapshot in zip(databases, snapshots):
+        tmpName = database + '.restore'
+        shutil.copyfile(snapshot, tmpName)
+        checkDatabase(tmpName)
+        os.rename(tmpName, database)
+    print('Restored snapshot {0}: {1} blobs'.format(name, len(keys)),
+          file=out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('command', choices=['backup', 'verify', 'restore'])
+    parser.add_argument('backupDir')
+    parser.add_argument('--database', action='append',
+                        help='a database to back up or restore; give it '
+                             'once for each shard and the directory')
+    parser.add_argument('--storage', default=STORAGE_URL)
+    parser.add_argument('--cold-storage', default=COLD_STORAGE_URL)
+    parser.add_argument('--rate', type=int, default=0,
+                        help='bytes a second to read or write; 0 for no limit')
+    parser.add_argument('--snapshot')
+    parser.add_argument('--force', action='store_true')
+    args = parser.parse_args(argv)
+    stores = {'hot': blobstore.from_url(args.storage),
+              'cold': blobstore.from_url(args.cold_storage)}
+    try:
+        databases = args.database or configuredDatabases()
+        if args.command == 'backup':
+            name, missing = backup(args.backupDir, stores, databases,
+                                   args.rate)
+            return 1 if missing else 0
+        if args.command == 'verify':
+            return 1 if verify(args.backupDir, args.snapshot) else 0
+        restore(args.backupDir, stores, databases, args.snapshot,
+                args.force, args.rate)
+    except BackupError as e:
+        print(e, file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
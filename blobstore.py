@@ -0,0 +1,376 @@
+"""Storage for the blobs that hold project contents.
+
+A store maps string keys to byte strings. Three backends are provided:
+files in a local directory, rows in an SQLite database and objects in an
+S3-compatible bucket. from_url picks one from a configuration string:
+
+    storage                          files under ./storage
+    file:/srv/snap/storage           files under /srv/snap/storage
+    sqlite:///blobs.sqlite           an SQLite database
+    s3://bucket/prefix?endpoint_url=http://localhost:9000
+
+Every store can read and write a blob as a sequence of chunks, fetch many
+blobs at once, and prefetch blobs in the background so that the caller
+can do other work while they are read.
+"""
+
+from __future__ import print_function
+
+import os
+import sqlite3
+import tempfile
+import threading
+
+try:
+    from urlparse import urlsplit, parse_qsl
+except ImportError:
+    from urllib.parse import urlsplit, parse_qsl
+
+try:
+    import boto3
+except ImportError:
+    boto3 = None
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+class BlobNotFound(IOError):
+    pass
+
+
+class Future(object):
+    """The result of calling fn(*args) on a background thread."""
+
+    def __init__(self, fn, *args):
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+        thread = threading.Thread(target=self._run, args=(fn, args))
+        thread.daemon = True
+        thread.start()
+
+    def _run(self, fn, args):
+        try:
+            self._result = fn(*args)
+        except Exception as e:
+            self._error = e
+        finally:
+            self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise RuntimeError('Timed out waiting for a background read')
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+def spawn(fn, *args):
+    return Future(fn, *args)
+
+
+class BlobStore(object):
+    """Base class for stores; subclasses supply read_stream, write_stream,
+    delete, exists and keys."""
+
+    def read_stream(self, key, chunk_size=CHUNK_SIZE):
+        raise NotImplementedError
+
+    def write_stream(self, key, chunks):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def exists(self, key):
+        raise NotImplementedError
+
+    def keys(self):
+        """Yield the key of every blob in the store."""
+        raise NotImplementedError
+
+    def get(self, key):
+        return b''.join(self.read_stream(key))
+
+    def put(self, key, data):
+        self.write_stream(key, [data])
+
+    def get_many(self, keys):
+        """Return a dict mapping each of keys to its blob."""
+        return dict((key, self.get(key)) for key in set(keys))
+
+    def prefetch(self, keys):
+        """Start reading keys in the background; the Future's result is
+        the dict get_many would return."""
+        return spawn(self.get_many, list(keys))
+
+
+class LocalStore(BlobStore):
+
+    def __init__(self, root, fileProxy=None):
+        self.root = root
+        self.fileProxy = fileProxy or (lambda fobj: fobj)
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def read_stream(self, key, chunk_size=CHUNK_SIZE):
+        try:
+            f = self.fileProxy(open(self.path(key), 'rb'))
+        except IOError:
+            raise BlobNotFound(key)
+        try:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            f.close()
+
+    def get(self, key):
+        try:
+            f = self.fileProxy(open(self.path(key), 'rb'))
+        except IOError:
+            raise BlobNotFound(key)
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def write_stream(self, key, chunks):
+        if not os.path.isdir(self.root):
+            try:
+                os.makedirs(self.root)
+            except OSError:
+                if not os.path.isdir(self.root):
+                    raise
+        # Each writer has a file of its own, as several may put the same
+        # key at once.
+        fd, tmpName = tempfile.mkstemp(prefix=key + '.', suffix='.tmp',
+                                       dir=self.root)
+        try:
+            f = self.fileProxy(os.fdopen(fd, 'wb'))
+            try:
+                for chunk in chunks:
+                    f.write(chunk)
+            finally:
+                f.close()
+            try:
+                os.rename(tmpName, self.path(key))
+            except OSError:
+                # Windows won't rename over a file. Keys name their
+                # contents, so the one already there is the same blob.
+                if not os.path.exists(self.path(key)):
+                    raise
+        finally:
+            if os.path.exists(tmpName):
+                os.remove(tmpName)
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def keys(self):
+        if not os.path.isdir(self.root):
+            return
+        for name in sorted(os.listdir(self.root)):
+            # Files being written by write_stream end in .tmp.
+            if not name.endswith('.tmp') and \
+                    os.path.isfile(self.path(name)):
+                yield name
+
+
+class SQLiteStore(BlobStore):
+    """Blobs kept in a table of their own SQLite database.
+
+    SQLite has no way to append to a blob, so write_stream gathers the
+    chunks before storing them; reads are streamed a chunk at a time.
+    """
+
+    BATCH_SIZE = 500
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.connection().execute(
+            'CREATE TABLE IF NOT EXISTS blobs '
+            '(key TEXT PRIMARY KEY, data BLOB NOT NULL)')
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None)
+            self.local.conn = conn
+        return conn
+
+    def read_stream(self, key, chunk_size=CHUNK_SIZE):
+        conn = self.connection()
+        row = conn.execute('SELECT length(data) FROM blobs WHERE key = ?',
+                           (key,)).fetchone()
+        if row is None:
+            raise BlobNotFound(key)
+        for start in range(0, row[0], chunk_size):
+            chunk = conn.execute(
+                'SELECT substr(data, ?, ?) FROM blobs WHERE key = ?',
+                (start + 1, chunk_size, key)).fetchone()
+            if chunk is None:
+                raise BlobNotFound(key)
+            yield bytes(chunk[0])
+
+    def get(self, key):
+        row = self.connection().execute(
+            'SELECT data FROM blobs WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            raise BlobNotFound(key)
+        return bytes(row[0])
+
+    def get_many(self, keys):
+        keys = list(set(keys))
+        blobs = {}
+        conn = self.connection()
+        for start in range(0, len(keys), self.BATCH_SIZE):
+            batch = keys[start:start + self.BATCH_SIZE]
+            rows = conn.execute(
+                'SELECT key, data FROM blobs WHERE key IN ({0})'.format(
+                    ', '.join('?' * len(batch))), batch)
+            for key, data in rows:
+                blobs[key] = bytes(data)
+        for key in keys:
+            if key not in blobs:
+                raise BlobNotFound(key)
+        return blobs
+
+    def write_stream(self, key, chunks):
+        self.connection().execute(
+            'INSERT OR REPLACE INTO blobs (key, data) VALUES (?, ?)',
+            (key, sqlite3.Binary(b''.join(chunks))))
+
+    def delete(self, key):
+        self.connection().execute('DELETE FROM blobs WHERE key = ?', (key,))
+
+    def exists(self, key):
+        return self.connection().execute(
+            'SELECT 1 FROM blobs WHERE key = ?', (key,)).fetchone() is not None
+
+    def keys(self):
+        rows = self.connection().execute(
+            'SELECT key FROM blobs ORDER BY key').fetchall()
+        for key, in rows:
+            yield key
+
+
+class _ChunkReader(object):
+    """A file-like object reading from an iterable of chunks."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += next(self.chunks)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def _isMissing(error):
+    code = getattr(error, 'response', {}).get('Error', {}).get('Code')
+    return code in ('404', 'NoSuchKey', 'NotFound')
+
+
+class S3Store(BlobStore):
+    """Blobs kept as objects in an S3-compatible bucket.
+
+    Needs boto3 unless a client with the same interface is passed in.
+    Other keyword arguments, such as endpoint_url, go to boto3.client.
+    """
+
+    MAX_PARALLEL = 8
+
+    def __init__(self, bucket, prefix='', client=None, **clientArgs):
+        if client is None:
+            if boto3 is None:
+                raise ImportError('S3 blob storage requires boto3')
+            client = boto3.client('s3', **clientArgs)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def read_stream(self, key, chunk_size=CHUNK_SIZE):
+        try:
+            body = self.client.get_object(Bucket=self.bucket,
+                                          Key=self.prefix + key)['Body']
+        except Exception as e:
+            if _isMissing(e):
+                raise BlobNotFound(key)
+            raise
+        try:
+            while True:
+                chunk = body.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            body.close()
+
+    def get_many(self, keys):
+        keys = list(set(keys))
+        blobs = {}
+        for start in range(0, len(keys), self.MAX_PARALLEL):
+            batch = [(key, spawn(self.get, key))
+                     for key in keys[start:start + self.MAX_PARALLEL]]
+            for key, future in batch:
+                blobs[key] = future.result()
+        return blobs
+
+    def write_stream(self, key, chunks):
+        self.client.upload_fileobj(_ChunkReader(chunks), self.bucket,
+                                   self.prefix + key)
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self.prefix + key)
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.prefix + key)
+        except Exception as e:
+            if _isMissing(e):
+                return False
+            raise
+        return True
+
+    def keys(self):
+        pages = self.client.get_paginator('list_objects_v2').paginate(
+            Bucket=self.bucket, Prefix=self.prefix)
+        for page in pages:
+            for obj in page.get('Contents', []):
+                yield obj['Key'][len(self.prefix):]
+
+
+def from_url(url, fileProxy=None):
+    """Return the store described by url; see the module docstring."""
+    parts = urlsplit(url)
+    if parts.scheme in ('', 'file'):
+        return LocalStore(parts.netloc + parts.path, fileProxy)
+    if parts.scheme == 'sqlite':
+        return SQLiteStore(parts.path[1:] if parts.path.startswith('/')
+                           else parts.path)
+    if parts.scheme == 's3':
+        options = dict(parse_qsl(parts.query))
+        return S3Store(parts.netloc, parts.path.lstrip('/'), **options)
+    raise ValueError('Unknown blob storage {0!r}'.format(url))
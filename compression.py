@@ -0,0 +1,253 @@
+"""Helpers for serving pre-compressed content.
+
+Stored content is kept as raw deflate segments, each ending in a full flush
+so that it does not refer back to any earlier data. Segments can therefore
+be spliced together in any order and wrapped in a fresh gzip header and
+trailer, so stored revisions can be sent to clients without being
+recompressed. A single segment is stored as a gzip file with an empty final
+block; a revision is stored as a segments file holding literal segments and
+references to separately stored blobs.
+"""
+
+from __future__ import print_function
+
+import bz2
+import struct
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+
+SEGMENTS_MAGIC = b'SNAPSEG1'
+XZ_MAGIC = b'\xfd7zXZ\x00'
+BZ2_MAGIC = b'BZh'
+GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+FINAL_BLOCK = b'\x03\x00'
+COMPRESS_LEVEL = 6
+
+
+class Segment(object):
+    """A raw deflate segment, with the crc32 and size of its contents."""
+
+    __slots__ = ('data', 'crc', 'size')
+
+    def __init__(self, data, crc, size):
+        self.data = data
+        self.crc = crc
+        self.size = size
+
+
+def crc32(data, crc=0):
+    return zlib.crc32(data, crc) & 0xffffffff
+
+
+def _gf2_times(mat, vec):
+    total = 0
+    i = 0
+    while vec:
+        if vec & 1:
+            total ^= mat[i]
+        vec >>= 1
+        i += 1
+    return total
+
+
+def _gf2_square(mat):
+    return [_gf2_times(mat, mat[n]) for n in range(32)]
+
+
+def crc32_combine(crc1, crc2, len2):
+    """Return the crc32 of A + B given crc32(A), crc32(B) and len(B)."""
+    if len2 == 0:
+        return crc1
+    odd = [0xedb88320] + [1 << n for n in range(31)]
+    even = _gf2_square(odd)
+    odd = _gf2_square(even)
+    while True:
+        even = _gf2_square(odd)
+        if len2 & 1:
+            crc1 = _gf2_times(even, crc1)
+        len2 >>= 1
+        if not len2:
+            break
+        odd = _gf2_square(even)
+        if len2 & 1:
+            crc1 = _gf2_times(odd, crc1)
+        len2 >>= 1
+        if not len2:
+            break
+    return (crc1 ^ crc2) & 0xffffffff
+
+
+def compress_segment(data, level=COMPRESS_LEVEL):
+    comp = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = comp.compress(data) + comp.flush(zlib.Z_FULL_FLUSH)
+    return Segment(body, crc32(data), len(data))
+
+
+def gzip_trailer(crc, size):
+    return struct.pack('<II', crc, size & 0xffffffff)
+
+
+def combine(segments):
+    """Return the (crc, size) of the concatenated contents of segments."""
+    crc = 0
+    size = 0
+    for seg in segments:
+        crc = crc32_combine(crc, seg.crc, seg.size)
+        size += seg.size
+    return crc, size
+
+
+def gzip_length(segments):
+    return (len(GZIP_HEADER) + sum(len(seg.data) for seg in segments) +
+            len(FINAL_BLOCK) + 8)
+
+
+def gzip_stream(segments):
+    """Yield a single gzip member containing all of the segments in order."""
+    segments = list(segments)
+    crc, size = combine(segments)
+    yield GZIP_HEADER
+    for seg in segments:
+        yield seg.data
+    yield FINAL_BLOCK + gzip_trailer(crc, size)
+
+
+def gzip_file_contents(segment):
+    return b''.join(gzip_stream([segment]))
+
+
+def read_segment(gz):
+    """Recover the segment stored by gzip_file_contents."""
+    if (len(gz) < len(GZIP_HEADER) + len(FINAL_BLOCK) + 8 or
+            gz[:4] != GZIP_HEADER[:4]):
+        raise ValueError('Not a segment gzip file')
+    crc, size = struct.unpack('<II', gz[-8:])
+    body = gz[len(GZIP_HEADER):-8]
+    if body[-len(FINAL_BLOCK):] != FINAL_BLOCK:
+        raise ValueError('Segment gzip file is not spliceable')
+    return Segment(body[:-len(FINAL_BLOCK)], crc, size)
+
+
+def pack_segments(items):
+    """Serialize a list of segments and 40 character blob references."""
+    header = [SEGMENTS_MAGIC, struct.pack('<I', len(items))]
+    body = []
+    for item in items:
+        if isinstance(item, Segment):
+            header.append(b'L' + struct.pack('<III', item.crc, item.size,
+                                             len(item.data)))
+            body.append(item.data)
+        else:
+            header.append(b'R' + item.encode('ascii'))
+    return b''.join(header + body)
+
+
+def unpack_segments(data):
+    """Inverse of pack_segments; references are returned as str."""
+    if data[:len(SEGMENTS_MAGIC)] != SEGMENTS_MAGIC:
+        raise ValueError('Not a segments file')
+    pos = len(SEGMENTS_MAGIC)
+    count, = struct.unpack('<I', data[pos:pos + 4])
+    pos += 4
+    entries = []
+    for _ in range(count):
+        kind = data[pos:pos + 1]
+        if kind == b'L':
+            entries.append(struct.unpack('<III', data[pos + 1:pos + 13]))
+            pos += 13
+        elif kind == b'R':
+            entries.append(str(data[pos + 1:pos + 41].decode('ascii')))
+            pos += 41
+        else:
+            raise ValueError('Corrupt segments file')
+    items = []
+    for entry in entries:
+        if isinstance(entry, str):
+            items.append(entry)
+        else:
+            crc, size, length = entry
+            items.append(Segment(data[pos:pos + length], crc, size))
+            pos += length
+    if pos != len(data):
+        raise ValueError('Corrupt segments file')
+    return items
+
+
+def inflate(segments):
+    decomp = zlib.decompressobj(-zlib.MAX_WBITS)
+    out = [decomp.decompress(seg.data) for seg in segments]
+    out.append(decomp.flush())
+    return b''.join(out)
+
+
+def parse_accept_encoding(header):
+    """Return a dict mapping each content coding to its quality value."""
+    codings = {}
+    if not header:
+        return codings
+    for item in header.split(','):
+        parts = item.strip().split(';')
+        coding = parts[0].strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in parts[1:]:
+            name, _, value = param.strip().partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        codings[coding] = quality
+    return codings
+
+
+def accepts(codings, coding):
+    if coding in codings:
+        return codings[coding] > 0
+    return codings.get('*', 0) > 0
+
+
+def choose_encoding(header):
+    """Pick the content coding to use for a response, or None."""
+    codings = parse_accept_encoding(header)
+    if brotli is not None and accepts(codings, 'br'):
+        return 'br'
+    if accepts(codings, 'gzip'):
+        return 'gzip'
+    return None
+
+
+def compress(data, coding):
+    if coding == 'br':
+        return brotli.compress(data)
+    if coding == 'gzip':
+        return gzip_file_contents(compress_segment(data))
+    raise ValueError('Unknown content coding {0!r}'.format(coding))
+
+
+def archive_compress(data):
+    """Compress data as tightly as the standard library allows."""
+    if lzma is not None:
+        return lzma.compress(data, preset=9)
+    return bz2.compress(data, 9)
+
+
+def archive_decompress(data):
+    if data[:len(XZ_MAGIC)] == XZ_MAGIC:
+        if lzma is None:
+            raise ValueError('Reading xz archives requires lzma')
+        return lzma.decompress(data)
+    if data[:len(BZ2_MAGIC)] == BZ2_MAGIC:
+        return bz2.decompress(data)
+    raise ValueError('Unknown archive format')
@@ -0,0 +1,99 @@
+#!/usr/bin/env python2
+"""Compare the size and render time of XML and JSON list responses.
+
+Builds a fixture in a scratch database, requests each list route once to
+capture the records it responds with, renders those records as XML and as
+JSON, and prints the payload size and the median time to render it. The
+time covers respondList alone, not the queries that fetched the records:
+
+    python formatbench.py [size] [repeat]
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import tempfile
+import time
+
+import querybudget
+
+
+ROUTES = ['/listProjects', '/getProjectByName', '/searchProjects',
+          '/listPublicProjects', '/listMembers', '/listStudents',
+          '/listTeachers', '/listCoursesTeaching', '/listCoursesEnrolled',
+          '/listAssignments', '/listSubmissions']
+
+FORMATS = [('xml', 'application/xml'), ('json', 'application/json')]
+
+
+def captureList(server, path, **kwargs):
+    """Run a request; return its status and the arguments after req and
+    resp that it passed to respondList, or None if it did not."""
+    captured = []
+    respondList = server.respondList
+
+    def capture(req, resp, *args):
+        captured.append(args)
+        return respondList(req, resp, *args)
+    server.respondList = capture
+    try:
+        response = querybudget.request(server.app, path, **kwargs)
+    finally:
+        server.respondList = respondList
+    return response[0], captured[0] if captured else None
+
+
+def timeRender(server, args, accept, repeat):
+    """Return the size of the body respondList renders from args for an
+    Accept header and the median seconds taken to render it."""
+    import falcon
+    from falcon.testing import create_environ
+    req = falcon.Request(create_environ(headers={'Accept': accept}))
+    times = []
+    for _ in range(repeat):
+        resp = falcon.Response()
+        start = time.time()
+        server.respondList(req, resp, *args)
+        body = resp.body
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        times.append(time.time() - start)
+    times.sort()
+    return len(body), times[len(times) // 2]
+
+
+def report(size=50, repeat=9, out=sys.stdout):
+    scratch = tempfile.mkdtemp(prefix='formatbench')
+    os.chdir(scratch)
+    os.mkdir('storage')
+    sys.path.insert(0, querybudget.HERE)
+    import server
+    try:
+        from urllib import urlencode
+    except ImportError:
+        from urllib.parse import urlencode
+    user, params, _ = querybudget.build_fixture(server, 'fb', size)
+    query_string = urlencode(sorted(params.items()))
+    print('{0:24} {1:>6} {2:>9} {3:>9} {4:>9} {5:>9}'.format(
+        'route', 'status', 'xml B', 'json B', 'xml ms', 'json ms'), file=out)
+    for path in ROUTES:
+        status, args = captureList(server, path, user=user,
+                                   query_string=query_string)
+        if args is None:
+            print('{0:24} {1:>6} {2:>9}'.format(path, status.split()[0],
+                                                'no list'), file=out)
+            continue
+        sizes = []
+        times = []
+        for _, accept in FORMATS:
+            size, seconds = timeRender(server, args, accept, repeat)
+            sizes.append(size)
+            times.append(seconds * 1000)
+        print('{0:24} {1:>6} {2:>9} {3:>9} {4:>9.2f} {5:>9.2f}'.format(
+            path, status.split()[0], sizes[0], sizes[1], times[0],
+            times[1]), file=out)
+
+
+if __name__ == '__main__':
+    report(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,143 @@
+"""Validate Snap! project XML and rewrite it in a canonical form.
+
+Projects are parsed incrementally with expat as they are read, so a save
+that is too large or too deeply nested is rejected before all of it has
+been read. The canonical form drops the XML declaration, comments,
+processing instructions and whitespace-only text between elements, and
+writes empty elements as <tag/>; text inside elements without children,
+such as a string slot holding a single space, is kept as it is.
+"""
+
+from __future__ import print_function
+
+import xml.parsers.expat
+
+
+CHUNK_SIZE = 64 * 1024
+MAX_SIZE = 64 * 1024 * 1024
+MAX_DEPTH = 1024
+
+
+class InvalidProject(ValueError):
+    pass
+
+
+class Document(object):
+    """A canonical project and the metadata gathered while writing it."""
+
+    __slots__ = ('contents', 'byteSize', 'spriteCount', 'mediaSize')
+
+    def __init__(self, contents, spriteCount, mediaSize):
+        self.contents = contents
+        self.byteSize = len(contents)
+        self.spriteCount = spriteCount
+        self.mediaSize = mediaSize
+
+
+def _escape(text, quote=False):
+    text = text.replace(u'&', u'&amp;').replace(u'<', u'&lt;') \
+               .replace(u'>', u'&gt;')
+    if quote:
+        text = text.replace(u'"', u'&quot;').replace(u'\n', u'&#10;') \
+                   .replace(u'\r', u'&#13;').replace(u'\t', u'&#9;')
+    return text
+
+
+class _Normalizer(object):
+
+    def __init__(self, maxDepth):
+        self.maxDepth = maxDepth
+        self.out = []
+        # One entry per open element: whether its start tag is still
+        # unclosed, and whether it has child elements.
+        self.open = []
+        self.text = []
+        self.spriteCount = 0
+        self.mediaSize = 0
+
+    def flushText(self, beforeChild):
+        text = u''.join(self.text)
+        self.text = []
+        if not text:
+            return
+        parent = self.open[-1]
+        if not text.strip() and (beforeChild or parent[1]):
+            return
+        self.closeStartTag()
+        self.out.append(_escape(text))
+
+    def closeStartTag(self):
+        if self.open and self.open[-1][0]:
+            self.out.append(u'>')
+            self.open[-1][0] = False
+
+    def start(self, tag, attrs):
+        if self.open:
+            self.flushText(True)
+            self.closeStartTag()
+            self.open[-1][1] = True
+        if len(self.open) >= self.maxDepth:
+            raise InvalidProject('Project is nested too deeply.')
+        if tag == 'sprite':
+            self.spriteCount += 1
+        parts = [u'<', tag]
+        for i in range(0, len(attrs), 2):
+            value = attrs[i + 1]
+            if value.startswith(u'data:'):
+                self.mediaSize += len(value)
+            parts.extend((u' ', attrs[i], u'="', _escape(value, True), u'"'))
+        self.out.append(u''.join(parts))
+        self.open.append([True, False])
+
+    def end(self, tag):
+        self.flushText(False)
+        unclosed, _ = self.open.pop()
+        if unclosed:
+            self.out.append(u'/>')
+        else:
+            self.out.append(u'</' + tag + u'>')
+
+    def characters(self, data):
+        if self.open:
+            self.text.append(data)
+
+    def rejectDoctype(self, *args):
+        raise InvalidProject('Projects may not contain a DTD.')
+
+
+def normalize(chunks, maxSize=MAX_SIZE, maxDepth=MAX_DEPTH):
+    """Parse a project from an iterable of byte strings.
+
+    Returns a Document, or raises InvalidProject if the project is not
+    well-formed XML or exceeds the limits.
+    """
+    handler = _Normalizer(maxDepth)
+    parser = xml.parsers.expat.ParserCreate()
+    parser.ordered_attributes = True
+    parser.buffer_text = True
+    parser.StartElementHandler = handler.start
+    parser.EndElementHandler = handler.end
+    parser.CharacterDataHandler = handler.characters
+    parser.StartDoctypeDeclHandler = handler.rejectDoctype
+    size = 0
+    try:
+        for chunk in chunks:
+            size += len(chunk)
+            if size > maxSize:
+                raise InvalidProject('Project is too large.')
+            parser.Parse(chunk, False)
+        parser.Parse(b'', True)
+    except xml.parsers.expat.ExpatError as e:
+        raise InvalidProject('Project is not valid XML: {0}'.format(
+            xml.parsers.expat.ErrorString(e.code)))
+    contents = u''.join(handler.out).encode('utf-8')
+    return Document(contents, handler.spriteCount, handler.mediaSize)
+
+
+def readChunks(stream, chunkSize=CHUNK_SIZE):
+    """Yield the contents of a file-like object a chunk at a time."""
+    while True:
+        chunk = stream.read(chunkSize)
+        if not chunk:
+            break
+        yield chunk
@@ -0,0 +1,144 @@
+"""An in-process publish/subscribe bus.
+
+Publishers send events to string topics; each subscriber receives the
+events of the topics it subscribed to in a queue of its own, so a slow
+subscriber never holds up a publisher. Every event gets an id one greater
+than the last, and the bus remembers its most recent events so that a
+subscriber can ask for those published since an id it has already seen:
+
+    subscription = bus.subscribe(['project:1234'], since=lastId)
+    for event in subscription.backlog:
+        ...
+    event = subscription.get(timeout=30)
+
+Only subscribers in the same process see an event.
+"""
+
+from __future__ import print_function
+
+import collections
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+HISTORY_SIZE = 1024
+MAX_PENDING = 256
+
+
+class Event(object):
+
+    __slots__ = ('eventId', 'topic', 'data')
+
+    def __init__(self, eventId, topic, data):
+        self.eventId = eventId
+        self.topic = topic
+        self.data = data
+
+
+class Subscription(object):
+    """The events published to some topics since it was made.
+
+    backlog holds the events requested with since; missed is set if the
+    bus no longer remembers all of them, and overflowed if more events
+    arrived than the subscriber read in time, in which case later events
+    are dropped.
+    """
+
+    def __init__(self, bus, topics, maxPending):
+        self.bus = bus
+        self.topics = topics
+        self.pending = queue.Queue(maxPending)
+        self.backlog = []
+        self.lastId = 0
+        self.missed = False
+        self.overflowed = False
+
+    def put(self, event):
+        try:
+            self.pending.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+
+    def get(self, timeout=None):
+        """Return the next event, or None if none arrives in timeout
+        seconds."""
+        try:
+            event = self.pending.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        self.lastId = event.eventId
+        return event
+
+    def drain(self):
+        """Return the events that have already arrived."""
+        events = []
+        while True:
+            try:
+                events.append(self.pending.get_nowait())
+            except queue.Empty:
+                break
+        if events:
+            self.lastId = events[-1].eventId
+        return events
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+
+class Bus(object):
+
+    def __init__(self, historySize=HISTORY_SIZE, maxPending=MAX_PENDING):
+        self.lock = threading.Lock()
+        self.subscribers = {}
+        self.history = collections.deque(maxlen=historySize)
+        self.maxPending = maxPending
+        self.lastId = 0
+        self.published = 0
+
+    def publish(self, topic, data):
+        with self.lock:
+            self.lastId += 1
+            self.published += 1
+            event = Event(self.lastId, topic, data)
+            self.history.append(event)
+            subscribers = list(self.subscribers.get(topic, ()))
+        for subscription in subscribers:
+            subscription.put(event)
+        return event
+
+    def subscribe(self, topics, since=None):
+        topics = frozenset(topics)
+        subscription = Subscription(self, topics, self.maxPending)
+        with self.lock:
+            subscription.lastId = self.lastId
+            if since is not None:
+                oldest = self.history[0].eventId if self.history \
+                    else self.lastId + 1
+                subscription.missed = since > self.lastId or \
+                    since + 1 < oldest
+                subscription.backlog = [event for event in self.history
+                                        if event.eventId > since and
+                                        event.topic in topics]
+            for topic in topics:
+                self.subscribers.setdefault(topic, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            for topic in subscription.topics:
+                subscribers = self.subscribers.get(topic)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self.subscribers[topic]
+
+    def stats(self):
+        with self.lock:
+            return {'published': self.published,
+                    'topics': len(self.subscribers),
+                    'subscriptions': len(set().union(
+                        *self.subscribers.values()))}
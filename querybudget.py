@@ -0,0 +1,286 @@
+#!/usr/bin/env python2
+"""Count the SQL statements each request runs, to catch N+1 queries.
+
+In a test, wrap a request in a query budget:
+
+    import querybudget
+    import server
+
+    querybudget.assert_query_budget(server.app, 4, '/listProjects',
+                                    user=('alice', 'secret'))
+
+The request fails the test if it runs more than 4 statements, and the
+assertion lists every statement it ran. Running this module prints the
+number of statements each route runs against a scratch database, once
+with a small fixture and once with a larger one, and flags the routes
+whose count grows with the size of the data:
+
+    python querybudget.py
+"""
+
+from __future__ import print_function
+
+import base64
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+
+import sqlalchemy.event
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class QueryLog(object):
+    """Records the statements run on some engines while it is active.
+
+    Only statements issued on behalf of the thread that entered the log are
+    counted, so work done by background threads does not count against a
+    request. requester returns the thread a statement is run for: the
+    current one, or for the group commit thread, the one that queued the
+    write it is running.
+
+    Each engine is given its listeners once, the first time a log watches
+    it; entering a log only marks its thread as measured. Adding and
+    removing listeners around every request would change the engine's
+    listener list while other threads run statements.
+    """
+
+    def __init__(self, engines, requester=threading.current_thread):
+        self.engines = list(engines)
+        self.requester = requester
+        self.statements = []
+        self.thread = None
+
+    def __len__(self):
+        return len(self.statements)
+
+    @property
+    def elapsed(self):
+        return sum(seconds for _, _, seconds in self.statements)
+
+    def __enter__(self):
+        self.thread = threading.current_thread()
+        for engine in self.engines:
+            _listen(engine)
+        with _lock:
+            _logs[self.thread] = self
+        return self
+
+    def __exit__(self, *exc_info):
+        with _lock:
+            if _logs.get(self.thread) is self:
+                del _logs[self.thread]
+
+    def watches(self, conn):
+        return (conn.engine in self.engines and
+                self.requester() is self.thread)
+
+    def format(self):
+        return '\n'.join('  {0:.1f}ms  {1} {2!r}'.format(seconds * 1000,
+                                                         ' '.join(sql.split()),
+                                                         params)
+                         for sql, params, seconds in self.statements)
+
+
+_lock = threading.Lock()
+_logs = {}
+_engines = set()
+
+
+def _listen(engine):
+    with _lock:
+        if engine in _engines:
+            return
+        _engines.add(engine)
+    sqlalchemy.event.listen(engine, 'before_cursor_execute', _before)
+    sqlalchemy.event.listen(engine, 'after_cursor_execute', _after)
+
+
+def _watching(conn):
+    """Return the active logs the statement being run on conn counts for."""
+    if not _logs:
+        return []
+    with _lock:
+        logs = list(_logs.values())
+    return [log for log in logs if log.watches(conn)]
+
+
+def _before(conn, cursor, statement, parameters, context, executemany):
+    if _watching(conn):
+        conn.info.setdefault('querybudget.start', []).append(time.time())
+
+
+def _after(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('querybudget.start')
+    if not starts:
+        return
+    seconds = time.time() - starts.pop()
+    for log in _watching(conn):
+        log.statements.append((statement, parameters, seconds))
+
+
+def default_engines():
+    import server
+    return [server.sql_engine, server.write_engine]
+
+
+def server_log():
+    """Return a QueryLog of the server's engines and group commits."""
+    import server
+    return QueryLog(default_engines(), server.writes.requester)
+
+
+def request(app, path, query_string='', body='', method='GET', user=None,
+            headers=None):
+    """Run one request through a WSGI app; return (status, headers, body)."""
+    from falcon.testing import create_environ
+    headers = dict(headers or {})
+    if user is not None:
+        token = base64.b64encode(':'.join(user).encode('utf-8'))
+        headers['Authorization'] = 'Basic ' + token.decode('ascii')
+    env = create_environ(path=path, query_string=query_string, body=body,
+                         method=method, headers=headers)
+    result = {}
+
+    def start_response(status, response_headers, exc_info=None):
+        result['status'] = status
+        result['headers'] = dict(response_headers)
+
+    chunks = app(env, start_response)
+    data = b''.join(chunk if isinstance(chunk, bytes)
+                    else chunk.encode('utf-8') for chunk in chunks)
+    return result['status'], result['headers'], data
+
+
+def measure(app, path, engines=None, **kwargs):
+    """Run a request and return (QueryLog, (status, headers, body))."""
+    log = server_log() if engines is None else QueryLog(engines)
+    with log:
+        response = request(app, path, **kwargs)
+    return log, response
+
+
+def assert_query_budget(app, budget, path, engines=None, **kwargs):
+    log, response = measure(app, path, engines, **kwargs)
+    if len(log) > budget:
+        raise AssertionError(
+            '{0} ran {1} queries in {2:.1f}ms, over its budget of {3}:\n{4}'
+            .format(path, len(log), log.elapsed * 1000, budget, log.format()))
+    return response
+
+
+def routes(app):
+    """Return the paths of the literal routes added to app, a server.API."""
+    paths = [path for path in app.routes if re.match(r'^/\w+$', path)]
+    destructive = re.compile(r'^/(un|remove|reset|change)')
+    return sorted(paths, key=lambda path: (bool(destructive.match(path)),
+                                           path))
+
+
+def build_fixture(server, prefix, size):
+    """Create users, a course, projects and submissions; return params."""
+    password = 'secret'
+    owner = prefix + 'owner'
+    contents = b'<project name="p"><stage name="Stage"/></project>'
+    with server.session_scope() as session:
+        users = [server.User(userName=prefix + 'user' + str(i),
+                             password=server.hash_password(
+                                 prefix + 'user' + str(i), password))
+                 for i in range(size)]
+        teacher = server.User(userName=owner,
+                              password=server.hash_password(owner, password))
+        course = server.Course(courseId=server.generateCourseId(),
+                               name=prefix + 'course', teachers=[teacher],
+                               students=users + [teacher])
+        assignment = server.Assignment(
+            assignId=server.generateAssignmentId(), name=prefix + 'hw',
+            course=[course])
+        session.add(assignment)
+        projects = []
+        for i in range(size):
+            project = server.Project(projId=server.generateProjId(),
+                                     owners=[teacher],
+                                     members=[teacher] + users,
+                                     sharedName=prefix + 'project',
+                                     public=True)
+            project.touch()
+            session.add(project)
+            document = server.readProject([contents.replace(
+                b'"p"', '"p{0}"'.format(i).encode('ascii'))])
+            revision, created = server.commitRevision(session, project,
+                                                      document)
+            if created:
+                revision.save(session, document.contents)
+            projects.append(project)
+            session.add(server.Submission(
+                submitId=server.generateSubmissionId(),
+                assignment=[assignment], revision=revision, project=project,
+                members=list(project.members), submitter=teacher,
+                time=server.datetime.datetime.utcnow()))
+        upload = server.Upload(uploadId=server.generateUploadId(),
+                               project=projects[0], user=teacher,
+                               size=len(contents))
+        upload.touch()
+        session.add(upload)
+        session.flush()
+        params = {
+            'userName': users[0].userName,
+            'projId': projects[0].projId,
+            'courseId': course.courseId,
+            'assignId': assignment.assignId,
+            'revId': projects[0].headId,
+            'fromRevId': projects[0].headId,
+            'toRevId': projects[-1].headId,
+            'uploadId': upload.uploadId,
+            'offset': '0',
+            'size': str(len(contents)),
+            'checksum': server.sha1hex(contents),
+            'projectName': prefix + 'project',
+            'query': 'p',
+            'name': prefix + 'new',
+        }
+    return (owner, password), params, contents
+
+
+def report(sizes=(1, 10), out=sys.stdout):
+    scratch = tempfile.mkdtemp(prefix='querybudget')
+    os.chdir(scratch)
+    os.mkdir('storage')
+    sys.path.insert(0, HERE)
+    import server
+    try:
+        from urllib import urlencode
+    except ImportError:
+        from urllib.parse import urlencode
+    counts = {}
+    statuses = {}
+    for index, size in enumerate(sizes):
+        user, params, body = build_fixture(server, 'qb{0}'.format(index),
+                                           size)
+        query_string = urlencode(sorted(params.items()))
+        for path in routes(server.app):
+            log, response = measure(server.app, path, user=user,
+                                    query_string=query_string)
+            if response[0].startswith('405'):
+                log, response = measure(server.app, path, user=user,
+                                        query_string=query_string,
+                                        method='POST', body=body)
+            counts.setdefault(path, []).append(len(log))
+            statuses.setdefault(path, response[0].split()[0])
+    print('{0:32} {1:>6} {2}'.format(
+        'route', 'status', ' '.join('{0:>8}'.format('n=' + str(size))
+                                    for size in sizes)), file=out)
+    for path in routes(server.app):
+        grows = counts[path][-1] > counts[path][0]
+        print('{0:32} {1:>6} {2}{3}'.format(
+            path, statuses[path],
+            ' '.join('{0:>8}'.format(count) for count in counts[path]),
+            '  <- grows with data' if grows else ''), file=out)
+
+
+if __name__ == '__main__':
+    report()
@@ -0,0 +1,46 @@
+#!/usr/bin/env python2
+"""Move courses between shards while the server runs.
+
+    python rebalance.py                      list what each shard holds
+    python rebalance.py COURSE_ID SHARD      move a course to SHARD
+
+Run it with the same SNAP_SHARDS and SNAP_DIRECTORY as the server; see
+server.moveCourse for how a course is moved.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not os.environ.get('SNAP_SHARDS') or len(argv) not in (0, 2):
+        print(__doc__.strip(), file=sys.stderr)
+        return 2
+    import server
+    if not argv:
+        counts = server.directory.counts()
+        for shard, url in zip(server.SHARD_IDS, server.SHARDS):
+            kinds = counts.get(shard, {})
+            print('{0} {1}  {2}'.format(shard, url, '  '.join(
+                '{0}s {1}'.format(kind, kinds[kind])
+                for kind in sorted(kinds))))
+        return 0
+    courseId, shard = argv[0], int(argv[1])
+    if shard not in server.SHARD_IDS:
+        print('There is no shard {0}.'.format(shard), file=sys.stderr)
+        return 1
+    try:
+        server.moveCourse(courseId, shard)
+    except server.NoSuchCourse:
+        print('The directory has no course {0}.'.format(courseId),
+              file=sys.stderr)
+        return 1
+    print('Moved course {0} to shard {1}.'.format(courseId, shard))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
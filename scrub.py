@@ -0,0 +1,465 @@
+#!/usr/bin/env python2
+"""Check stored revisions against their ids, and the database against blob
+storage, while the server runs.
+
+    python scrub.py [--workers N] [--rate BYTES_PER_SECOND]
+                    [--report FILE] [--checkpoint FILE] [--restart]
+
+A revision's id is the sha1 of its parent's id followed by its contents,
+so every stored revision can be read back and checked. A pool of worker
+processes does this. Each stored content is read once for all the
+revisions that share it and checked against its own hash, and each media
+blob against its hash. The scrub then checks the references between rows,
+and that every blob in storage belongs to a row.
+
+The problems found are written to the report, scrub-report.json by
+default, as JSON; PROBLEMS lists the kinds. Progress is saved to the
+checkpoint file as the workers go, so a scrub that was interrupted carries
+on where it stopped when run again, unless --restart is given. --rate
+limits the bytes a second the workers read between them.
+
+Rows and blobs change while the server runs, so each problem is looked at
+a second time and only reported if it is still there. With shards, pass
+every shard database with --database, as they share the blob storage.
+"""
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import sqlite3
+import sys
+
+import backup
+import blobstore
+import compression
+
+
+DATABASE = 'snap.sqlite'
+STORAGE_URL = backup.STORAGE_URL
+COLD_STORAGE_URL = backup.COLD_STORAGE_URL
+REPORT = 'scrub-report.json'
+CHECKPOINT = 'scrub-checkpoint.json'
+# Tasks finished between saves of the checkpoint.
+CHECKPOINT_EVERY = 100
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+PROBLEMS = {
+    'missing': 'a row needs a blob that is not in storage',
+    'unreadable': 'a blob could not be decoded',
+    'revision-hash': "a revision's contents do not hash to its id",
+    'content-hash': 'a stored content does not hash to its key',
+    'media-hash': 'a media blob does not hash to its key',
+    'dangling': 'a row refers to a row that does not exist',
+    'orphan': 'a blob in storage belongs to no row',
+}
+
+# (table, key column, column, table referred to, column referred to)
+REFERENCES = [
+    ('projects', 'projId', 'headId', 'revisions', 'revId'),
+    ('submissions', 'submitId', 'revisionId', 'revisions', 'revId'),
+    ('revisions', 'revId', 'contentHash', 'contents', 'contentHash'),
+]
+
+# Tasks are done in this order, and by id within each kind.
+TASK_KINDS = ['content', 'legacy', 'media']
+
+# As in server.py.
+xmlDeclRe = re.compile(br'^\s*<\?xml[^>]*\?>\s*')
+
+
+def sha1hex(*parts):
+    sha1 = hashlib.sha1()
+    for part in parts:
+        sha1.update(part)
+    return sha1.hexdigest()
+
+
+class Databases(object):
+    """Runs queries on every database and gathers the rows."""
+
+    def __init__(self, paths):
+        self.paths = paths
+
+    def rows(self, sql, params=()):
+        rows = []
+        for path in self.paths:
+            conn = sqlite3.connect(path)
+            try:
+                rows.extend(tuple(str(value) if value is not None else None
+                                  for value in row)
+                            for row in conn.execute(sql, params))
+            finally:
+                conn.close()
+        return rows
+
+    def column(self, sql, params=()):
+        return set(row[0] for row in self.rows(sql, params))
+
+
+def contentTask(contentHash, revisions):
+    return ('content', contentHash, sorted(set(revisions)))
+
+
+def allTasks(dbs):
+    """Return every task, in the order they are done."""
+    revisions = {}
+    for revId, prevId, contentHash in dbs.rows(
+            'SELECT revId, prevId, contentHash FROM revisions '
+            'WHERE contentHash IS NOT NULL'):
+        revisions.setdefault(contentHash, []).append((revId, prevId))
+    tasks = [contentTask(contentHash, revisions.get(contentHash, []))
+             for contentHash in sorted(dbs.column(
+                 'SELECT contentHash FROM contents'))]
+    tasks.extend(('legacy', revId, prevId) for revId, prevId in sorted(set(
+        dbs.rows('SELECT revId, prevId FROM revisions '
+                 'WHERE contentHash IS NULL'))))
+    tasks.extend(('media', mediaHash) for mediaHash in sorted(dbs.column(
+        'SELECT mediaHash FROM media')))
+    return tasks
+
+
+def refreshTask(dbs, task):
+    """Return task as it stands now, or None if its rows are gone."""
+    kind, key = task[:2]
+    if kind == 'content':
+        if not dbs.column('SELECT 1 FROM contents WHERE contentHash = ?',
+                          (key,)):
+            return None
+        return contentTask(key, dbs.rows(
+            'SELECT revId, prevId FROM revisions WHERE contentHash = ?',
+            (key,)))
+    if kind == 'legacy':
+        prevIds = dbs.column('SELECT prevId FROM revisions '
+                             'WHERE revId = ? AND contentHash IS NULL',
+                             (key,))
+        return ('legacy', key, prevIds.pop()) if prevIds else None
+    if dbs.column('SELECT 1 FROM media WHERE mediaHash = ?', (key,)):
+        return task
+    return None
+
+
+def taskOrder(task):
+    return TASK_KINDS.index(task[0]), task[1]
+
+
+# Set in each worker process by initWorker.
+stores = {}
+throttle = None
+# Bytes read by this process; the throttle only counts them under a rate.
+bytesRead = 0
+
+
+def initWorker(storageUrl, coldStorageUrl, rate):
+    global throttle
+    stores['hot'] = blobstore.from_url(storageUrl)
+    stores['cold'] = blobstore.from_url(coldStorageUrl)
+    throttle = backup.Throttle(rate)
+
+
+class Problem(Exception):
+
+    def __init__(self, **fields):
+        Exception.__init__(self, fields)
+        self.fields = fields
+
+
+def read(store, key, table, rowId):
+    global bytesRead
+    try:
+        data = stores[store].get(key)
+    except blobstore.BlobNotFound:
+        raise Problem(kind='missing', table=table, id=rowId, keys=[key])
+    bytesRead += len(data)
+    throttle.consume(len(data))
+    return data
+
+
+def decode(decoder, data, table, rowId, key):
+    try:
+        return decoder(data)
+    except Exception as e:
+        raise Problem(kind='unreadable', table=table, id=rowId, keys=[key],
+                      error=str(e))
+
+
+def resolveMedia(items):
+    """Return the segments of items, reading the media they refer to."""
+    segments = []
+    for item in items:
+        if isinstance(item, str):
+            key = item + '.media.gz'
+            item = decode(compression.read_segment,
+                          read('hot', key, 'media', item), 'media', item, key)
+        segments.append(item)
+    return segments
+
+
+def inflate(segments, table, rowId, key):
+    return decode(compression.inflate, segments, table, rowId, key)
+
+
+def loadContent(contentHash):
+    key = contentHash + '.segments'
+    coldKey = contentHash + '.cold'
+    try:
+        data = read('hot', key, 'contents', contentHash)
+    except Problem:
+        try:
+            data = read('cold', coldKey, 'contents', contentHash)
+        except Problem:
+            raise Problem(kind='missing', table='contents', id=contentHash,
+                          keys=[key, coldKey])
+        return decode(compression.archive_decompress, data, 'contents',
+                      contentHash, coldKey)
+    items = decode(compression.unpack_segments, data, 'contents',
+                   contentHash, key)
+    return inflate(resolveMedia(items), 'contents', contentHash, key)
+
+
+def loadLegacy(revId):
+    """Read a revision stored before contents were shared, under one of the
+    keys server.py has used for them."""
+    segmentsKey, gzipKey, plainKey = [revId + suffix for suffix
+                                      in backup.LEGACY_SUFFIXES]
+    if stores['hot'].exists(segmentsKey):
+        items = decode(compression.unpack_segments,
+                       read('hot', segmentsKey, 'revisions', revId),
+                       'revisions', revId, segmentsKey)
+        return inflate(resolveMedia(items), 'revisions', revId,
+                       segmentsKey)
+    if stores['hot'].exists(gzipKey):
+        segment = decode(compression.read_segment,
+                         read('hot', gzipKey, 'revisions', revId),
+                         'revisions', revId, gzipKey)
+        return inflate([segment], 'revisions', revId, gzipKey)
+    try:
+        data = read('hot', plainKey, 'revisions', revId)
+    except Problem:
+        raise Problem(kind='missing', table='revisions', id=revId,
+                      keys=[segmentsKey, gzipKey, plainKey])
+    return xmlDeclRe.sub(b'', data, count=1)
+
+
+def checkRevisions(revisions, contents):
+    problems = []
+    for revId, prevId in revisions:
+        computed = sha1hex((prevId or '').encode('ascii'), contents)
+        if computed != revId:
+            problems.append({'kind': 'revision-hash', 'table': 'revisions',
+                             'id': revId, 'computed': computed})
+    return problems
+
+
+def checkTask(task):
+    """Do one task; return the problems found and the bytes read."""
+    start = bytesRead
+    kind = task[0]
+    try:
+        if kind == 'content':
+            contentHash, revisions = task[1:]
+            contents = loadContent(contentHash)
+            problems = checkRevisions(revisions, contents)
+            computed = sha1hex(contents)
+            if computed != contentHash:
+                problems.append({'kind': 'content-hash', 'table': 'contents',
+                                 'id': contentHash, 'computed': computed})
+        elif kind == 'legacy':
+            revId, prevId = task[1:]
+            problems = checkRevisions([(revId, prevId)], loadLegacy(revId))
+        else:
+            mediaHash = task[1]
+            key = mediaHash + '.media.gz'
+            segment = decode(compression.read_segment,
+                             read('hot', key, 'media', mediaHash),
+                             'media', mediaHash, key)
+            computed = sha1hex(inflate([segment], 'media', mediaHash, key))
+            problems = []
+            if computed != mediaHash:
+                problems.append({'kind': 'media-hash', 'table': 'media',
+                                 'id': mediaHash, 'computed': computed})
+    except Problem as e:
+        problems = [e.fields]
+    return problems, bytesRead - start
+
+
+def danglingReferences(dbs):
+    """Return the number of references checked and a problem for each
+    reference to a row that does not exist."""
+    checked = 0
+    problems = []
+    for table, keyColumn, column, target, targetColumn in REFERENCES:
+        existing = dbs.column('SELECT {0} FROM {1}'.format(targetColumn,
+                                                           target))
+        rows = dbs.rows('SELECT {0}, {1} FROM {2} WHERE {1} IS NOT NULL'
+                        .format(keyColumn, column, table))
+        checked += len(rows)
+        for rowId, value in rows:
+            if value in existing:
+                continue
+            stillRefers = dbs.column(
+                'SELECT 1 FROM {0} WHERE {1} = ? AND {2} = ?'.format(
+                    table, keyColumn, column), (rowId, value))
+            exists = dbs.column('SELECT 1 FROM {0} WHERE {1} = ?'.format(
+                target, targetColumn), (value,))
+            if stillRefers and not exists:
+                problems.append({'kind': 'dangling', 'table': table,
+                                 'id': rowId, 'column': column,
+                                 'refersTo': value})
+    return checked, problems
+
+
+def blobOwners(dbs):
+    """Return a function giving whether a key belongs to a row."""
+    hot = dbs.column('SELECT contentHash FROM contents WHERE NOT cold')
+    cold = dbs.column('SELECT contentHash FROM contents WHERE cold')
+    legacy = dbs.column('SELECT revId FROM revisions '
+                        'WHERE contentHash IS NULL')
+    media = dbs.column('SELECT mediaHash FROM media')
+    uploads = dbs.column('SELECT uploadId FROM uploads')
+    suffixes = [('.segments', hot | legacy), ('.cold', cold),
+                ('.media.gz', media), ('.upload', uploads)]
+    suffixes.extend((suffix, legacy) for suffix in backup.LEGACY_SUFFIXES
+                    if suffix != '.segments')
+
+    def owned(key):
+        for suffix, ids in suffixes:
+            if key.endswith(suffix):
+                return key[:-len(suffix)] in ids
+        return False
+    return owned
+
+
+def orphanBlobs(dbs, names):
+    """Return the number of blobs in the stores named checked and a problem
+    for each blob that belongs to no row."""
+    # Listed before the rows are read, so that a blob written along with
+    # its row is not taken for an orphan.
+    listed = [(name, key) for name in names for key in stores[name].keys()]
+    owned = blobOwners(dbs)
+    candidates = [(name, key) for name, key in listed if not owned(key)]
+    if candidates:
+        owned = blobOwners(dbs)
+    return len(listed), [{'kind': 'orphan', 'store': name, 'key': key}
+                         for name, key in candidates
+                         if stores[name].exists(key) and not owned(key)]
+
+
+def readCheckpoint(path, databases):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        checkpoint = json.load(f)
+    if checkpoint.get('databases') != databases:
+        return None
+    return checkpoint
+
+
+def writeJSON(path, data):
+    tmpName = path + '.tmp'
+    with open(tmpName, 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.rename(tmpName, path)
+
+
+def scrub(databases, storageUrl=STORAGE_URL,
+          coldStorageUrl=COLD_STORAGE_URL, workers=None, rate=0,
+          report=REPORT, checkpointPath=CHECKPOINT, restart=False,
+          out=sys.stdout):
+    """Scrub and write the report; return the problems found."""
+    workers = workers or multiprocessing.cpu_count()
+    dbs = Databases(databases)
+    state = None if restart else readCheckpoint(checkpointPath, databases)
+    if state is None:
+        state = {'databases': databases, 'done': None, 'problems': [],
+                 'bytesRead': 0, 'tasks': 0,
+                 'started': datetime.datetime.utcnow().strftime(TIME_FORMAT)}
+    else:
+        print('Resuming after {0} {1}'.format(*state['done']), file=out)
+    initWorker(storageUrl, coldStorageUrl, rate)
+    done = tuple(state['done']) if state['done'] else None
+    tasks = [task for task in allTasks(dbs)
+             if done is None or taskOrder(task) > done]
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.Pool(
+            workers, initWorker,
+            (storageUrl, coldStorageUrl, float(rate) / workers))
+        results = pool.imap(checkTask, tasks, 4)
+    else:
+        results = (checkTask(task) for task in tasks)
+    try:
+        for count, task in enumerate(tasks, 1):
+            problems, size = next(results)
+            state['bytesRead'] += size
+            if problems:
+                current = refreshTask(dbs, task)
+                problems = checkTask(current)[0] if current else []
+                # A missing media blob is found by every content using it.
+                state['problems'].extend(problem for problem in problems
+                                         if problem not in state['problems'])
+            state['done'] = list(taskOrder(task))
+            state['tasks'] += 1
+            if count % CHECKPOINT_EVERY == 0:
+                writeJSON(checkpointPath, state)
+        if pool is not None:
+            pool.close()
+            pool.join()
+    except BaseException:
+        if pool is not None:
+            pool.terminate()
+        writeJSON(checkpointPath, state)
+        raise
+    references, problems = danglingReferences(dbs)
+    names = ['hot'] if coldStorageUrl == storageUrl else ['hot', 'cold']
+    blobs, orphans = orphanBlobs(dbs, names)
+    problems = state['problems'] + problems + orphans
+    writeJSON(report, {
+        'databases': databases,
+        'storage': storageUrl,
+        'coldStorage': coldStorageUrl,
+        'started': state['started'],
+        'finished': datetime.datetime.utcnow().strftime(TIME_FORMAT),
+        'checked': {'tasks': state['tasks'], 'references': references,
+                    'blobs': blobs},
+        'bytesRead': state['bytesRead'],
+        'kinds': PROBLEMS,
+        'problems': problems})
+    if os.path.exists(checkpointPath):
+        os.remove(checkpointPath)
+    print('Checked {0} contents, revisions and media, {1} references and '
+          '{2} blobs: {3} problems; see {4}'.format(
+              state['tasks'], references, blobs, len(problems),
+              report), file=out)
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--database', action='append',
+                        help='a database to scrub; give it once for each '
+                             'shard (default {0})'.format(DATABASE))
+    parser.add_argument('--storage', default=STORAGE_URL)
+    parser.add_argument('--cold-storage', default=COLD_STORAGE_URL)
+    parser.add_argument('--workers', type=int, default=None,
+                        help='worker processes (default one per CPU)')
+    parser.add_argument('--rate', type=int, default=0,
+                        help='bytes a second to read; 0 for no limit')
+    parser.add_argument('--report', default=REPORT)
+    parser.add_argument('--checkpoint', default=CHECKPOINT)
+    parser.add_argument('--restart', action='store_true',
+                        help='ignore the checkpoint of an unfinished scrub')
+    args = parser.parse_args(argv)
+    problems = scrub(args.database or [DATABASE], args.storage,
+                     args.cold_storage, args.workers, args.rate,
+                     args.report, args.checkpoint, args.restart)
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
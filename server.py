@@ -19,10 +19,27 @@ except ImportError:
 import sqlalchemy
 import sqlalchemy.engine as sqlengine
 import sqlalchemy.ext.declarative
-from sqlalchemy.orm import relationship, sessionmaker, join
+import sqlalchemy.event
+from sqlalchemy.orm import relationship, sessionmaker, join, subqueryload
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import attributes
+from sqlalchemy.orm.query import _MapperEntity
+from sqlalchemy.ext.horizontal_shard import ShardedSession, ShardedQuery
 from sqlalchemy import Column, ForeignKey, Integer, String, Table, Boolean
+from sqlalchemy import Index, and_, or_
 import falcon
 
+import blobstore
+import compression
+import lru
+import projectxml
+import pubsub
+import sharding
+import singleflight
+import snapdiff
+import tracing
+import versioncache
+import zipstream
 import base64
 import xml.etree.ElementTree as etree
 import xml.dom.minidom as mdom
@@ -39,12 +56,26 @@ import string
 from contextlib import contextmanager
 import urllib
 import wsgiref.util
+import io
+import json
+import threading
+import atexit
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 
 @contextmanager
-def session_scope():
-    """Provide a transactional scope around a series of operations."""
+def session_scope(shard=None):
+    """Provide a transactional scope around a series of operations, on
+    a single shard if shard is given."""
     session = Session()
+    if shard is not None:
+        session.info['shard'] = shard
+        session.info['pinned'] = True
     try:
         yield session
         session.commit()
@@ -52,11 +83,129 @@ def session_scope():
         session.rollback()
         raise
     finally:
+        callbacks = session.info.pop('afterCommit', [])
         session.close()
+    for callback in callbacks:
+        callback()
+
+
+def afterCommit(session, callback):
+    """Run callback once the session's transaction has committed."""
+    session.info.setdefault('afterCommit', []).append(callback)
+
+
+def publishAfterCommit(session, topic, data):
+    afterCommit(session, lambda: bus.publish(topic, data))
+
+
+def bumpAfterCommit(session, *keys):
+    """Invalidate the cached responses built from the data named by keys
+    once the session's transaction has committed; see respondCached."""
+    afterCommit(session, lambda: responseCache.bump(*keys))
+
+
+def publishRoster(session, course, user, role, action):
+    publishAfterCommit(session, 'course:' + course.courseId,
+                       {'type': 'roster', 'courseId': course.courseId,
+                        'userName': user.userName, 'role': role,
+                        'action': action})
+    bumpAfterCommit(session, ('roster', course.courseId),
+                    ('courses', user.userName))
 
 
 HASH_ID_LEN = 40
 STORAGE_DIR = 'storage'
+# Where revisions and media are kept: a directory, sqlite:///<path> or
+# s3://<bucket>/<prefix>; see blobstore.from_url. Partial uploads are always
+# kept in STORAGE_DIR.
+STORAGE_URL = os.environ.get('SNAP_STORAGE_URL', STORAGE_DIR)
+COLD_STORAGE_URL = os.environ.get('SNAP_COLD_STORAGE_URL',
+                                  os.path.join(STORAGE_DIR, 'cold'))
+COMPRESS_MIN_SIZE = 1024
+MEDIA_MIN_SIZE = 4096
+DIFF_CACHE_SIZE = 1024
+# Bytes of compressed revision contents kept in memory for getRevision.
+REVISION_CACHE_SIZE = 64 * 1024 * 1024
+# Bytes of list responses kept in memory; see respondCached.
+RESPONSE_CACHE_SIZE = 16 * 1024 * 1024
+# Seconds a request waits for another request's identical revision read
+# before reading the revision itself.
+READ_WAIT_TIMEOUT = 10
+GALLERY_PAGE_SIZE = 50
+CURSOR_TIME_FORMAT = '%Y%m%d%H%M%S%f'
+SEARCH_LIMIT = 50
+# Seconds to buffer saves sent with autosave=1 before committing them; 0
+# turns coalescing off.
+AUTOSAVE_WINDOW = 0
+# Writes queued within GROUP_COMMIT_MAX_WAIT seconds of each other share a
+# transaction, up to GROUP_COMMIT_MAX_BATCH of them; a batch size of 1
+# commits every write on its own.
+GROUP_COMMIT_MAX_BATCH = 64
+GROUP_COMMIT_MAX_WAIT = 0.005
+UPLOAD_TIMEOUT = datetime.timedelta(hours=24)
+# Seconds between sweeps for expired uploads; 0 turns them off.
+EXPIRE_UPLOADS_INTERVAL = 3600
+# Revisions that are not a project's head or a submission move to cold
+# storage COLD_AFTER they were saved. Reading one copies it back to hot
+# storage if PROMOTE_COLD_READS is set.
+COLD_AFTER = datetime.timedelta(days=30)
+PROMOTE_COLD_READS = False
+# Older revisions of a project are thinned out: each (age, interval) keeps
+# one revision per interval among those younger than age, with None
+# meaning every revision, or no age limit.
+RETENTION = [
+    (datetime.timedelta(days=1), None),
+    (datetime.timedelta(weeks=1), datetime.timedelta(hours=1)),
+    (datetime.timedelta(days=30), datetime.timedelta(days=1)),
+    (None, datetime.timedelta(weeks=1)),
+]
+# Seconds between runs of the thinning and tiering job; 0 turns it off.
+TIERING_INTERVAL = 0
+TIERING_BATCH_SIZE = 100
+# Limits in bytes on the revisions saved to each user's projects, to each
+# project, and on the revisions submitted to each course; 0 means none.
+USER_QUOTA = 0
+PROJECT_QUOTA = 0
+COURSE_QUOTA = 0
+# Users who may list storage usage and cache statistics, from SNAP_ADMINS
+# (comma separated).
+ADMINS = set(name for name in os.environ.get('SNAP_ADMINS', '').split(',')
+             if name)
+USAGE_LIST_SIZE = 20
+# Seconds between recounts of the usage counters; 0 turns them off.
+RECONCILE_INTERVAL = 0
+# /watch waits up to WATCH_TIMEOUT seconds for an event, or streams events
+# for up to WATCH_MAX_DURATION seconds to clients that accept
+# text/event-stream, sending a heartbeat every WATCH_HEARTBEAT seconds.
+# Each open watch holds a worker for that long: a greenlet under gevent, a
+# whole thread otherwise. WATCH_MAX_OPEN caps how many a process holds
+# open at once, and WATCH_MAX_PER_USER how many of them one user does.
+WATCH_TIMEOUT = 30
+WATCH_HEARTBEAT = 15
+WATCH_MAX_DURATION = 600
+WATCH_MAX_OPEN = 1000
+WATCH_MAX_PER_USER = 4
+WATCH_MAX_TOPICS = 100
+
+# When SNAP_SHARDS lists database URLs (comma separated), tenant data is
+# split across them and SNAP_DIRECTORY records which shard each user,
+# project, course, assignment and upload is in; see sharding.py. Shards
+# are numbered by their position in the list, so only ever append to it.
+SHARDS = [url for url in os.environ.get('SNAP_SHARDS', '').split(',')
+          if url]
+DIRECTORY_URL = os.environ.get('SNAP_DIRECTORY',
+                               'sqlite:///directory.sqlite')
+
+# A fraction TRACE_SAMPLE_RATE of requests is traced to TRACE_FILE; see
+# tracing.py for the format and for summarizing it.
+TRACE_FILE = os.environ.get('SNAP_TRACE_FILE', 'traces.jsonl')
+TRACE_SAMPLE_RATE = float(os.environ.get('SNAP_TRACE_SAMPLE_RATE', 0))
+
+blobs = blobstore.from_url(STORAGE_URL, fileProxy)
+coldBlobs = blobstore.from_url(COLD_STORAGE_URL, fileProxy)
+tracer = tracing.Tracer(TRACE_FILE, TRACE_SAMPLE_RATE)
+# Changes that /watch requests are told about, published once committed.
+bus = pubsub.Bus()
 
 Base = sqlalchemy.ext.declarative.declarative_base()
 
@@ -127,15 +276,29 @@ class User(Base):
     coursesTeaching = relationship('Course', secondary=course_teachers)
     coursesTaking = relationship('Course', secondary=course_students)
 
+    # With shards, the same user can be loaded both from the home shard and
+    # as a stub from another one, as two objects; see STUB_COLUMNS.
+    def __eq__(self, other):
+        return isinstance(other, User) and other.userName == self.userName
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.userName)
+
+    def toData(self):
+        return {'userName': self.userName}
+
     def toXMLName(self):
-        return Elt('user', {'userName': self.userName})
+        return Elt('user', self.toData())
 
     @staticmethod
     def fromRequest(session, req):
         userName = forceParam(req, 'userName')
-        user = session.query(User) \
-                      .filter(User.userName == userName) \
-                      .first()
+        user = routedQuery(session, User, 'user', userName) \
+            .filter(User.userName == userName) \
+            .first()
         if user is None:
             raise NoSuchUser()
         return user
@@ -147,22 +310,112 @@ class Revision(Base):
     revId = Column(String(HASH_ID_LEN), primary_key=True)
     prevId = Column(String(HASH_ID_LEN),
                     ForeignKey('revisions.revId'))
-    prev = relationship('Revision')
+    prev = relationship('Revision', remote_side=[revId],
+                        foreign_keys=[prevId])
+    contentHash = Column(String(HASH_ID_LEN),
+                         ForeignKey('contents.contentHash'))
+    content = relationship('Content')
+    # The nearest older revision that is still stored, once the one named
+    # by prevId has been thinned out.
+    ancestorId = Column(String(HASH_ID_LEN))
+    ancestor = relationship('Revision', remote_side=[revId],
+                            primaryjoin='Revision.ancestorId == '
+                                        'Revision.revId',
+                            foreign_keys=[ancestorId])
+    created = Column(sqlalchemy.DateTime)
+    # The project whose save created this revision, which pays for it.
+    projectId = Column(String(HASH_ID_LEN), index=True)
+    byteSize = Column(Integer)
+    spriteCount = Column(Integer)
+    mediaSize = Column(Integer)
+
+    def setDocument(self, document):
+        self.byteSize = document.byteSize
+        self.spriteCount = document.spriteCount
+        self.mediaSize = document.mediaSize
+
+    def sizeData(self):
+        if self.byteSize is None:
+            return None
+        return {'bytes': self.byteSize,
+                'sprites': self.spriteCount,
+                'media': self.mediaSize}
 
-    def filename(self):
-        return os.path.join(STORAGE_DIR, self.revId + '.revision')
+    @staticmethod
+    def legacyKeysFor(revId):
+        return [revId + ext for ext in ('.segments', '.revision.gz',
+                                        '.revision')]
+
+    def save(self, session, contents):
+        self.addContent(session, StagedContents(contents))
+
+    def addContent(self, session, staged):
+        """Reference the content of staged, adding its rows if they are
+        missing and writing the blobs staged.write did not."""
+        content, created = insertOrGet(session, Content,
+                                       contentHash=staged.contentHash,
+                                       size=staged.size, refCount=1)
+        if created:
+            content.addMedia(session, staged)
+            if not staged.wrote(Content, staged.contentHash):
+                staged.putContent()
+        else:
+            addRefs(session, content, 1)
+        self.content = content
+
+    @staticmethod
+    def loadItemsFor(revId, contentHash):
+        if contentHash is not None:
+            return Content.loadItems(contentHash)
+        segmentsKey, gzipKey, plainKey = Revision.legacyKeysFor(revId)
+        try:
+            return compression.unpack_segments(blobs.get(segmentsKey))
+        except blobstore.BlobNotFound:
+            pass
+        try:
+            gz = blobs.get(gzipKey)
+        except blobstore.BlobNotFound:
+            contents = stripXMLDecl(blobs.get(plainKey))
+            return [compression.compress_segment(contents)]
+        return [compression.read_segment(gz)]
+
+    @staticmethod
+    def loadSegmentsFor(revId, contentHash):
+        with tracer.span('storage.read', revId=revId):
+            return resolveMedia(Revision.loadItemsFor(revId, contentHash))
 
-    def save(self, contents):
-        f = fileProxy(open(self.filename(), 'w'))
-        f.write(contents)
+    def loadItems(self):
+        return Revision.loadItemsFor(self.revId, self.contentHash)
+
+    def loadSegments(self):
+        return Revision.loadSegmentsFor(self.revId, self.contentHash)
+
+    def prefetch(self):
+        """Start loading the segments in the background."""
+        return blobstore.spawn(Revision.loadSegmentsFor, self.revId,
+                               self.contentHash)
 
     def load(self):
-        f = fileProxy(open(self.filename()))
-        return f.read()
+        return compression.inflate(self.loadSegments())
+
+    def discard(self, session):
+        """Delete this revision, releasing the content it references."""
+        if self.projectId is not None:
+            project = session.query(Project).get(self.projectId)
+            if project is not None:
+                chargeRevision(session, project, self, -1)
+        if self.content is not None:
+            if addRefs(session, self.content, -1) <= 0:
+                self.content.discard(session)
+        else:
+            releaseMedia(session, self.loadItems())
+            for key in Revision.legacyKeysFor(self.revId):
+                afterCommit(session, lambda key=key: blobs.delete(key))
+        session.delete(self)
 
     @staticmethod
-    def fromRequest(session, req):
-        revId = forceParam(req, 'revId')
+    def fromRequest(session, req, paramName='revId'):
+        revId = forceParam(req, paramName)
         rev = session.query(Revision) \
                      .filter(Revision.revId == revId) \
                      .first()
@@ -170,13 +423,333 @@ class Revision(Base):
             raise NoSuchRevision()
         return rev
 
-    def toXML(self):
-        el = Elt('revision', {'revId': self.revId})
-        el.appendChild(Elt('prevId', text=self.prevId))
-        data = Elt('data')
-        data.append(mdom.parseString(self.load()).firstChild)
-        el.appendChild(data)
-        return el
+    def toXMLStub(self):
+        """Return the revision's XML with an empty data element."""
+        return Elt('revision', {'revId': self.revId}, children=[
+            Elt('prevId', text=self.prevId),
+            Elt('data')])
+
+    def envelope(self):
+        """Return the XML before and after the revision's data."""
+        return splitAtData(Elt('success').append(self.toXMLStub()))
+
+
+def splitAtData(el):
+    """Return the XML of el before and after its one empty data element."""
+    prefix, suffix = el.toxml().split('<data/>')
+    return ((prefix + '<data>').encode('utf-8'),
+            ('</data>' + suffix).encode('utf-8'))
+
+
+class Content(Base):
+    __tablename__ = 'contents'
+
+    contentHash = Column(String(HASH_ID_LEN), primary_key=True)
+    size = Column(Integer)
+    refCount = Column(Integer, default=0)
+    cold = Column(Boolean, default=False)
+
+    @staticmethod
+    def keyFor(contentHash):
+        return contentHash + '.segments'
+
+    @staticmethod
+    def coldKeyFor(contentHash):
+        return contentHash + '.cold'
+
+    def key(self):
+        return Content.keyFor(self.contentHash)
+
+    def save(self, session, contents):
+        staged = StagedContents(contents)
+        self.addMedia(session, staged)
+        staged.putContent()
+
+    def addMedia(self, session, staged):
+        for mediaHash, data in staged.media.items():
+            media, created = insertOrGet(session, Media, mediaHash=mediaHash,
+                                         size=len(data), refCount=1)
+            if not created:
+                addRefs(session, media, 1)
+            elif not staged.wrote(Media, mediaHash):
+                media.save(data)
+
+    @staticmethod
+    def loadItems(contentHash):
+        try:
+            return compression.unpack_segments(
+                blobs.get(Content.keyFor(contentHash)))
+        except blobstore.BlobNotFound:
+            contents = Content.loadCold(contentHash)
+        if PROMOTE_COLD_READS:
+            promoteContent(contentHash)
+        return [compression.compress_segment(contents)]
+
+    @staticmethod
+    def loadCold(contentHash):
+        return compression.archive_decompress(
+            coldBlobs.get(Content.coldKeyFor(contentHash)))
+
+    def freeze(self, session):
+        """Move this content from hot to cold storage."""
+        items = Content.loadItems(self.contentHash)
+        contents = compression.inflate(resolveMedia(items))
+        coldBlobs.put(Content.coldKeyFor(self.contentHash),
+                      compression.archive_compress(contents))
+        self.cold = True
+        releaseMedia(session, items)
+        afterCommit(session, lambda key=self.key(): blobs.delete(key))
+
+    def thaw(self, session):
+        """Move this content from cold storage back to hot storage."""
+        self.save(session, Content.loadCold(self.contentHash))
+        self.cold = False
+        coldKey = Content.coldKeyFor(self.contentHash)
+        if not usedElsewhere(session, self,
+                             Content.contentHash == self.contentHash,
+                             Content.cold == sqlalchemy.true()):
+            afterCommit(session, lambda: coldBlobs.delete(coldKey))
+
+    def discard(self, session):
+        keep = usedElsewhere(session, self,
+                             Content.contentHash == self.contentHash)
+        if self.cold:
+            if not keep:
+                coldKey = Content.coldKeyFor(self.contentHash)
+                afterCommit(session, lambda: coldBlobs.delete(coldKey))
+        else:
+            releaseMedia(session, Content.loadItems(self.contentHash))
+            if not keep:
+                discardBlob(session, self)
+        session.delete(self)
+
+
+class Media(Base):
+    __tablename__ = 'media'
+
+    mediaHash = Column(String(HASH_ID_LEN), primary_key=True)
+    size = Column(Integer)
+    refCount = Column(Integer, default=0)
+
+    @staticmethod
+    def keyFor(mediaHash):
+        return mediaHash + '.media.gz'
+
+    def key(self):
+        return Media.keyFor(self.mediaHash)
+
+    @staticmethod
+    def encode(data):
+        return compression.gzip_file_contents(
+            compression.compress_segment(data))
+
+    def save(self, data):
+        if not blobs.exists(self.key()):
+            blobs.put(self.key(), Media.encode(data))
+
+    @staticmethod
+    def loadSegments(mediaHashes):
+        """Return a dict mapping each of mediaHashes to its segment."""
+        mediaHashes = set(mediaHashes)
+        if not mediaHashes:
+            return {}
+        with tracer.span('storage.media', count=len(mediaHashes)):
+            found = blobs.get_many(Media.keyFor(mediaHash)
+                                   for mediaHash in mediaHashes)
+        return dict((mediaHash,
+                     compression.read_segment(found[Media.keyFor(mediaHash)]))
+                    for mediaHash in mediaHashes)
+
+    def discard(self, session):
+        discardBlob(session, self)
+
+
+class StagedContents(object):
+    """Saved contents split into segments and media, ready to be stored.
+
+    A group commit writes the blobs with write before its unit is queued,
+    so that the unit, which holds the write lock, only adds rows. Blobs
+    that were not written ahead are written when their rows are added.
+    """
+
+    def __init__(self, contents):
+        contents = stripXMLDecl(contents)
+        self.contentHash = sha1hex(contents)
+        self.size = len(contents)
+        self.pieces = []
+        self.media = {}
+        self.written = set()
+        self.shard = None
+        for isMedia, data in splitMedia(contents):
+            if isMedia:
+                mediaHash = sha1hex(data)
+                self.media[mediaHash] = data
+                data = mediaHash
+            self.pieces.append((isMedia, data))
+
+    def wrote(self, model, blobHash):
+        """Whether write stored the blob of model's row blobHash and it is
+        still there; a failed save of the same contents may have deleted
+        it since."""
+        return (model, blobHash) in self.written and \
+            blobs.exists(model.keyFor(blobHash))
+
+    def putContent(self):
+        items = [data if isMedia else compression.compress_segment(data)
+                 for isMedia, data in self.pieces]
+        with tracer.span('storage.write', contentHash=self.contentHash):
+            blobs.put(Content.keyFor(self.contentHash),
+                      compression.pack_segments(items))
+
+    def write(self, session):
+        """Write the blobs of contents that session has no row for yet."""
+        if SHARDS:
+            self.shard = session.current()
+        if localQuery(session, Content) \
+                .filter(Content.contentHash == self.contentHash) \
+                .first() is not None:
+            return
+        known = set()
+        if self.media:
+            known = set(media.mediaHash for media in
+                        localQuery(session, Media)
+                        .filter(Media.mediaHash.in_(list(self.media))))
+        for mediaHash, data in self.media.items():
+            key = Media.keyFor(mediaHash)
+            if mediaHash not in known and not blobs.exists(key):
+                blobs.put(key, Media.encode(data))
+                self.written.add((Media, mediaHash))
+        self.putContent()
+        self.written.add((Content, self.contentHash))
+
+    def discard(self):
+        """Delete the blobs write stored that no row names, as when the
+        transaction that was to add the rows rolled back."""
+        deleteUnused([(self.shard, model, blobHash)
+                      for model, blobHash in self.written])
+
+
+def discardBlob(session, instance):
+    """Delete the hot blob of instance, a Content or Media row, once
+    session has committed, unless a row names it again by then."""
+    pending = session.info.get('unusedBlobs')
+    if pending is None:
+        pending = session.info['unusedBlobs'] = []
+        afterCommit(session, lambda: deleteUnused(pending))
+    model = type(instance)
+    key = model.__mapper__.primary_key[0]
+    pending.append((getattr(instance, '_shard', None), model,
+                    getattr(instance, key.key)))
+
+
+def deleteUnused(blobHashes):
+    """Delete the hot blobs of the (shard, model, blobHash) triples that
+    no row of model names. The rows are checked and the blobs deleted
+    under the shard's write lock, so that a save adding a row meanwhile
+    either commits first, keeping the blob, or finds it gone and writes
+    it again."""
+    byShard = {}
+    for shard, model, blobHash in blobHashes:
+        byShard.setdefault(shard, []).append((model, blobHash))
+    for shard, unused in byShard.items():
+        with write_scope(shard) as session:
+            for model, blobHash in unused:
+                key = model.__mapper__.primary_key[0]
+                if session.query(model).filter(key == blobHash) \
+                        .first() is None:
+                    blobs.delete(model.keyFor(blobHash))
+
+
+def resolveMedia(items):
+    """Replace the media references among items with their segments."""
+    media = Media.loadSegments(item for item in items
+                               if isinstance(item, str))
+    return [media[item] if isinstance(item, str) else item
+            for item in items]
+
+
+promoting = set()
+
+
+def promoteContent(contentHash):
+    """Copy cold content back to hot storage in the background."""
+    if contentHash in promoting:
+        return
+    promoting.add(contentHash)
+
+    def promote():
+        try:
+            for shard in shardIds():
+                with session_scope(shard) as session:
+                    content = session.query(Content) \
+                        .filter(Content.contentHash == contentHash) \
+                        .first()
+                    if content is not None and content.cold:
+                        content.thaw(session)
+        finally:
+            promoting.discard(contentHash)
+    blobstore.spawn(promote)
+
+
+def releaseMedia(session, items):
+    refs = set(item for item in items if isinstance(item, str))
+    if not refs:
+        return
+    released = localQuery(session, Media).filter(Media.mediaHash.in_(refs))
+    released.update({Media.refCount: Media.refCount - 1},
+                    synchronize_session=False)
+    for media in released.filter(Media.refCount <= 0):
+        if not usedElsewhere(session, media,
+                             Media.mediaHash == media.mediaHash):
+            media.discard(session)
+        session.delete(media)
+
+
+def addRefs(session, instance, delta):
+    """Add delta to the refCount of instance's row in one UPDATE, so that
+    writers counting the same row at once can't lose a count; return the
+    new count."""
+    model = type(instance)
+    key = model.__mapper__.primary_key[0]
+    query = onShard(session.query(model), getattr(instance, '_shard', None)) \
+        .filter(key == getattr(instance, key.key))
+    query.update({model.refCount: model.refCount + delta},
+                 synchronize_session=False)
+    count = query.with_entities(model.refCount).scalar()
+    attributes.set_committed_value(instance, 'refCount', count)
+    return count
+
+
+def removeFile(name):
+    try:
+        os.remove(name)
+    except OSError:
+        pass
+
+
+xmlDeclRe = re.compile(br'^\s*<\?xml[^>]*\?>\s*')
+dataURLRe = re.compile(br'data:[\w/+.-]*(?:;[\w.=-]+)*;base64,'
+                       br'[A-Za-z0-9+/]*=*')
+
+
+def stripXMLDecl(contents):
+    return xmlDeclRe.sub(b'', contents, count=1)
+
+
+def splitMedia(contents):
+    """Split contents into (isMedia, data) pieces around embedded media."""
+    pieces = []
+    pos = 0
+    for match in dataURLRe.finditer(contents):
+        if match.end() - match.start() < MEDIA_MIN_SIZE:
+            continue
+        if match.start() > pos:
+            pieces.append((False, contents[pos:match.start()]))
+        pieces.append((True, match.group()))
+        pos = match.end()
+    if pos < len(contents) or not pieces:
+        pieces.append((False, contents[pos:]))
+    return pieces
 
 
 class Elt(mdom.Element):
@@ -199,7 +772,8 @@ class Elt(mdom.Element):
 
 
 def formatXML(elt):
-    return elt.toprettyxml()
+    with tracer.span('serialize.xml'):
+        return elt.toprettyxml()
 
 
 class Project(Base):
@@ -217,25 +791,62 @@ class Project(Base):
                                                secondary=student_shares)
     head = relationship('Revision')
     public = Column(Boolean)
+    updated = Column(sqlalchemy.DateTime)
+
+    __table_args__ = (
+        Index('ix_projects_public_updated', 'public', 'updated', 'projId'),
+    )
 
     def getURI(self, req):
-        env = dict(req.env)
-        env['PATH_INFO'] = '/GetRevision'
-        env['QUERY_STRING'] = urllib.urlencode({'revId': self.headId})
-        return wsgiref.util.request_uri(env)
+        return revisionURI(req, self.headId)
+
+    def touch(self):
+        self.updated = datetime.datetime.utcnow()
+
+    def toData(self, req):
+        data = {'projId': self.projId,
+                'owners': [owner.toData() for owner in self.owners],
+                'members': [mem.toData() for mem in self.members]}
+        pending = autosaves.get(self.projId)
+        head = pending.revision() if pending is not None else self.head
+        if pending is not None:
+            data['URI'] = revisionURI(req, pending.revId)
+        elif self.head is not None:
+            data['URI'] = self.getURI(req)
+        if head is not None and head.sizeData() is not None:
+            data['size'] = head.sizeData()
+        sharedName = self.sharedName
+        if pending is not None and pending.sharedName is not None:
+            sharedName = pending.sharedName
+        if sharedName is not None:
+            data['sharedName'] = sharedName
+        return data
 
     def toXML(self, req):
-        proj = Elt('project')
-        proj.appendChild(Elt('projId', text=self.projId))
-        for owner in self.owners:
-            proj.appendChild(Elt('owner').append(owner.toXMLName()))
-        for mem in self.members:
-            proj.appendChild(Elt('member').append(mem.toXMLName()))
-        if self.head is not None:
-            proj.appendChild(Elt('URI', text=self.getURI(req)))
-        if self.sharedName is not None:
-            proj.appendChild(Elt('sharedName', text=self.sharedName))
-        return proj
+        return projectXML(self.toData(req))
+
+    def hasRevision(self, session, revision):
+        """Whether revision is in this project's history, found with one
+        recursive query over the previous and ancestor links."""
+        revisions = Revision.__table__
+        history = sqlalchemy.select([revisions.c.revId, revisions.c.prevId,
+                                     revisions.c.ancestorId]) \
+                            .where(revisions.c.revId == self.headId) \
+                            .cte('history', recursive=True)
+        older = revisions.alias('older')
+        history = history.union(
+            sqlalchemy.select([older.c.revId, older.c.prevId,
+                               older.c.ancestorId])
+            .where(sqlalchemy.or_(older.c.revId == history.c.prevId,
+                                  older.c.revId == history.c.ancestorId)))
+        # A count always returns a row; Python 2's sqlite3 loses track of
+        # the columns of a WITH statement that returns none.
+        found = onShard(session.query(sqlalchemy.func.count()),
+                        getattr(self, '_shard', None)) \
+            .select_from(history) \
+            .filter(history.c.revId == revision.revId) \
+            .scalar()
+        return found > 0
 
     def canRead(self, user):
         if user in self.members:
@@ -252,14 +863,300 @@ class Project(Base):
     @staticmethod
     def fromRequest(session, req):
         projId = forceParam(req, 'projId')
-        proj = session.query(Project) \
-                      .filter(Project.projId == projId) \
-                      .first()
+        proj = routedQuery(session, Project, 'project', projId) \
+            .filter(Project.projId == projId) \
+            .first()
         if proj is None:
             raise NoSuchProject()
         return proj
 
 
+def listingQuery(session):
+    """Query projects with everything Project.toData reads loaded up
+    front, so that listing many takes no more queries than listing one."""
+    return session.query(Project) \
+                  .options(subqueryload(Project.owners),
+                           subqueryload(Project.members),
+                           joinedload(Project.head))
+
+
+def projectXML(data):
+    proj = Elt('project')
+    proj.appendChild(Elt('projId', text=data['projId']))
+    for owner in data['owners']:
+        proj.appendChild(Elt('owner').append(Elt('user', owner)))
+    for mem in data['members']:
+        proj.appendChild(Elt('member').append(Elt('user', mem)))
+    if 'URI' in data:
+        proj.appendChild(Elt('URI', text=data['URI']))
+    if 'size' in data:
+        proj.appendChild(Elt('size', stringValues(data['size'])))
+    if 'sharedName' in data:
+        proj.appendChild(Elt('sharedName', text=data['sharedName']))
+    return proj
+
+
+def revisionURI(req, revId):
+    env = dict(req.env)
+    env['PATH_INFO'] = '/GetRevision'
+    env['QUERY_STRING'] = urllib.urlencode({'revId': revId})
+    return wsgiref.util.request_uri(env)
+
+
+class GalleryCache(object):
+    """The first page of public projects, dropped whenever it may change."""
+
+    def __init__(self):
+        self.generation = 0
+        self.page = None
+
+    def invalidate(self):
+        self.generation += 1
+        self.page = None
+
+
+galleryCache = GalleryCache()
+
+
+def invalidateGallery(session, project):
+    if project.public:
+        afterCommit(session, galleryCache.invalidate)
+
+
+def publicProjectsPage(session, cursor=None):
+    query = session.query(Project) \
+                   .options(subqueryload(Project.owners),
+                            joinedload(Project.head)) \
+                   .filter(Project.public == sqlalchemy.true())
+    if cursor is not None:
+        try:
+            updated = datetime.datetime.strptime(cursor[:20],
+                                                 CURSOR_TIME_FORMAT)
+        except ValueError:
+            raise UserLogicError('Invalid cursor.')
+        projId = cursor[20:]
+        query = query.filter(or_(Project.updated < updated,
+                                 and_(Project.updated == updated,
+                                      Project.projId < projId)))
+    projects = query.order_by(Project.updated.desc(), Project.projId.desc()) \
+                    .limit(GALLERY_PAGE_SIZE + 1) \
+                    .all()
+    if SHARDS:
+        # Each shard sent its own first page.
+        projects.sort(key=lambda proj: (proj.updated is not None,
+                                        proj.updated, proj.projId),
+                      reverse=True)
+        projects = projects[:GALLERY_PAGE_SIZE + 1]
+    nextCursor = None
+    if len(projects) > GALLERY_PAGE_SIZE:
+        projects = projects[:GALLERY_PAGE_SIZE]
+        last = projects[-1]
+        if last.updated is not None:
+            nextCursor = (last.updated.strftime(CURSOR_TIME_FORMAT) +
+                          last.projId)
+    entries = [(proj.projId, proj.headId, proj.sharedName, proj.updated,
+                [owner.userName for owner in proj.owners],
+                proj.head and proj.head.sizeData())
+               for proj in projects]
+    return entries, nextCursor
+
+
+def publicProjectData(req, entry):
+    projId, headId, sharedName, updated, owners, size = entry
+    data = {'projId': projId, 'sharedName': sharedName,
+            'updated': updated and updated.isoformat(),
+            'owners': [{'userName': owner} for owner in owners]}
+    if headId is not None:
+        data['URI'] = revisionURI(req, headId)
+    if size is not None:
+        data['size'] = size
+    return data
+
+
+def publicProjectXML(data):
+    proj = Elt('project', {'projId': data['projId'],
+                           'sharedName': data['sharedName'],
+                           'updated': data['updated']})
+    for owner in data['owners']:
+        proj.appendChild(Elt('owner').append(Elt('user', owner)))
+    if 'URI' in data:
+        proj.appendChild(Elt('URI', text=data['URI']))
+    if 'size' in data:
+        proj.appendChild(Elt('size', stringValues(data['size'])))
+    return proj
+
+
+class SearchDoc(Base):
+    __tablename__ = 'search_docs'
+
+    docId = Column(Integer, primary_key=True)
+    projId = Column(String(HASH_ID_LEN), unique=True)
+
+
+blockSpecParamRe = re.compile(r"%'([^']*)'")
+
+
+def projectSearchText(contents):
+    """Return the sprite, variable and custom block names in a project."""
+    words = []
+    try:
+        for event, el in etree.iterparse(io.BytesIO(contents)):
+            if el.tag in ('project', 'stage', 'sprite', 'variable'):
+                if el.get('name'):
+                    words.append(el.get('name'))
+            elif el.tag == 'block-definition':
+                words.append(blockSpecParamRe.sub(r'\1', el.get('s', '')))
+            el.clear()
+    except etree.ParseError:
+        pass
+    return ' '.join(words)
+
+
+def reindexProject(projId):
+    with session_scope(shardOf('project', projId)) as session:
+        # Everything is read before the first write, which takes the
+        # database's write lock until the commit.
+        project = session.query(Project) \
+                         .filter(Project.projId == projId) \
+                         .first()
+        if project is not None:
+            content = ''
+            if project.head is not None:
+                content = projectSearchText(project.head.load())
+            row = {'sharedName': project.sharedName or '',
+                   'owners': ' '.join(owner.userName
+                                      for owner in project.owners),
+                   'content': content}
+        doc = session.query(SearchDoc) \
+                     .filter(SearchDoc.projId == projId) \
+                     .first()
+        if doc is not None:
+            session.execute(
+                sqlalchemy.text('DELETE FROM project_search '
+                                'WHERE rowid = :docId'),
+                {'docId': doc.docId})
+        if project is None:
+            if doc is not None:
+                session.delete(doc)
+            return
+        if doc is None:
+            doc = SearchDoc(projId=projId)
+            session.add(doc)
+            session.flush()
+        row['docId'] = doc.docId
+        session.execute(
+            sqlalchemy.text('INSERT INTO project_search '
+                            '(rowid, sharedName, owners, content) '
+                            'VALUES (:docId, :sharedName, :owners, :content)'),
+            row)
+
+
+class SearchIndexer(object):
+    """Reindexes projects in the background, in the order they changed."""
+
+    def __init__(self):
+        self.pending = queue.Queue()
+        self.queued = set()
+        self.worker = None
+
+    def enqueue(self, projId):
+        if not searchAvailable or projId in self.queued:
+            return
+        self.queued.add(projId)
+        self.pending.put(projId)
+        if self.worker is None:
+            self.worker = threading.Thread(target=self.run)
+            self.worker.daemon = True
+            self.worker.start()
+
+    def run(self):
+        while True:
+            projId = self.pending.get()
+            self.queued.discard(projId)
+            try:
+                reindexProject(projId)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self.pending.task_done()
+
+    def join(self):
+        self.pending.join()
+
+
+searchIndexer = SearchIndexer()
+
+
+def reindexAfterCommit(session, projId):
+    afterCommit(session, lambda: searchIndexer.enqueue(projId))
+
+
+def reindexAllProjects():
+    with session_scope() as session:
+        projIds = [projId for projId, in session.query(Project.projId)]
+    for projId in projIds:
+        searchIndexer.enqueue(projId)
+
+
+def ftsQuery(text):
+    terms = [term for term in text.split() if term]
+    if not terms:
+        raise UserLogicError('Empty search query.')
+    return ' '.join('"{0}"*'.format(term.replace('"', '""'))
+                    for term in terms)
+
+
+def readableBy(user):
+    """Return a filter for the projects Project.canRead lets user read,
+    for use in a query instead of calling canRead on every row."""
+    teaching = [course.courseId for course in user.coursesTeaching]
+    enrolled = teaching + [course.courseId for course in user.coursesTaking]
+    readable = [
+        Project.projId.in_(sqlalchemy.select([shares.c.projId])
+                           .where(shares.c.userName == user.userName)),
+        Project.projId.in_(sqlalchemy.select([project_owners.c.project])
+                           .where(project_owners.c.users == user.userName))]
+    if teaching:
+        readable.append(Project.projId.in_(
+            sqlalchemy.select([teacher_shares.c.project])
+            .where(teacher_shares.c.course.in_(teaching))))
+    if enrolled:
+        readable.append(Project.projId.in_(
+            sqlalchemy.select([student_shares.c.project])
+            .where(student_shares.c.course.in_(enrolled))))
+    return or_(*readable)
+
+
+def searchProjects(session, query, user):
+    """Return up to SEARCH_LIMIT projects user can read that match an FTS
+    query, best match first."""
+    readable = readableBy(user)
+    found = []
+    for shard in shardIds():
+        found.extend(searchShard(session, query, readable, shard))
+    found.sort(key=lambda row: row[1])
+    return [project for project, rank in found[:SEARCH_LIMIT]]
+
+
+def searchShard(session, query, readable, shard):
+    matches = sqlalchemy.text('SELECT rowid AS docId, rank '
+                              'FROM project_search '
+                              'WHERE project_search MATCH :query') \
+                        .bindparams(query=query) \
+                        .columns(docId=Integer, rank=sqlalchemy.Float) \
+                        .alias('matches')
+    return onShard(session.query(Project, matches.c.rank), shard) \
+        .join(SearchDoc, SearchDoc.projId == Project.projId) \
+        .join(matches, matches.c.docId == SearchDoc.docId) \
+        .filter(readable) \
+        .options(subqueryload(Project.owners),
+                 subqueryload(Project.members),
+                 joinedload(Project.head)) \
+        .order_by(matches.c.rank) \
+        .limit(SEARCH_LIMIT) \
+        .all()
+
+
 class Course(Base):
     __tablename__ = 'courses'
 
@@ -271,15 +1168,18 @@ class Course(Base):
     @staticmethod
     def fromRequest(session, req):
         courseId = forceParam(req, 'courseId')
-        course = session.query(Course) \
-                        .filter(Course.courseId == courseId) \
-                        .first()
+        course = routedQuery(session, Course, 'course', courseId) \
+            .filter(Course.courseId == courseId) \
+            .first()
         if course is None:
             raise NoSuchCourse()
         return course
 
+    def toData(self):
+        return {'courseId': self.courseId, 'name': self.name}
+
     def toXMLId(self):
-        return Elt('course', {'courseId': self.courseId, 'name': self.name})
+        return Elt('course', self.toData())
 
 
 class Assignment(Base):
@@ -293,15 +1193,24 @@ class Assignment(Base):
     @staticmethod
     def fromRequest(session, req):
         assignId = forceParam(req, 'assignId')
-        assign = session.query(Assignment) \
-                        .filter(Assignment.assignId == assignId) \
-                        .first()
+        assign = routedQuery(session, Assignment, 'assignment', assignId) \
+            .filter(Assignment.assignId == assignId) \
+            .first()
         if assign is None:
             raise NoSuchAssignment()
         return assign
 
+    def toData(self):
+        return {'assignId': self.assignId}
+
     def toXMLId(self):
-        return Elt('assignment', {'assignId': self.assignId})
+        return Elt('assignment', self.toData())
+
+    def isTeacher(self, user):
+        return any(user in course.teachers for course in self.course)
+
+    def isStudent(self, user):
+        return any(user in course.students for course in self.course)
 
 
 class Submission(Base):
@@ -321,17 +1230,364 @@ class Submission(Base):
     @staticmethod
     def fromRequest(session, req):
         assignId = forceParam(req, 'assignId')
-        assign = session.query(Assignment) \
-                        .filter(Assignment.assignId == assignId) \
-                        .first()
+        assign = routedQuery(session, Assignment, 'assignment', assignId) \
+            .filter(Assignment.assignId == assignId) \
+            .first()
         if assign is None:
             raise NoSuchAssignment()
         return assign
 
+    def toShortData(self):
+        return {'submitId': self.submitId,
+                'revId': self.revisionId,
+                'time': self.time and self.time.isoformat()}
+
     def toShortXML(self):
-        return Elt('submission', {'submitId': self.submitId,
-                                  'revId': self.revision.revId,
-                                  'time': self.time})
+        return Elt('submission', self.toShortData())
+
+
+class Upload(Base):
+    __tablename__ = 'uploads'
+
+    uploadId = Column(String(HASH_ID_LEN), primary_key=True)
+    projectId = Column(String(HASH_ID_LEN), ForeignKey('projects.projId'))
+    userName = Column(String, ForeignKey('users.userName'))
+    size = Column(Integer)
+    sharedName = Column(String)
+    expires = Column(sqlalchemy.DateTime, index=True)
+    project = relationship('Project')
+    user = relationship('User')
+    chunks = relationship('UploadChunk', order_by='UploadChunk.offset',
+                          cascade='all, delete-orphan')
+
+    def filename(self):
+        return os.path.join(STORAGE_DIR, self.uploadId + '.upload')
+
+    def touch(self):
+        self.expires = datetime.datetime.utcnow() + UPLOAD_TIMEOUT
+
+    def writeChunk(self, offset, data):
+        mode = 'r+b' if os.path.exists(self.filename()) else 'wb'
+        f = fileProxy(open(self.filename(), mode))
+        try:
+            f.seek(offset)
+            f.write(data)
+        finally:
+            f.close()
+
+    def load(self):
+        f = fileProxy(open(self.filename(), 'rb'))
+        try:
+            return f.read(self.size)
+        finally:
+            f.close()
+
+    def discard(self, session):
+        afterCommit(session, lambda name=self.filename(): removeFile(name))
+
+    def receivedRanges(self):
+        ranges = []
+        for chunk in self.chunks:
+            end = chunk.offset + chunk.length
+            if ranges and chunk.offset <= ranges[-1][1]:
+                ranges[-1][1] = max(ranges[-1][1], end)
+            else:
+                ranges.append([chunk.offset, end])
+        return [(start, end) for start, end in ranges if end > start]
+
+    def isComplete(self):
+        return self.receivedRanges() == [(0, self.size)]
+
+    @staticmethod
+    def fromRequest(session, req):
+        uploadId = forceParam(req, 'uploadId')
+        upload = routedQuery(session, Upload, 'upload', uploadId) \
+            .filter(Upload.uploadId == uploadId) \
+            .first()
+        if upload is None or upload.expires < datetime.datetime.utcnow():
+            raise NoSuchUpload()
+        return upload
+
+    def toXML(self):
+        el = Elt('upload', {'uploadId': self.uploadId,
+                            'projId': self.projectId,
+                            'size': str(self.size)})
+        for start, end in self.receivedRanges():
+            el.appendChild(Elt('range', {'offset': str(start),
+                                         'length': str(end - start)}))
+        return el
+
+
+class Usage(Base):
+    """The bytes of revisions charged to a user, project or course."""
+    __tablename__ = 'usage'
+
+    kind = Column(String, primary_key=True)
+    name = Column(String, primary_key=True)
+    bytes = Column(Integer, default=0)
+
+    def toData(self):
+        return {'kind': self.kind, 'name': self.name, 'bytes': self.bytes}
+
+
+class UploadChunk(Base):
+    __tablename__ = 'upload_chunks'
+
+    uploadId = Column(String(HASH_ID_LEN), ForeignKey('uploads.uploadId'),
+                      primary_key=True)
+    offset = Column(Integer, primary_key=True)
+    length = Column(Integer)
+    checksum = Column(String(HASH_ID_LEN))
+
+
+def expireUploads(session):
+    now = datetime.datetime.utcnow()
+    for upload in session.query(Upload).filter(Upload.expires < now):
+        upload.discard(session)
+        session.delete(upload)
+
+
+def expireAllUploads():
+    for shard in shardIds():
+        with session_scope(shard) as session:
+            expireUploads(session)
+
+
+# Sharding
+
+directory = sharding.Directory(DIRECTORY_URL) if SHARDS else None
+SHARD_IDS = list(range(len(SHARDS)))
+# The objects whose ids requests name, so the directory records their
+# shard.
+PLACED = {User: ('user', 'userName'), Project: ('project', 'projId'),
+          Course: ('course', 'courseId'),
+          Assignment: ('assignment', 'assignId'),
+          Upload: ('upload', 'uploadId')}
+# A user or course linked to rows in another shard gets a copy of these
+# columns there, so the join through the link table finds it.
+STUB_COLUMNS = {User: ('userName',), Course: ('courseId', 'name')}
+LINKS = {User: ('projects', 'coursesTeaching', 'coursesTaking'),
+         Project: ('members', 'owners', 'course_shared_with_teachers',
+                   'course_shared_with_students'),
+         Course: ('teachers', 'students'),
+         Assignment: ('course',),
+         Submission: ('members',)}
+
+
+class RoutedQuery(ShardedQuery):
+    """A query whose objects each appear once, although users and courses
+    can be found both in their own shard and as stubs in others."""
+
+    def _execute_and_instances(self, context):
+        results = super(RoutedQuery, self)._execute_and_instances(context)
+        if self._shard_id is not None or len(self._entities) != 1 or \
+                not isinstance(self._entities[0], _MapperEntity):
+            return results
+        seen = set()
+        unique = []
+        for instance in results:
+            if id(instance) not in seen:
+                seen.add(id(instance))
+                unique.append(instance)
+        return iter(unique)
+
+    def _execute_crud(self, stmt, mapper):
+        # Bulk updates and deletes go to the session's current shard, like
+        # other statements not about a loaded row, rather than to every
+        # shard as newer versions of ShardedQuery would send them.
+        if self._shard_id is None:
+            return self.set_shard(self.session.current()) \
+                       ._execute_crud(stmt, mapper)
+        return super(RoutedQuery, self)._execute_crud(stmt, mapper)
+
+
+class RoutedSession(ShardedSession):
+    """A session over every shard.
+
+    Queries run on every shard, unless the session is pinned to one. Rows
+    stay in the shard they were loaded from; new rows, link table rows and
+    statements not about a loaded row go to the shard the session was
+    routed to by routedQuery, failing that to the home shard of the user
+    who signed in, and new users go to their own home shard.
+    """
+
+    def __init__(self, **kwargs):
+        super(RoutedSession, self).__init__(self.chooseShard, self.chooseIds,
+                                            self.chooseQuery,
+                                            query_cls=RoutedQuery, **kwargs)
+
+    def current(self):
+        for key in ('shard', 'home'):
+            if self.info.get(key) is not None:
+                return self.info[key]
+        return SHARD_IDS[0]
+
+    def chooseShard(self, mapper, instance, clause=None):
+        if instance is None:
+            return self.current()
+        shard = getattr(instance, '_shard', None)
+        if shard is None:
+            if isinstance(instance, User):
+                shard = homeShard(instance.userName)
+            else:
+                shard = self.current()
+            instance._shard = shard
+        return shard
+
+    def chooseIds(self, query, ident):
+        return self.chooseQuery(query)
+
+    def chooseQuery(self, query):
+        current = self.current()
+        if self.info.get('pinned'):
+            return [current]
+        return [current] + [shard for shard in SHARD_IDS if shard != current]
+
+
+def shardIds():
+    """Return the shards, or [None] if the data is not sharded."""
+    return SHARD_IDS or [None]
+
+
+def shardOf(kind, key):
+    """Return the shard key is placed in, or None if it is not known."""
+    if directory is None or key is None:
+        return None
+    return directory.lookup(kind, key)
+
+
+def homeShard(userName):
+    shard = directory.lookup('user', userName)
+    if shard is None:
+        shard = sharding.hashShard(userName, len(SHARD_IDS))
+    return shard
+
+
+def routedQuery(session, model, kind, key):
+    """Query model in the shard that the directory places key in, or in
+    every shard if it has no place for it. The first object other than a
+    user looked up this way routes the session to its shard, and raises
+    ShardMoved if the session was already sent to another one, as group
+    commits are when the object moves before they run."""
+    query = session.query(model)
+    shard = shardOf(kind, key)
+    if shard is None:
+        return query
+    if kind == 'user':
+        session.info.setdefault('home', shard)
+    else:
+        current = session.info.setdefault('shard', shard)
+        if session.info.setdefault('route', (kind, key, current)) == \
+                (kind, key, current) and current != shard:
+            raise ShardMoved()
+    return query.set_shard(shard).populate_existing()
+
+
+def localQuery(session, model):
+    """Query model in the shard new rows of the session go to; for rows
+    such as contents that each shard counts references to on its own."""
+    query = session.query(model)
+    if not SHARDS:
+        return query
+    return query.set_shard(session.current()).populate_existing()
+
+
+def everyShard(query):
+    """Return the rows of query from every shard, even in a session that
+    is pinned to one."""
+    if not SHARDS:
+        return query.all()
+    rows = []
+    for shard in SHARD_IDS:
+        rows.extend(query.set_shard(shard))
+    return rows
+
+
+def onShard(query, shard):
+    return query if shard is None else query.set_shard(shard)
+
+
+def shardArgs(shard):
+    """Keyword arguments for Session.execute to run on shard."""
+    return {} if shard is None else {'shard_id': shard}
+
+
+def usedElsewhere(session, instance, *criteria):
+    """Whether a shard other than instance's has a row of its model that
+    matches criteria, naming a blob that must therefore be kept."""
+    shard = getattr(instance, '_shard', None)
+    if shard is None:
+        return False
+    query = session.query(type(instance)).filter(*criteria)
+    return any(query.set_shard(other).first() is not None
+               for other in SHARD_IDS if other != shard)
+
+
+def rememberShard(instance, context):
+    instance._shard = context.attributes.get('shard_id')
+
+
+def refreshShard(instance, context, attrs):
+    rememberShard(instance, context)
+
+
+def addStubs(session, flushContext, instances):
+    shard = session.current()
+    for instance in list(session.new) + list(session.dirty):
+        for name in LINKS.get(type(instance), ()):
+            added = attributes.get_history(
+                instance, name, attributes.PASSIVE_NO_INITIALIZE).added
+            if added:
+                for linked in [instance] + list(added):
+                    addStub(session, linked, shard)
+
+
+def addStub(session, instance, shard):
+    columns = STUB_COLUMNS.get(type(instance))
+    if columns is None or session.chooseShard(None, instance) == shard:
+        return
+    session.execute(type(instance).__table__.insert().prefix_with('OR IGNORE'),
+                    dict((name, getattr(instance, name)) for name in columns),
+                    shard_id=shard)
+
+
+def placeNew(session, flushContext):
+    placements = {}
+    for instance in session.new:
+        if type(instance) in PLACED:
+            kind, attr = PLACED[type(instance)]
+            placements.setdefault(instance._shard, []).append(
+                (kind, getattr(instance, attr)))
+    for shard, items in placements.items():
+        directory.placeMany(items, shard)
+    if session.new or session.dirty or session.deleted:
+        session.info['wrote'] = True
+
+
+def markWritten(context):
+    context.session.info['wrote'] = True
+
+
+def checkRoute(session):
+    """Refuse to commit writes to a shard that the object the session was
+    routed by has been moved away from meanwhile; see moveCourse."""
+    route = session.info.get('route')
+    if route is None:
+        return
+    session.flush()
+    kind, key, shard = route
+    if session.info.get('wrote') and directory.lookup(kind, key) != shard:
+        raise ShardMoved()
+
+
+if SHARDS:
+    sqlalchemy.event.listen(Base, 'load', rememberShard, propagate=True)
+    sqlalchemy.event.listen(Base, 'refresh', refreshShard, propagate=True)
+    sqlalchemy.event.listen(RoutedSession, 'before_flush', addStubs)
+    sqlalchemy.event.listen(RoutedSession, 'after_flush', placeNew)
+    sqlalchemy.event.listen(RoutedSession, 'after_bulk_update', markWritten)
+    sqlalchemy.event.listen(RoutedSession, 'after_bulk_delete', markWritten)
+    sqlalchemy.event.listen(RoutedSession, 'before_commit', checkRoute)
 
 
 def split_auth_token(token):
@@ -376,7 +1632,7 @@ def sendError(resp, msg):
 
 
 def handle_exception(exp, req, resp, params):
-    respondXML(resp, falcon.HTTP_500, xmlError(traceback.format_exc()))
+    respondError(req, resp, falcon.HTTP_500, traceback.format_exc())
 
 
 # Exceptions
@@ -399,35 +1655,33 @@ class NotAuthenticated(ServerException):
 class NotAuthorized(ServerException):
 
     def handle(self, req, resp, params):
-        respondXML(resp, falcon.HTTP_403, xmlError('Not authorized'))
+        respondError(req, resp, falcon.HTTP_403, 'Not authorized')
 
 
 class NotPermitted(ServerException):
 
     def handle(self, req, resp, params):
-        respondXML(resp, falcon.HTTP_400, xmlError('Not permitted'))
+        respondError(req, resp, falcon.HTTP_400, 'Not permitted')
 
 
 class NeedAuthentication(ServerException):
 
     def handle(self, req, resp, params):
         requestLogin(resp)
-        resp.body = xmlError('Need authentication')
-        resp.content_type = 'application/xml; charset=utf-8'
+        respondError(req, resp, resp.status, 'Need authentication')
 
 
 class IncorrectPassword(ServerException):
 
     def handle(self, req, resp, params):
         requestLogin(resp)
-        resp.body = xmlError('Incorrect password')
-        resp.content_type = 'application/xml; charset=utf-8'
+        respondError(req, resp, resp.status, 'Incorrect password')
 
 
 class NoSuchUser(ServerException):
 
     def handle(self, req, resp, params):
-        respondXML(resp, falcon.HTTP_500, xmlError('User does not exist.'))
+        respondError(req, resp, falcon.HTTP_500, 'User does not exist.')
 
 
 class NoSuchProject(ServerException):
@@ -446,6 +1700,10 @@ class NoSuchRevision(ServerException):
     pass
 
 
+class NoSuchUpload(ServerException):
+    pass
+
+
 class MissingParameter(ServerException):
 
     def __init__(self, param):
@@ -453,8 +1711,31 @@ class MissingParameter(ServerException):
         ServerException.__init__(self)
 
     def handle(self, req, resp, params):
-        msg = xmlError('Missing parameter {0}.'.format(self._param))
-        respondXML(resp, falcon.HTTP_400, msg)
+        respondError(req, resp, falcon.HTTP_400,
+                     'Missing parameter {0}.'.format(self._param))
+
+
+class QuotaExceeded(ServerException):
+
+    def __init__(self, kind):
+        self.kind = kind
+
+    def handle(self, req, resp, params):
+        respondError(req, resp, falcon.HTTP_413,
+                     'The {0} storage quota is exceeded.'.format(self.kind))
+
+
+class TooManyWatches(ServerException):
+
+    def handle(self, req, resp, params):
+        respondError(req, resp, HTTP_429, 'Too many open watches.')
+
+
+class ShardMoved(ServerException):
+
+    def handle(self, req, resp, params):
+        respondError(req, resp, falcon.HTTP_503,
+                     'The data was being moved; try again.')
 
 
 class UserLogicError(ServerException):
@@ -464,18 +1745,21 @@ class UserLogicError(ServerException):
         ServerException.__init__(self)
 
     def handle(self, req, resp, params):
-        respondXML(resp, falcon.HTTP_400, xmlError(self._msg))
+        respondError(req, resp, falcon.HTTP_400, self._msg)
 
 
 class UnknownURL(ServerException):
 
     def handle(self, req, resp, params):
-        respondXML(resp, falcon.HTTP_400, xmlError('Could not parse url.'))
+        respondError(req, resp, falcon.HTTP_400, 'Could not parse url.')
 
 
 usernameRe = re.compile('[A-z0-9_.-]+')
 
 
+HTTP_429 = '429 Too Many Requests'
+
+
 def validUsername(username):
     return isinstance(username, str) and usernameRe.match(username)
 
@@ -496,24 +1780,26 @@ def hash_password(username, password):
 
 def userExists(username):
     with session_scope() as session:
-        res = session.query(User) \
+        res = session.query(User.userName) \
                      .filter(User.userName == username) \
-                     .count() != 0
+                     .first() is not None
         return res
 
 
 def auth(session, req, resp):
-    username, password = forceUserPass(req, resp)
-    if None in (username, password):
-        raise NeedAuthentication()
-    users = session.query(User).filter(User.userName == username).all()
-    if len(users) == 0:
-        raise NoSuchUser()
-    user = users[0]
-    if hash_password(username, password) != user.password:
-        raise IncorrectPassword()
-    else:
-        return user
+    with tracer.span('auth'):
+        username, password = forceUserPass(req, resp)
+        if None in (username, password):
+            raise NeedAuthentication()
+        users = routedQuery(session, User, 'user', username) \
+            .filter(User.userName == username).all()
+        if len(users) == 0:
+            raise NoSuchUser()
+        user = users[0]
+        if hash_password(username, password) != user.password:
+            raise IncorrectPassword()
+        else:
+            return user
 
 
 def respondXML(resp, status, body):
@@ -522,6 +1808,125 @@ def respondXML(resp, status, body):
     resp.body = body
 
 
+def addVary(resp, field):
+    """Add field to the Vary header of resp, after those set before."""
+    fields = [name for name in resp._headers.get('vary', '').split(', ')
+              if name]
+    if field not in fields:
+        resp.set_header('Vary', ', '.join(fields + [field]))
+
+
+def wantsJSON(req, resp):
+    """Whether the client prefers JSON to XML in its Accept header; resp
+    is marked as varying with it, for caches."""
+    addVary(resp, 'Accept')
+    types = compression.parse_accept_encoding(req.get_header('Accept'))
+    quality = types.get('application/json', 0)
+    return quality > 0 and quality >= types.get('application/xml', 0)
+
+
+def respondJSON(resp, status, data):
+    resp.content_type = 'application/json; charset=utf-8'
+    resp.status = status
+    with tracer.span('serialize.json'):
+        resp.body = json.dumps(data, separators=(',', ':'))
+
+
+def respondError(req, resp, status, msg):
+    if wantsJSON(req, resp):
+        respondJSON(resp, status, {'error': msg})
+    else:
+        respondXML(resp, status, xmlError(msg))
+
+
+def respondList(req, resp, name, items, toXML, attrib=None):
+    """Respond with a list of plain records, as JSON under name or as
+    XML with toXML(record) for each record."""
+    if wantsJSON(req, resp):
+        data = dict(attrib or {})
+        data[name] = items
+        respondJSON(resp, falcon.HTTP_200, data)
+        return
+    success = Elt('success', stringValues(attrib or {}))
+    for item in items:
+        success.appendChild(toXML(item))
+    respondXML(resp, falcon.HTTP_200, formatXML(success))
+
+
+def eltMaker(tag):
+    return lambda attrib: Elt(tag, stringValues(attrib))
+
+
+def stringValues(attrib):
+    return dict((k, str(v) if isinstance(v, (int, float)) else v)
+                for k, v in attrib.items() if v is not None)
+
+
+def responseSize(response):
+    return len(response[1])
+
+
+# List responses, filed under the versions of the rosters, course lists and
+# assignment lists they show. Handlers that change one of these bump its
+# version with bumpAfterCommit.
+responseCache = versioncache.VersionedCache(RESPONSE_CACHE_SIZE,
+                                            responseSize)
+
+
+def respondCached(req, resp, name, dependencies, respond):
+    """Respond with the response cached under name, unless the data named
+    by dependencies has changed since; otherwise call respond() and cache
+    what it responded with."""
+    cacheKey = responseCache.key(name + (wantsJSON(req, resp),),
+                                 dependencies)
+    cached = responseCache.get(cacheKey)
+    if cached is not None:
+        resp.status = falcon.HTTP_200
+        resp.content_type, resp.body = cached
+        return
+    respond()
+    if resp.status == falcon.HTTP_200:
+        responseCache.put(cacheKey, (resp.content_type, resp.body))
+
+
+def renderRevision(segments, envelope, gzip):
+    """Return the chunks of a response embedding segments in envelope."""
+    prefix, suffix = envelope
+    with tracer.span('serialize.revision', gzip=gzip):
+        if gzip:
+            return list(compression.gzip_stream(
+                [compression.compress_segment(prefix)] + segments +
+                [compression.compress_segment(suffix)]))
+        return [prefix + compression.inflate(segments) + suffix]
+
+
+def renderStoredRevision(revision, gzip):
+    return renderRevision(cachedSegments(revision), revision.envelope(), gzip)
+
+
+def respondRevision(req, resp, revision, segments=None, envelope=None):
+    codings = compression.parse_accept_encoding(
+        req.get_header('Accept-Encoding'))
+    gzip = compression.accepts(codings, 'gzip')
+    if segments is None and envelope is None:
+        chunks = singleFlight(revisionRenders, (revision.revId, gzip),
+                              renderStoredRevision, revision, gzip)
+    else:
+        if segments is None:
+            segments = cachedSegments(revision)
+        chunks = renderRevision(segments, envelope or revision.envelope(),
+                                gzip)
+    resp.content_type = 'application/xml; charset=utf-8'
+    resp.status = falcon.HTTP_200
+    addVary(resp, 'Accept-Encoding')
+    if gzip:
+        resp.set_header('Content-Encoding', 'gzip')
+        resp.stream = iter(chunks)
+        resp.stream_len = sum(len(chunk) for chunk in chunks)
+    else:
+        resp.data = b''.join(chunks)
+
+
 def generate_password():
     chars = [random.choice(string.letters + string.digits) for i in range(6)]
     return ''.join(chars)
@@ -576,6 +1981,10 @@ def generateSubmissionId():
     return generateHashId()
 
 
+def generateUploadId():
+    return generateHashId()
+
+
 def forceParam(req, paramName):
     param = req.get_param(paramName)
     if param is None:
@@ -584,8 +1993,26 @@ def forceParam(req, paramName):
         return param
 
 
+def forceIntParam(req, paramName):
+    param = forceParam(req, paramName)
+    try:
+        value = int(param)
+    except ValueError:
+        raise UserLogicError('{0} must be an integer.'.format(paramName))
+    if value < 0:
+        raise UserLogicError('{0} must not be negative.'.format(paramName))
+    return value
+
+
+def sha1hex(*parts):
+    sha1 = hashlib.sha1()
+    for part in parts:
+        sha1.update(part)
+    return sha1.hexdigest()
+
+
 def get_or_create(session, model, defaults=None, *args, **kwargs):
-    instance = session.query(model).filter_by(*args, **kwargs).first()
+    instance = localQuery(session, model).filter_by(*args, **kwargs).first()
     if instance is not None:
         return instance, False
     else:
@@ -598,6 +2025,901 @@ def get_or_create(session, model, defaults=None, *args, **kwargs):
         return instance, True
 
 
+def insertOrGet(session, model, **values):
+    """Insert a row of model unless one with the same primary key exists
+    and return (instance, created). Unlike get_or_create, two writers
+    adding the same row at once both succeed, so identical contents saved
+    together don't fail on the key."""
+    key = model.__mapper__.primary_key[0]
+    result = session.execute(
+        model.__table__.insert().prefix_with('OR IGNORE').values(**values),
+        **shardArgs(session.current() if SHARDS else None))
+    instance = localQuery(session, model) \
+        .filter(key == values[key.key]) \
+        .one()
+    return instance, result.rowcount == 1
+
+
+def readProject(chunks):
+    """Validate and normalize uploaded project XML; see projectxml."""
+    try:
+        return projectxml.normalize(chunks)
+    except projectxml.InvalidProject as e:
+        raise UserLogicError(str(e))
+
+
+def commitRevision(session, project, document, sharedName=None,
+                   prevId=None):
+    """Make document the head of project, as a revision following prevId,
+    or the current head if prevId is None."""
+    if sharedName is not None:
+        project.sharedName = sharedName
+    if prevId is None:
+        prevId = formatHash(0)
+        if project.head is not None:
+            prevId = project.head.revId
+    revId = sha1hex(prevId, document.contents)
+    revision, created = get_or_create(session, Revision, revId=revId,
+                                      prevId=prevId)
+    if created:
+        revision.created = datetime.datetime.utcnow()
+        revision.projectId = project.projId
+        revision.setDocument(document)
+        chargeRevision(session, project, revision)
+    project.head = revision
+    project.touch()
+    publishAfterCommit(session, 'project:' + project.projId,
+                       {'type': 'head', 'projId': project.projId,
+                        'revId': revision.revId})
+    invalidateGallery(session, project)
+    reindexAfterCommit(session, project.projId)
+    session.add(project)
+    session.add(revision)
+    return revision, created
+
+
+def addUsage(session, kind, name, delta):
+    if not delta:
+        return
+    updated = session.query(Usage) \
+                     .filter(Usage.kind == kind, Usage.name == name) \
+                     .update({Usage.bytes: Usage.bytes + delta},
+                             synchronize_session=False)
+    if not updated:
+        session.add(Usage(kind=kind, name=name, bytes=delta))
+
+
+def usageOf(session, kind, name):
+    return sum(size or 0 for size, in session.query(Usage.bytes)
+               .filter(Usage.kind == kind, Usage.name == name))
+
+
+def chargeRevision(session, project, revision, sign=1):
+    """Charge the bytes of a revision to its project and the project's
+    owners, or refund them if sign is -1."""
+    size = sign * (revision.byteSize or 0)
+    addUsage(session, 'project', project.projId, size)
+    for owner in project.owners:
+        addUsage(session, 'user', owner.userName, size)
+
+
+def chargeSubmission(session, submission):
+    if submission.revision is None:
+        return
+    size = submission.revision.byteSize or 0
+    for assignment in submission.assignment:
+        for course in assignment.course:
+            addUsage(session, 'course', course.courseId, size)
+
+
+def releaseProject(session, project):
+    """Refund the owners of a project that is being deleted."""
+    size = usageOf(session, 'project', project.projId)
+    for owner in project.owners:
+        addUsage(session, 'user', owner.userName, -size)
+    session.query(Usage) \
+           .filter(Usage.kind == 'project', Usage.name == project.projId) \
+           .delete(synchronize_session=False)
+
+
+def checkQuota(session, project, size):
+    """Raise QuotaExceeded unless size more bytes fit in the quotas of
+    project and its owners."""
+    if PROJECT_QUOTA and \
+            usageOf(session, 'project', project.projId) + size > \
+            PROJECT_QUOTA:
+        raise QuotaExceeded('project')
+    if USER_QUOTA:
+        for owner in project.owners:
+            if usageOf(session, 'user', owner.userName) + size > USER_QUOTA:
+                raise QuotaExceeded('user')
+
+
+def checkCourseQuota(session, assignment, size):
+    if COURSE_QUOTA:
+        for course in assignment.course:
+            if usageOf(session, 'course', course.courseId) + size > \
+                    COURSE_QUOTA:
+                raise QuotaExceeded('course')
+
+
+def canReadRevision(session, user, revision, project=None):
+    heads = session.query(Project).filter(Project.headId == revision.revId)
+    for proj in heads:
+        if proj.public or proj.canRead(user):
+            return True
+    submissions = session.query(Submission) \
+                         .filter(Submission.revisionId == revision.revId)
+    for submission in submissions:
+        if user == submission.submitter or user in submission.members:
+            return True
+        for assignment in submission.assignment:
+            if assignment.isTeacher(user):
+                return True
+    if project is not None and (project.public or project.canRead(user)):
+        return project.hasRevision(session, revision)
+    return False
+
+
+diffCache = lru.LRUCache(DIFF_CACHE_SIZE)
+
+
+def segmentsSize(segments):
+    return sum(len(seg.data) for seg in segments)
+
+
+revisionCache = lru.LRUCache(REVISION_CACHE_SIZE, segmentsSize)
+# Concurrent reads of the same revision share one load, and concurrent
+# getRevision requests for it share one rendered response.
+revisionLoads = singleflight.SingleFlight(READ_WAIT_TIMEOUT)
+revisionRenders = singleflight.SingleFlight(READ_WAIT_TIMEOUT)
+
+
+def loadAndCache(revId, contentHash):
+    segments = Revision.loadSegmentsFor(revId, contentHash)
+    revisionCache.put(revId, segments)
+    return segments
+
+
+def warmRevision(revision):
+    """Start loading a revision into revisionCache in the background."""
+    if revision.revId in revisionCache or \
+            revisionLoads.inFlight(revision.revId):
+        return
+    blobstore.spawn(revisionLoads.run, revision.revId, loadAndCache,
+                    revision.revId, revision.contentHash)
+
+
+def singleFlight(flight, key, fn, *args):
+    try:
+        return flight.run(key, fn, *args)
+    except singleflight.Timeout:
+        return fn(*args)
+
+
+def cachedSegments(revision):
+    segments = revisionCache.get(revision.revId)
+    if segments is not None:
+        return segments
+    return singleFlight(revisionLoads, revision.revId, loadAndCache,
+                        revision.revId, revision.contentHash)
+
+
+def exportArchive(manifest, files):
+    archive = zipstream.ZipStream()
+    now = datetime.datetime.utcnow()
+    for data in archive.add_bytes('manifest.xml', manifest.encode('utf-8'),
+                                  now):
+        yield data
+    pending = files[0][1].prefetch() if files else None
+    for i, (name, revision, when) in enumerate(files):
+        with tracer.span('storage.wait'):
+            segments = pending.result()
+        if i + 1 < len(files):
+            pending = files[i + 1][1].prefetch()
+        for data in archive.add_segments(name, segments, when):
+            yield data
+    for data in archive.finish():
+        yield data
+
+
+class PendingSave(object):
+
+    __slots__ = ('projId', 'prevId', 'revId', 'document', 'contents',
+                 'sharedName', 'timer')
+
+    def __init__(self, projId, prevId):
+        self.projId = projId
+        self.prevId = prevId
+        self.revId = None
+        self.document = None
+        self.contents = None
+        self.sharedName = None
+        self.timer = None
+
+    def update(self, document, sharedName):
+        self.document = document
+        self.contents = document.contents
+        self.revId = sha1hex(self.prevId, self.contents)
+        if sharedName is not None:
+            self.sharedName = sharedName
+
+    def revision(self):
+        revision = Revision(revId=self.revId, prevId=self.prevId)
+        revision.setDocument(self.document)
+        return revision
+
+
+class AutosaveBuffer(object):
+    """Collapses the autosaves made to a project within a window.
+
+    The first autosave after a commit starts the window; later ones replace
+    its contents. When the window closes, or the buffer is flushed
+    explicitly, the latest contents are committed as a single revision on
+    top of the head the window started from, even if the head has moved
+    since, so the revId handed out for the latest autosave is the one that
+    gets stored. Handlers that move the head flush the buffer first.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.flushing = {}
+        self.byRevId = {}
+
+    def get(self, projId):
+        return self.pending.get(projId)
+
+    def lookup(self, revId):
+        return self.byRevId.get(revId)
+
+    def save(self, project, document, sharedName):
+        with self.lock:
+            entry = self.pending.get(project.projId)
+            if entry is None:
+                prevId = self.flushing.get(project.projId)
+                if prevId is None:
+                    prevId = project.headId or formatHash(0)
+                entry = PendingSave(project.projId, prevId)
+                self.pending[project.projId] = entry
+                self._schedule(entry)
+            else:
+                self.byRevId.pop(entry.revId, None)
+            entry.update(document, sharedName)
+            self.byRevId[entry.revId] = entry
+            return entry.revId
+
+    def _schedule(self, entry):
+        entry.timer = threading.Timer(AUTOSAVE_WINDOW, self.flush,
+                                      [entry.projId])
+        entry.timer.daemon = True
+        entry.timer.start()
+
+    def flush(self, projId):
+        with self.lock:
+            entry = self.pending.pop(projId, None)
+            if entry is None:
+                return
+            entry.timer.cancel()
+            self.flushing[projId] = entry.revId
+        try:
+            with session_scope() as session:
+                project = routedQuery(session, Project, 'project', projId) \
+                    .filter(Project.projId == projId) \
+                    .first()
+                if project is not None:
+                    revision, created = commitRevision(
+                        session, project, entry.document, entry.sharedName,
+                        entry.prevId)
+                    if created:
+                        revision.save(session, entry.contents)
+        except Exception:
+            traceback.print_exc()
+            with self.lock:
+                if projId not in self.pending:
+                    self.pending[projId] = entry
+                    self._schedule(entry)
+                    return
+        finally:
+            with self.lock:
+                self.flushing.pop(projId, None)
+        with self.lock:
+            if self.byRevId.get(entry.revId) is entry:
+                del self.byRevId[entry.revId]
+
+    def flushAll(self):
+        for projId in list(self.pending):
+            self.flush(projId)
+
+
+autosaves = AutosaveBuffer()
+atexit.register(autosaves.flushAll)
+
+
+class WriteUnit(object):
+
+    __slots__ = ('work', 'done', 'result', 'error', 'trace', 'thread')
+
+    def __init__(self, work):
+        self.work = work
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.trace = tracer.current()
+        self.thread = threading.current_thread()
+
+
+class WriteScheduler(object):
+    """Commits write units from concurrent requests in shared transactions.
+
+    Each unit is a function of a session. Units that arrive while a batch
+    is being gathered run one after another in a single transaction, each
+    inside its own savepoint so that a unit which raises is rolled back
+    without affecting the rest. The callers are released once the whole
+    batch has committed. Each shard has its own batches.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queues = {}
+        self.batches = 0
+        self.units = 0
+        self.local = threading.local()
+
+    def requester(self):
+        """Return the thread that queued the unit the current thread is
+        running, or the current thread outside units."""
+        unit = getattr(self.local, 'unit', None)
+        return threading.current_thread() if unit is None else unit.thread
+
+    def run(self, work, shard=None):
+        """Return work(session), run in a batch on shard; the shard only
+        matters when the data is sharded, and work is run on its own if
+        it is not known."""
+        if GROUP_COMMIT_MAX_BATCH <= 1 or (SHARDS and shard is None):
+            with session_scope() as session:
+                return work(session)
+        unit = WriteUnit(work)
+        self.queueFor(shard).put(unit)
+        with tracer.span('db.commit'):
+            unit.done.wait()
+        if unit.error is not None:
+            raise unit.error
+        return unit.result
+
+    def queueFor(self, shard):
+        with self.lock:
+            pending = self.queues.get(shard)
+            if pending is None:
+                pending = self.queues[shard] = queue.Queue()
+                worker = threading.Thread(target=self.loop,
+                                          args=(pending, shard))
+                worker.daemon = True
+                worker.start()
+            return pending
+
+    def gather(self, pending):
+        batch = [pending.get()]
+        deadline = time.time() + GROUP_COMMIT_MAX_WAIT
+        while len(batch) < GROUP_COMMIT_MAX_BATCH:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(pending.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def loop(self, pending, shard):
+        while True:
+            batch = self.gather(pending)
+            try:
+                self.commit(batch, shard)
+            except Exception as e:
+                for unit in batch:
+                    if unit.error is None:
+                        unit.error = e
+            finally:
+                for unit in batch:
+                    unit.done.set()
+
+    def commit(self, batch, shard=None):
+        session = newWriteSession(shard)
+        callbacks = []
+        try:
+            for unit in batch:
+                session.info.pop('route', None)
+                session.info.pop('wrote', None)
+                session.info.pop('unusedBlobs', None)
+                savepoint = session.begin_nested()
+                self.local.unit = unit
+                try:
+                    with tracer.attached(unit.trace):
+                        unit.result = unit.work(session)
+                        checkRoute(session)
+                    savepoint.commit()
+                except Exception as e:
+                    savepoint.rollback()
+                    unit.error = e
+                    session.info.pop('afterCommit', None)
+                else:
+                    callbacks.extend(session.info.pop('afterCommit', []))
+                finally:
+                    self.local.unit = None
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+        self.batches += 1
+        self.units += len(batch)
+        for callback in callbacks:
+            callback()
+
+
+writes = WriteScheduler()
+
+
+def epochSeconds(when):
+    return (when - datetime.datetime(1970, 1, 1)).total_seconds()
+
+
+def retentionBucket(created, now):
+    """Return the bucket a revision counts against, or None to keep it."""
+    age = now - created
+    for tier, (maxAge, interval) in enumerate(RETENTION):
+        if maxAge is None or age < maxAge:
+            if interval is None:
+                return None
+            return tier, int(epochSeconds(created) //
+                             interval.total_seconds())
+    return None
+
+
+def olderRevision(revisions, row):
+    if row.prevId in revisions:
+        return row.prevId
+    return row.ancestorId
+
+
+def thinRevisions(now=None, shard=None):
+    """Delete old revisions not kept by RETENTION; return how many.
+
+    The revisions are walked without taking the write lock. The links
+    past the doomed ones and their deletion are then written in batches
+    of TIERING_BATCH_SIZE, each in a transaction of its own.
+    """
+    now = now or datetime.datetime.utcnow()
+    relinks = []
+    with session_scope(shard) as session:
+        revisions = dict((row.revId, row) for row in session.query(
+            Revision.revId, Revision.prevId, Revision.ancestorId,
+            Revision.created))
+        heads = set(headId for headId, in session.query(Project.headId)
+                    if headId is not None)
+        protected = heads | set(
+            revId for revId, in everyShard(
+                session.query(Submission.revisionId)))
+        visited = set()
+        kept = set()
+        chains = []
+        for headId in heads:
+            chain = []
+            buckets = set()
+            revId = headId
+            while revId in revisions and revId not in visited:
+                row = revisions[revId]
+                chain.append(revId)
+                visited.add(revId)
+                bucket = None
+                if row.created is not None:
+                    bucket = retentionBucket(row.created, now)
+                if (revId in protected or bucket is None or
+                        bucket not in buckets):
+                    kept.add(revId)
+                    buckets.add(bucket)
+                revId = olderRevision(revisions, row)
+            chains.append((chain, revId))
+        doomed = visited - kept
+        for chain, joinId in chains:
+            # A chain that runs into one walked earlier is linked to the
+            # first revision kept on that one.
+            while joinId in doomed:
+                joinId = olderRevision(revisions, revisions[joinId])
+            survivors = [revId for revId in chain if revId not in doomed]
+            if joinId in revisions:
+                survivors.append(joinId)
+            for newer, older in zip(survivors, survivors[1:]):
+                row = revisions[newer]
+                if row.prevId != older and row.ancestorId != older:
+                    relinks.append((newer, older))
+    for start in range(0, len(relinks), TIERING_BATCH_SIZE):
+        with session_scope(shard) as session:
+            for newer, older in relinks[start:start + TIERING_BATCH_SIZE]:
+                session.query(Revision) \
+                       .filter(Revision.revId == newer) \
+                       .update({'ancestorId': older},
+                               synchronize_session=False)
+    doomed = list(doomed)
+    deleted = 0
+    for start in range(0, len(doomed), TIERING_BATCH_SIZE):
+        batch = doomed[start:start + TIERING_BATCH_SIZE]
+        with session_scope(shard) as session:
+            # Saves since the walk may have made some of them heads again.
+            kept = set(headId for headId, in session.query(Project.headId)
+                       .filter(Project.headId.in_(batch)))
+            kept.update(revId for revId, in everyShard(
+                session.query(Submission.revisionId)
+                .filter(Submission.revisionId.in_(batch))))
+            for revision in session.query(Revision) \
+                                   .filter(Revision.revId.in_(batch)):
+                if revision.revId not in kept:
+                    revision.discard(session)
+                    deleted += 1
+    return deleted
+
+
+def tierContents(now=None, shard=None):
+    """Move a batch of contents that are only used by old revisions that
+    are neither heads nor submissions to cold storage; return how many."""
+    now = now or datetime.datetime.utcnow()
+    heads = sqlalchemy.select([Project.headId])
+    submitted = sqlalchemy.select([Submission.revisionId])
+    with session_scope(shard) as session:
+        inUse = session.query(Revision.contentHash) \
+                       .filter(Revision.contentHash.isnot(None)) \
+                       .filter(or_(Revision.revId.in_(heads),
+                                   Revision.revId.in_(submitted),
+                                   Revision.created.is_(None),
+                                   Revision.created > now - COLD_AFTER))
+        contents = session.query(Content) \
+                          .filter(or_(Content.cold.is_(None),
+                                      Content.cold == sqlalchemy.false())) \
+                          .filter(~Content.contentHash.in_(inUse)) \
+                          .limit(TIERING_BATCH_SIZE) \
+                          .all()
+        for content in contents:
+            content.freeze(session)
+        return len(contents)
+
+
+def runTiering(now=None):
+    for shard in shardIds():
+        thinRevisions(now, shard)
+        while tierContents(now, shard):
+            pass
+
+
+def claimRevisions(session):
+    """Set the project of revisions saved before usage was counted to
+    the first project found to have them in its history."""
+    revisions = dict((row.revId, row) for row in session.query(
+        Revision.revId, Revision.prevId, Revision.ancestorId,
+        Revision.projectId))
+    claimed = {}
+    for projId, headId in session.query(Project.projId, Project.headId) \
+                                 .order_by(Project.projId):
+        revId = headId
+        while revId in revisions and revId not in claimed and \
+                revisions[revId].projectId is None:
+            claimed.setdefault(projId, []).append(revId)
+            revId = olderRevision(revisions, revisions[revId])
+    for projId, revIds in claimed.items():
+        for start in range(0, len(revIds), TIERING_BATCH_SIZE):
+            session.query(Revision) \
+                   .filter(Revision.revId.in_(
+                       revIds[start:start + TIERING_BATCH_SIZE])) \
+                   .update({'projectId': projId}, synchronize_session=False)
+
+
+def revisionSizes(session, revIds):
+    """Return {revId: bytes} for revIds, looking in every shard."""
+    revIds = list(revIds)
+    size = sqlalchemy.func.coalesce(Revision.byteSize, Content.size, 0)
+    sizes = {}
+    for start in range(0, len(revIds), TIERING_BATCH_SIZE):
+        sizes.update(everyShard(
+            session.query(Revision.revId, size)
+                   .outerjoin(Content)
+                   .filter(Revision.revId.in_(
+                       revIds[start:start + TIERING_BATCH_SIZE]))))
+    return sizes
+
+
+def reconcileUsage(shard=None):
+    """Recount the usage counters from the revisions and submissions,
+    repairing any that have drifted; return how many had. The count is
+    taken under the write lock, so that no save lands between it and the
+    repair."""
+    with write_scope(shard) as session:
+        if shard is not None:
+            session.info['pinned'] = True
+        return recountUsage(session)
+
+
+def recountUsage(session):
+    size = sqlalchemy.func.sum(sqlalchemy.func.coalesce(
+        Revision.byteSize, Content.size, 0))
+    claimRevisions(session)
+    expected = {}
+    projects = session.query(Project.projId, size) \
+                      .join(Revision,
+                            Revision.projectId == Project.projId) \
+                      .outerjoin(Content) \
+                      .group_by(Project.projId)
+    for projId, total in projects:
+        expected[('project', projId)] = total
+    owners = session.query(project_owners.c.project,
+                           project_owners.c.users)
+    for projId, userName in owners:
+        key = ('user', userName)
+        expected[key] = (expected.get(key, 0) +
+                         expected.get(('project', projId), 0))
+    # A submitted revision can be in another shard than the course.
+    submitted = session.query(course_assignments.c.course,
+                              Submission.revisionId) \
+                       .select_from(Submission) \
+                       .join(assignment_submissions,
+                             assignment_submissions.c.submissions ==
+                             Submission.submitId) \
+                       .join(course_assignments,
+                             course_assignments.c.assignment ==
+                             assignment_submissions.c.assignment) \
+                       .all()
+    sizes = revisionSizes(session, set(revId for _, revId in submitted))
+    for courseId, revId in submitted:
+        if revId in sizes:
+            key = ('course', courseId)
+            expected[key] = expected.get(key, 0) + sizes[revId]
+    drifted = 0
+    for usage in session.query(Usage):
+        total = expected.pop((usage.kind, usage.name), 0)
+        if usage.bytes != total:
+            usage.bytes = total
+            drifted += 1
+    for (kind, name), total in expected.items():
+        if total:
+            session.add(Usage(kind=kind, name=name, bytes=total))
+            drifted += 1
+    return drifted
+
+
+def reconcileAllUsage():
+    return sum(reconcileUsage(shard) for shard in shardIds())
+
+
+def courseRows(conn, courseId):
+    """Return (table, criterion) for the rows that belong to a course, and
+    the names of the users they refer to."""
+    assignIds = [assignId for assignId, in conn.execute(
+        sqlalchemy.select([course_assignments.c.assignment])
+        .where(course_assignments.c.course == courseId))]
+    submitIds = [submitId for submitId, in conn.execute(
+        sqlalchemy.select([assignment_submissions.c.submissions])
+        .where(assignment_submissions.c.assignment.in_(assignIds)))] \
+        if assignIds else []
+    rows = [(Course.__table__, Course.courseId == courseId),
+            (course_teachers, course_teachers.c.course == courseId),
+            (course_students, course_students.c.course == courseId),
+            (course_assignments, course_assignments.c.course == courseId),
+            (Usage.__table__, and_(Usage.kind == 'course',
+                                   Usage.name == courseId))]
+    if assignIds:
+        rows += [(Assignment.__table__, Assignment.assignId.in_(assignIds)),
+                 (assignment_submissions,
+                  assignment_submissions.c.assignment.in_(assignIds))]
+    if submitIds:
+        rows += [(Submission.__table__, Submission.submitId.in_(submitIds)),
+                 (submission_members,
+                  submission_members.c.submissions.in_(submitIds))]
+    userNames = set()
+    for column, table in ((course_teachers.c.teacher, course_teachers),
+                          (course_students.c.student, course_students)):
+        userNames.update(name for name, in conn.execute(
+            sqlalchemy.select([column]).where(table.c.course == courseId)))
+    if submitIds:
+        userNames.update(name for name, in conn.execute(
+            sqlalchemy.select([submission_members.c.users])
+            .where(submission_members.c.submissions.in_(submitIds))))
+        userNames.update(name for name, in conn.execute(
+            sqlalchemy.select([Submission.submitterName])
+            .where(Submission.submitId.in_(submitIds))))
+    return assignIds, rows, userNames
+
+
+def copyCourse(source, target, courseId):
+    """Make target's copy of a course the same as source's; return the
+    course's assignment ids and its tables with their criteria."""
+    assignIds, rows, userNames = courseRows(source, courseId)
+    with target.begin():
+        sharding.copyStubs(source, target, User.__table__,
+                           STUB_COLUMNS[User], userNames)
+        for table, criterion in rows:
+            sharding.syncRows(source, target, table, criterion)
+    return assignIds, rows
+
+
+def moveCourse(courseId, target):
+    """Move a course, its roster, assignments and submissions to shard
+    target while the server runs.
+
+    The rows are copied once while writes go on and once more holding the
+    source shard's write lock, during which the directory is switched and
+    the source's rows are deleted. Requests routed to the source by the
+    course or one of its assignments that commit after the switch fail
+    with ShardMoved and can be retried. The submitted revisions stay with
+    their projects, and the source keeps the course's name for projects
+    shared with it.
+    """
+    source = directory.lookup('course', courseId)
+    if source is None:
+        raise NoSuchCourse()
+    if source == target:
+        return
+    targetConn = shardWriteEngines[target].connect()
+    try:
+        with shardEngines[source].connect() as sourceConn:
+            copyCourse(sourceConn, targetConn, courseId)
+        with shardWriteEngines[source].connect() as sourceConn:
+            with sourceConn.begin():
+                assignIds, rows = copyCourse(sourceConn, targetConn,
+                                             courseId)
+                directory.placeMany([('course', courseId)] +
+                                    [('assignment', assignId)
+                                     for assignId in assignIds], target)
+                for table, criterion in rows:
+                    if table is not Course.__table__:
+                        sourceConn.execute(table.delete().where(criterion))
+    finally:
+        targetConn.close()
+
+
+def runPeriodically(interval, job):
+    while True:
+        time.sleep(interval)
+        try:
+            job()
+        except Exception:
+            traceback.print_exc()
+
+
+class WatchLimiter(object):
+    """Counts the /watch requests each user has open."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.total = 0
+
+    def acquire(self, userName):
+        with self.lock:
+            count = self.counts.get(userName, 0)
+            if count >= WATCH_MAX_PER_USER or self.total >= WATCH_MAX_OPEN:
+                raise TooManyWatches()
+            self.counts[userName] = count + 1
+            self.total += 1
+
+    def release(self, userName):
+        with self.lock:
+            count = self.counts.pop(userName) - 1
+            if count > 0:
+                self.counts[userName] = count
+            self.total -= 1
+
+
+watchers = WatchLimiter()
+RESET_EVENT = {'type': 'reset'}
+
+
+def paramList(req, paramName):
+    return [item for item in (req.get_param(paramName) or '').split(',')
+            if item]
+
+
+def watchTopics(session, req, user):
+    """Return the bus topics a /watch request asks for, checking that
+    user may see each of them."""
+    topics = []
+    for projId in paramList(req, 'projId'):
+        project = session.query(Project).get(projId)
+        if project is None:
+            raise NoSuchProject()
+        if not (project.public or project.canRead(user)):
+            raise NotAuthorized()
+        topics.append('project:' + projId)
+    for assignId in paramList(req, 'assignId'):
+        assignment = session.query(Assignment).get(assignId)
+        if assignment is None:
+            raise NoSuchAssignment()
+        if not assignment.isTeacher(user):
+            raise NotAuthorized()
+        topics.append('assignment:' + assignId)
+    for courseId in paramList(req, 'courseId'):
+        course = session.query(Course).get(courseId)
+        if course is None:
+            raise NoSuchCourse()
+        if user not in course.teachers:
+            raise NotAuthorized()
+        topics.append('course:' + courseId)
+    if not topics:
+        raise UserLogicError('Nothing to watch.')
+    if len(topics) > WATCH_MAX_TOPICS:
+        raise UserLogicError('Too many things to watch.')
+    return topics
+
+
+def eventData(event):
+    data = dict(event.data)
+    data['id'] = event.eventId
+    return data
+
+
+def waitForEvents(subscription, timeout):
+    """Return the data of the events a long poll responds with."""
+    if subscription.missed:
+        return [RESET_EVENT]
+    events = list(subscription.backlog)
+    if not events:
+        event = subscription.get(timeout)
+        if event is not None:
+            events.append(event)
+    events.extend(subscription.drain())
+    data = [eventData(event) for event in events]
+    if subscription.overflowed:
+        data.append(RESET_EVENT)
+    return data
+
+
+def eventFrame(data):
+    """Format event data as a text/event-stream message."""
+    lines = []
+    if 'id' in data:
+        lines.append('id: {0}'.format(data['id']))
+    lines.append('event: ' + data['type'])
+    lines.append('data: ' + json.dumps(data, separators=(',', ':')))
+    return ('\n'.join(lines) + '\n\n').encode('utf-8')
+
+
+class WatchStream(object):
+    """The body of a text/event-stream /watch response."""
+
+    def __init__(self, subscription, release):
+        self.subscription = subscription
+        self.release = release
+        self.closed = False
+
+    def __iter__(self):
+        subscription = self.subscription
+        try:
+            yield b': connected\n\n'
+            if subscription.missed:
+                yield eventFrame(RESET_EVENT)
+            for event in subscription.backlog:
+                yield eventFrame(eventData(event))
+            deadline = time.time() + WATCH_MAX_DURATION
+            while not subscription.overflowed:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                event = subscription.get(min(WATCH_HEARTBEAT, remaining))
+                if event is None:
+                    yield b': heartbeat\n\n'
+                else:
+                    yield eventFrame(eventData(event))
+            if subscription.overflowed:
+                yield eventFrame(RESET_EVENT)
+        finally:
+            self.close()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.subscription.close()
+            self.release()
+
+
 # Handlers
 
 
@@ -617,6 +2939,7 @@ class AddStudent(RootHandler):
                 raise NotAuthorized()
             student = User.fromRequest(session, req)
             course.students.append(student)
+            publishRoster(session, course, student, 'student', 'add')
             respondXML(resp, falcon.HTTP_200, xmlSuccess())
 
 
@@ -631,9 +2954,56 @@ class AddTeacher(RootHandler):
                 raise NotAuthorized()
             teacher = User.fromRequest(session, req)
             course.teachers.append(teacher)
+            publishRoster(session, course, teacher, 'teacher', 'add')
             respondXML(resp, falcon.HTTP_200, xmlSuccess())
 
 
+class BeginUpload(RootHandler):
+
+    def on_get(self, req, resp):
+        with session_scope() as session:
+            user = auth(session, req, resp)
+            project = Project.fromRequest(session, req)
+            if user not in project.members:
+                raise NotAuthorized()
+            size = forceIntParam(req, 'size')
+            if size == 0:
+                raise UserLogicError('Project is empty.')
+            if size > projectxml.MAX_SIZE:
+                raise UserLogicError('Project is too large.')
+            checkQuota(session, project, size)
+            upload = Upload(uploadId=generateUploadId(),
+                            project=project,
+                            user=user,
+                            size=size,
+                            sharedName=req.get_param('sharedName'))
+            upload.touch()
+            session.add(upload)
+            respondXML(resp, falcon.HTTP_200,
+                       xmlSuccess({'uploadId': upload.uploadId}))
+
+
+class CacheStats(RootHandler):
+
+    def on_get(self, req, resp):
+        with session_scope() as session:
+            user = auth(session, req, resp)
+            if user.userName not in ADMINS:
+                raise NotAuthorized()
+        stats = responseCache.stats()
+        byName = stats.pop('byName')
+        caches = [dict(stats, name='responses'),
+                  dict(revisionCache.stats(), name='revisions'),
+                  dict(diffCache.stats(), name='diffs')]
+        for name in sorted(byName):
+            counts = byName[name]
+            lookups = counts['hits'] + counts['misses']
+            caches.append(dict(counts, name='responses.' + name,
+                               hitRate=float(counts['hits']) / lookups
+                               if lookups else 0.0))
+        respondList(req, resp, 'caches', caches, eltMaker('cache'))
+
+
 class ChangePassword(RootHandler):
 
     def on_get(self, req, resp):
@@ -645,17 +3015,48 @@ class ChangePassword(RootHandler):
             respondXML(resp, falcon.HTTP_200, xmlSuccess())
 
 
+class CommitUpload(RootHandler):
+
+    def on_get(self, req, resp):
+        with session_scope() as session:
+            user = auth(session, req, resp)
+            upload = Upload.fromRequest(session, req)
+            if user != upload.user or user not in upload.project.members:
+                raise NotAuthorized()
+            if not upload.isComplete():
+                raise UserLogicError('Upload is missing chunks.')
+            autosaves.flush(upload.projectId)
+            session.refresh(upload.project)
+            contents = upload.load()
+            checksum = req.get_param('checksum')
+            if checksum is not None and checksum != sha1hex(contents):
+                raise UserLogicError('Upload checksum does not match.')
+            document = readProject([contents])
+            checkQuota(session, upload.project, document.byteSize)
+            revision, created = commitRevision(session, upload.project,
+                                               document, upload.sharedName)
+            session.delete(upload)
+            respondXML(resp, falcon.HTTP_200,
+                       xmlSuccess({'revId': revision.revId}))
+            if created:
+                revision.save(session, document.contents)
+            upload.discard(session)
+
+
 class CreateAssignment(RootHandler):
 
     def on_get(self, req, resp):
         with session_scope() as session:
+            user = auth(session, req, resp)
             course = Course.fromRequest(session, req)
             name = forceParam(req, 'name')
             if user not in course.teachers:
                 raise NotAuthorized()
             assignId = generateAssignmentId()
-            assignment = Assignment(assignId=assignId, courseId=courseId,
+            assignment = Assignment(assignId=assignId, course=[course],
                                     name=name)
+            session.add(assignment)
+            bumpAfterCommit(session, ('assignments', course.courseId))
             success = Elt('success', {'assignId': assignId})
             respondXML(resp, falcon.HTTP_200, formatXML(success))
 
@@ -669,6 +3070,7 @@ class CreateCourse(RootHandler):
             courseId = generateCourseId()
             course = Course(courseId=courseId, name=name, teachers=[user])
             session.add(course)
+            bumpAfterCommit(session, ('courses', user.userName))
             el = Elt('success', {'courseId': courseId})
             respondXML(resp, falcon.HTTP_200, formatXML(el))
 
@@ -681,6 +3083,7 @@ class CreateProject(RootHandler):
             projId = generateProjId()
             proj = Project(projId=projId, owners=[user])
             proj.members.append(user)
+            proj.touch()
             session.add(proj)
             el = Elt('success', {'projId': projId})
             respondXML(resp, falcon.HTTP_200, formatXML(el))
@@ -719,6 +3122,40 @@ class CreateUser(RootHandler):
                 send_initial_email(user, password)
 
 
+class DiffRevisions(RootHandler):
+
+    def on_get(self, req, resp):
+        with session_scope() as session:
+            user = auth(session, req, resp)
+            project = None
+            if req.get_param('projId') is not None:
+                project = Project.fromRequest(session, req)
+            old = Revision.fromRequest(session, req, 'fromRevId')
+            new = Revision.fromRequest(session, req, 'toRevId')
+            for revision in (old, new):
+                if not canReadRevision(session, user, revision, project):
+                    raise NotAuthorized()
+            key = (old.revId, new.revId)
+            body = diffCache.get(key)
+            changed = old.contentHash is None or \
+                old.contentHash != new.contentHash
+            if body is None and changed:
+                loads = [old.prefetch(), new.prefetch()]
+            if body is None:
+                success = Elt('success', {'fromRevId': old.revId,
+                                          'toRevId': new.revId})
+                if changed:
+                    with tracer.span('storage.wait'):
+                        oldXML, newXML = [
+                            compression.inflate(load.result())
+                            for load in loads]
+                    for change in snapdiff.diff(oldXML, newXML):
+                        success.appendChild(Elt('change', change.attrib()))
+                body = formatXML(success)
+                diffCache.put(key, body)
+            respondXML(resp, falcon.HTTP_200, body)
+
+
 class Enroll(RootHandler):
 
     def on_get(self, req, resp):
@@ -726,23 +3163,109 @@ class Enroll(RootHandler):
             user = auth(session, req, resp)
             course = Course.fromRequest(session, req)
             course.students.append(user)
+            publishRoster(session, course, user, 'student', 'add')
             respondXML(resp, falcon.HTTP_200, xmlSuccess())
 
 
+class ExportSubmissions(RootHandler):
+
+    def on_get(self, req, resp):
+        with session_scope() as session:
+            user = auth(session, req, resp)
+            assignment = Assignment.fromRequest(session, req)
+            if not assignment.isTeacher(user):
+                raise NotAuthorized()
+            manifest = Elt('submissions', {'assignId': assignment.assignId,
+                                           'name': assignment.name})
+            files = []
+            submissions = onShard(session.query(Submission),
+                                  getattr(assignment, '_shard', None)) \
+                .with_parent(assignment, 'submissions') \
+                .options(joinedload(Submission.revision),
+                         joinedload(Submission.submitter),
+                         subqueryload(Submission.members))
+            for submission in submissions:
+                if submission.revision is None:
+                    continue
+                name = 'submissions/{0}-{1}.xml'.format(
+                    submission.submitterName, submission.submitId)
+                el = Elt('submission', {'submitId': submission.submitId,
+                                        'revId': submission.revisionId,
+                                        'projId': submission.projectId,
+                                        'file': name,
+                                        'time': submission.time.isoformat()})
+                el.appendChild(Elt('submitter').append(
+                    submission.submitter.toXMLName()))
+                for member in submission.members:
+                    el.appendChild(Elt('member').append(member.toXMLName()))
+                manifest.appendChild(el)
+                session.expunge(submission.revision)
+                files.append((name, submission.revision, submission.time))
+            resp.status = falcon.HTTP_200
+            resp.content_type = 'application/zip'
+            resp.set_header('Content-Disposition',
+                            'attachment; filename="{0}.zip"'.format(
+                                assignment.assignId))
+            resp.stream = exportArchive(formatXML(manifest), files)
+
+
+class ForkProject(RootHandler):
+
+    def on_get(self, req, resp):
+        with session_scope() as session:
+            user = auth(session, req, resp)
+            source = Project.fromRequest(session, req)
+            if not (source.public or source.canRead(user)):
+                raise NotAuthorized()
+            sharedName = req.get_param('sharedName') or source.sharedName
+            courseId = req.get_param('courseId')
+            if courseId is None:
+                recipients = [user]
+            else:
+                course = Course.fromRequest(session, req)
+                if user not in course.teachers:
+                    raise NotAuthorized()
+                recipients = course.students
+            success = Elt('success')
+            for recipient in recipients:
+                projId = generateProjId()
+                proj = Project(projId=projId, owners=[recipient],
+                               members=[recipient], head=source.head,
+                               sharedName=sharedName)
+                proj.touch()
+                session.add(proj)
+                reindexAfterCommit(session, projId)
+                success.appendChild(Elt('project', {
+                    'projId': projId,
+                    'userName': recipient.userName}))
+            respondXML(resp, falcon.HTTP_200, formatXML(success))
+
+
+class FlushProject(RootHandler):
+
+    def on_get(self, req, resp):
+        with session_scope() as session:
+            user = auth(session, req, resp)
+            project = Project.fromRequest(session, req)
+            if user not in project.members:
+                raise NotAuthorized()
+            projId = project.projId
+        autosaves.flush(projId)
+        respondXML(resp, falcon.HTTP_200, xmlSuccess())
+
+
 class GetProjectByName(RootHandler):
 
     def on_get(self, req, resp):
         with session_scope() as session:
             user = User.fromRequest(session, req)
             projectName = forceParam(req, 'projectName')
-            projects = session.query(Project) \
-                              .filter(Project.members.contains(user)) \
-                              .filter(Project.sharedName == projectName) \
-                              .all()
-            success = Elt('success')
-            for proj in projects:
-                success.appendChild(proj.toXML(req))
-            respondXML(resp, falcon.HTTP_200, formatXML(success))
+            projects = listingQuery(session) \
+                .filter(Project.members.contains(user)) \
+                .filter(Project.sharedName == projectName) \
+                .all()
+            respondList(req, resp, 'projects',
+                        [proj.toData(req) for proj in projects], projectXML)
 
 
 class GetRevision(RootHandler):
@@ -750,24 +3273,32 @@ class GetRevision(RootHandler):
     def on_get(self, req, resp):
         with session_scope() as session:
             user = auth(session, req, resp)
+            pending = autosaves.lookup(req.get_param('revId'))
+            if pending is not None:
+                segments = [compression.compress_segment(pending.contents)]
+                respondRevision(req, resp, pending.revision(), segments)
+                return
             revision = Revision.fromRequest(session, req)
-            success = Elt('success')
-            success.appendChild(revision.toXML())
-            respondXML(resp, falcon.HTTP_200, formatXML(success))
+            respondRevision(req, resp, revision)
 
 
 class ListAssignments(RootHandler):
 
     def on_get(self, req, resp):
+        courseId = forceParam(req, 'courseId')
+        respondCached(req, resp, ('listAssignments', courseId),
+                      [('assignments', courseId)],
+                      lambda: self.respond(req, resp))
+
+    def respond(self, req, resp):
         with session_scope() as session:
             course = Course.fromRequest(session, req)
             assigns = session.query(Assignment) \
-                             .filter(Assignment.course == course) \
+                             .filter(Assignment.course.contains(course)) \
                              .all()
-            success = Elt('success')
-            for assign in assigns:
-                success.appendChild(assign.toXMLId())
-            respondXML(resp, falcon.HTTP_200, formatXML(success))
+            respondList(req, resp, 'assignments',
+                        [assign.toData() for assign in assigns],
+                        eltMaker('assignment'))
 
 
 class ListCoursesEnrolled(RootHandler):
@@ -775,21 +3306,30 @@ class ListCoursesEnrolled(RootHandler):
     def on_get(self, req, resp):
         with session_scope() as session:
             user = auth(session, req, resp)
-            success = Elt('success')
-            for course in user.coursesTaking:
-                success.appendChild(course.toXMLId())
-            respondXML(resp, falcon.HTTP_200, formatXML(success))
+            respondCached(req, resp, ('listCoursesEnrolled', user.userName),
+                          [('courses', user.userName)],
+                          lambda: respondList(
+                              req, resp, 'courses',
+                              [course.toData()
+                               for course in user.coursesTaking],
+                              eltMaker('course')))
 
 
 class ListCoursesTeaching(RootHandler):
 
     def on_get(self, req, resp):
+        userName = forceParam(req, 'userName')
+        respondCached(req, resp, ('listCoursesTeaching', userName),
+                      [('courses', userName)],
+                      lambda: self.respond(req, resp))
+
+    def respond(self, req, resp):
         with session_scope() as session:
             teacher = User.fromRequest(session, req)
-            success = Elt('success')
-            for course in teacher.coursesTeaching:
-                success.appendChild(course.toXMLId())
-            respondXML(resp, falcon.HTTP_200, formatXML(success))
+            respondList(req, resp, 'courses',
+                        [course.toData()
+                         for course in teacher.coursesTeaching],
+                        eltMaker('course'))
 
 
 class ListMembers(RootHandler):
@@ -800,10 +3340,9 @@ class ListMembers(RootHandler):
             project = Project.fromRequest(session, req)
             if user not in project.members:
                 raise NotAuthorized()
-            success = Elt('success')
-            for member in project.members:
-                success.appendChild(member.toXMLName())
-            respondXML(resp, falcon.HTTP_200, formatXML(success))
+            respondList(req, resp, 'members',
+                        [member.toData() for member in project.members],
+                        eltMaker('user'))
 
 
 class ListProjects(RootHandler):
@@ -811,13 +3350,11 @@ class ListProjects(RootHandler):
     def on_get(self, req, resp):
         with session_scope() as session:
             user = auth(session, req, resp)
-            projects = session.query(Project) \
-                              .filter(Project.members.contains(user)) \
-                              .all()
-            success = Elt('success')
-            for proj in projects:
-                success.appendChild(proj.toXML(req))
-            respondXML(resp, falcon.HTTP_200, formatXML(success))
+            projects = listingQuery(session) \
+                .filter(Project.members.contains(user)) \
+                .all()
+            respondList(req, resp, 'projects',
+                        [proj.toData(req) for proj in projects], projectXML)
 
 
 class ListStudents(RootHandler):
@@ -828,10 +3365,9 @@ class ListStudents(RootHandler):
             course = Course.fromRequest(session, req)
             if user not in course.teachers:
                 raise NotAuthorized()
-            success = Elt('success')
-            for student in course.students:
-                success.appendChild(student.toXMLName())
-            respondXML(resp, falcon.HTTP_200, xmlSuccess())
+            respondList(req, resp, 'students',
+                        [student.toData() for student in course.students],
+                        eltMaker('user'))
 
 
 class ListSubmissions(RootHandler):
@@ -840,23 +3376,72 @@ class ListSubmissions(RootHandler):
         with session_scope() as session:
             user = auth(session, req, resp)
             assignment = Assignment.fromRequest(session, req)
-            if user not in assignment.course.teachers:
+            if not assignment.isTeacher(user):
                 raise NotAuthorized()
-            success = Elt('success')
-            for submission in assignment.submissions:
-                success.appendChild(submission.toShortXML())
-            respondXML(resp, falcon.HTTP_200, formatXML(success))
+            respondList(req, resp, 'submissions',
+                        [submission.toShortData()
+                         for submission in assignment.submissions],
+                        eltMaker('submission'))
 
 
 class ListTeachers(RootHandler):
 
     def on_get(self, req, resp):
+        courseId = forceParam(req, 'courseId')
+        respondCached(req, resp, ('listTeachers', courseId),
+                      [('roster', courseId)],
+                      lambda: self.respond(req, resp))
+
+    def respond(self, req, resp):
         with session_scope() as session:
             course = Course.fromRequest(session, req)
-            success = Elt('success')
-            for teacher in course.teachers:
-                success.appendChild(teacher.toXMLName())
-            respondXML(resp, falcon.HTTP_200, formatXML(success))
+            respondList(req, resp, 'teachers',
+                        [teacher.toData() for teacher in course.teachers],
+                        eltMaker('user'))
+
+
+class ListPublicProjects(RootHandler):
+
+    def on_get(self, req, resp):
+        cursor = req.get_param('cursor')
+        page = galleryCache.page if cursor is None else None
+        if page is None:
+            generation = galleryCache.generation
+            with session_scope() as session:
+                page = publicProjectsPage(session, cursor)
+            if cursor is None and generation == galleryCache.generation:
+                galleryCache.page = page
+        entries, nextCursor = page
+        respondList(req, resp, 'projects',
+                    [publicProjectData(req, entry) for entry in entries],
+                    publicProjectXML, {'cursor': nextCursor})
+
+
+class ListStorageUsage(RootHandler):
+
+    def on_get(self, req, resp):
+        with session_scope() as session:
+            user = auth(session, req, resp)
+            if user.userName not in ADMINS:
+                raise NotAuthorized()
+            limit = USAGE_LIST_SIZE
+            if req.get_param('limit') is not None:
+                limit = forceIntParam(req, 'limit')
+            query = session.query(Usage.kind, Usage.name, Usage.bytes)
+            kind = req.get_param('kind')
+            if kind is not None:
+                query = query.filter(Usage.kind == kind)
+            # With shards, a counter is split between those holding the
+            # projects and submissions it counts.
+            totals = {}
+            for row in query.order_by(Usage.bytes.desc()).limit(limit):
+                key = (row.kind, row.name)
+                totals[key] = totals.get(key, 0) + (row.bytes or 0)
+            usages = sorted(totals.items(), key=lambda item: -item[1])
+            respondList(req, resp, 'usage',
+                        [{'kind': key[0], 'name': key[1], 'bytes': size}
+                         for key, size in usages[:limit]],
+                        eltMaker('usage'))
 
 
 class LoadProject(RootHandler):
@@ -869,7 +3454,23 @@ class LoadProject(RootHandler):
                 raise NotAuthorized()
             success = Elt('success')
             success.appendChild(project.toXML(req))
-            respondXML(resp, falcon.HTTP_200, formatXML(success))
+            pending = autosaves.get(project.projId)
+            if pending is not None:
+                revision = pending.revision()
+                segments = [compression.compress_segment(pending.contents)]
+            else:
+                revision = project.head
+                segments = None
+            if revision is None:
+                respondXML(resp, falcon.HTTP_200, formatXML(success))
+            elif req.get_param('includeRevision') == '1':
+                success.appendChild(revision.toXMLStub())
+                respondRevision(req, resp, revision, segments,
+                                splitAtData(success))
+            else:
+                if pending is None:
+                    warmRevision(revision)
+                respondXML(resp, falcon.HTTP_200, formatXML(success))
 
 
 class MakePublic(RootHandler):
@@ -881,6 +3482,9 @@ class MakePublic(RootHandler):
             if user not in project.members:
                 raise NotAuthorized()
             project.public = True
+            if project.updated is None:
+                project.touch()
+            invalidateGallery(session, project)
             respondXML(resp, falcon.HTTP_200, xmlSuccess())
 
 
@@ -897,6 +3501,7 @@ class RemoveStudent(RootHandler):
                 course.students.remove(student)
             except ValueError:
                 raise UserLogicError('User is not taking this course.')
+            publishRoster(session, course, student, 'student', 'remove')
             respondXML(resp, falcon.HTTP_200, xmlSuccess())
 
 
@@ -915,6 +3520,7 @@ class RemoveTeacher(RootHandler):
                 course.teachers.remove(teacher)
             except ValueError:
                 raise UserLogicError('User is not teaching this course.')
+            publishRoster(session, course, teacher, 'teacher', 'remove')
             respondXML(resp, falcon.HTTP_200, xmlSuccess())
 
 
@@ -935,30 +3541,51 @@ class ResetPassword(RootHandler):
 class SaveProject(RootHandler):
 
     def on_post(self, req, resp):
+        autosave = AUTOSAVE_WINDOW > 0 and req.get_param('autosave') == '1'
+        projId = req.get_param('projId')
+        sharedName = req.get_param('sharedName')
         with session_scope() as session:
             user = auth(session, req, resp)
             project = Project.fromRequest(session, req)
             if user not in project.members:
                 raise NotAuthorized()
-            contents = req.stream.read()
-            prevId = formatHash(0)
-            sharedName = req.get_param('sharedName')
-            if sharedName is not None:
-                project.sharedName = sharedName
-            if project.head is not None:
-                prevId = project.head.revId
-            sha1 = hashlib.sha1()
-            sha1.update(prevId)
-            sha1.update(contents)
-            revId = sha1.hexdigest()
-            revision, created = get_or_create(session, Revision, revId=revId,
-                                              prevId=prevId)
-            project.head = revision
-            session.add(project)
-            session.add(revision)
-            respondXML(resp, falcon.HTTP_200, xmlSuccess({'revId': revId}))
-            if created:
-                revision.save(contents)
+            document = readProject(projectxml.readChunks(req.stream))
+            checkQuota(session, project, document.byteSize)
+            if autosave:
+                revId = autosaves.save(project, document, sharedName)
+            else:
+                staged = StagedContents(document.contents)
+                staged.write(session)
+        if not autosave:
+            autosaves.flush(projId)
+
+            # Only the rows are written in the batch; see StagedContents.
+            def save(session):
+                project = Project.fromRequest(session, req)
+                revision, created = commitRevision(session, project,
+                                                   document, sharedName)
+                if created:
+                    revision.addContent(session, staged)
+                return revision.revId
+            try:
+                revId = writes.run(save, shardOf('project', projId))
+            except Exception:
+                staged.discard()
+                raise
+        respondXML(resp, falcon.HTTP_200, xmlSuccess({'revId': revId}))
+
+
+class SearchProjectsHandler(RootHandler):
+
+    def on_get(self, req, resp):
+        if not searchAvailable:
+            raise UserLogicError('Search is not available.')
+        with session_scope() as session:
+            user = auth(session, req, resp)
+            query = ftsQuery(forceParam(req, 'query'))
+            found = [project.toData(req)
+                     for project in searchProjects(session, query, user)]
+            respondList(req, resp, 'projects', found, projectXML)
 
 
 class ShareProject(RootHandler):
@@ -1007,34 +3634,97 @@ class ShareProjectWithTeachers(RootHandler):
 class SubmitProject(RootHandler):
 
     def on_get(self, req, resp):
+        # Pending autosaves are committed first, once the user is known to
+        # be allowed to; the unit can't, as they need the write lock.
         with session_scope() as session:
+            user = auth(session, req, resp)
+            project = Project.fromRequest(session, req)
+            if user not in project.members:
+                raise NotAuthorized()
+            projId = project.projId
+        autosaves.flush(projId)
+
+        def submit(session):
             user = auth(session, req, resp)
             assignment = Assignment.fromRequest(session, req)
             project = Project.fromRequest(session, req)
             if user not in project.members:
                 raise NotAuthorized()
-            if user not in assignment.course.students:
+            if not assignment.isStudent(user):
                 raise UserLogicError('User not enrolled in '
                                      'the class for this assignment')
+            if project.head is not None:
+                checkCourseQuota(session, assignment,
+                                 project.head.byteSize or 0)
             submission = Submission()
             submission.submitId = generateSubmissionId()
-            submission.assignment = assignment
+            submission.assignment = [assignment]
             submission.revision = project.head
             submission.project = project
-            submission.members = project.members
+            submission.members = list(project.members)
             submission.submitter = user
             submission.time = datetime.datetime.utcnow()
             session.add(submission)
+            chargeSubmission(session, submission)
+            publishAfterCommit(session, 'assignment:' + assignment.assignId,
+                               {'type': 'submission',
+                                'assignId': assignment.assignId,
+                                'submitId': submission.submitId,
+                                'projId': project.projId,
+                                'userName': user.userName})
+            return submission.submitId
+        submitId = writes.run(submit, shardOf('assignment',
+                                              req.get_param('assignId')))
+        respondXML(resp, falcon.HTTP_200, xmlSuccess({'submitId': submitId}))
+
+
+class UploadChunkHandler(RootHandler):
+
+    def on_post(self, req, resp):
+        with session_scope() as session:
+            user = auth(session, req, resp)
+            upload = Upload.fromRequest(session, req)
+            if user != upload.user:
+                raise NotAuthorized()
+            offset = forceIntParam(req, 'offset')
+            checksum = forceParam(req, 'checksum')
+            data = req.stream.read()
+            if sha1hex(data) != checksum:
+                raise UserLogicError('Chunk checksum does not match.')
+            if offset + len(data) > upload.size:
+                raise UserLogicError('Chunk extends past the end of upload.')
+            upload.writeChunk(offset, data)
+            session.merge(UploadChunk(uploadId=upload.uploadId,
+                                      offset=offset,
+                                      length=len(data),
+                                      checksum=checksum))
+            upload.touch()
             respondXML(resp, falcon.HTTP_200, xmlSuccess())
 
 
+class UploadStatus(RootHandler):
+
+    def on_get(self, req, resp):
+        with session_scope() as session:
+            user = auth(session, req, resp)
+            upload = Upload.fromRequest(session, req)
+            if user != upload.user:
+                raise NotAuthorized()
+            success = Elt('success')
+            success.appendChild(upload.toXML())
+            respondXML(resp, falcon.HTTP_200, formatXML(success))
+
+
 class UnCreateAssignment(RootHandler):
 
     def on_get(self, req, resp):
         with session_scope() as session:
-            assignment = Assigment.fromRequest(session, req)
-            if user not in assignment.course.teachers:
+            user = auth(session, req, resp)
+            assignment = Assignment.fromRequest(session, req)
+            if not assignment.isTeacher(user):
                 raise NotAuthorized()
+            bumpAfterCommit(session, *[('assignments', course.courseId)
+                                       for course in assignment.course])
             session.delete(assignment)
             respondXML(resp, falcon.HTTP_200, xmlSuccess())
 
@@ -1047,6 +3737,9 @@ class UnCreateProject(RootHandler):
             project = Project.fromRequest(session, req)
             if user not in project.owners:
                 raise NotAuthorized()
+            invalidateGallery(session, project)
+            reindexAfterCommit(session, project.projId)
+            releaseProject(session, project)
             session.delete(project)
             respondXML(resp, falcon.HTTP_200, xmlSuccess())
 
@@ -1061,6 +3754,7 @@ class UnEnroll(RootHandler):
                 course.students.remove(user)
             except ValueError:
                 raise UserLogicError('User is not taking this course.')
+            publishRoster(session, course, user, 'student', 'remove')
             respondXML(resp, falcon.HTTP_200, xmlSuccess())
 
 
@@ -1072,6 +3766,7 @@ class UnMakePublic(RootHandler):
             project = Project.fromRequest(session, req)
             if user not in project.members:
                 raise NotAuthorized()
+            invalidateGallery(session, project)
             project.public = False
             respondXML(resp, falcon.HTTP_200, xmlSuccess())
 
@@ -1123,6 +3818,44 @@ class UnShareProjectWithTeachers(RootHandler):
             respondXML(resp, falcon.HTTP_200, xmlSuccess())
 
 
+class Watch(RootHandler):
+
+    def on_get(self, req, resp):
+        with session_scope() as session:
+            user = auth(session, req, resp)
+            userName = user.userName
+            topics = watchTopics(session, req, user)
+        since = req.get_param('since') or req.get_header('Last-Event-ID')
+        if since is not None:
+            try:
+                since = int(since)
+            except ValueError:
+                raise UserLogicError('since must be an integer.')
+        types = compression.parse_accept_encoding(req.get_header('Accept'))
+        watchers.acquire(userName)
+        try:
+            subscription = bus.subscribe(topics, since)
+        except Exception:
+            watchers.release(userName)
+            raise
+
+        def release():
+            watchers.release(userName)
+        if types.get('text/event-stream', 0) > 0:
+            resp.status = falcon.HTTP_200
+            resp.content_type = 'text/event-stream'
+            resp.set_header('Cache-Control', 'no-cache')
+            resp.stream = WatchStream(subscription, release)
+            return
+        try:
+            events = waitForEvents(subscription, WATCH_TIMEOUT)
+        finally:
+            subscription.close()
+            release()
+        respondList(req, resp, 'events', events, eltMaker('event'),
+                    {'lastEventId': subscription.lastId})
+
+
 class NoMethod(RootHandler):
 
     def on_get(self, req, resp):
@@ -1141,22 +3874,153 @@ def raise_unknown_url(req, resp):
     raise UnknownURL()
 
 
+def compress_response(req, resp):
+    body = resp.body_encoded if resp.body is not None else resp.data
+    if body is None or len(body) < COMPRESS_MIN_SIZE:
+        return
+    addVary(resp, 'Accept-Encoding')
+    coding = compression.choose_encoding(req.get_header('Accept-Encoding'))
+    if coding is None:
+        return
+    resp.body = None
+    with tracer.span('serialize.compress', coding=coding):
+        resp.data = compression.compress(body, coding)
+    resp.set_header('Content-Encoding', coding)
+
+
 def set_access_control(req, resp, params):
     resp.set_header('Access-Control-Allow-Origin', '*')
     resp.set_header('Access-Control-Allow-Headers',
-                    'Snap-Server-Authorization, Authorization')
+                    'Snap-Server-Authorization, Authorization, ' +
+                    tracing.TRACE_HEADER)
+    resp.set_header('Access-Control-Expose-Headers', tracing.TRACE_HEADER)
     resp.set_header('Access-Control-Allow-Methods', 'GET, POST')
     resp.set_header('Allow', 'GET, POST')
 
 
-sql_engine = sqlengine.create_engine('sqlite:///snap.sqlite', echo=False)
+def disable_pysqlite_transactions(dbapi_connection, connection_record):
+    dbapi_connection.isolation_level = None
+
+
+def begin_immediate(conn):
+    conn.execute('BEGIN IMMEDIATE')
+
+
+def createAutocommitEngine(url):
+    """Return an engine whose connections leave transactions to the
+    statements run on them. Savepoints need this, as pysqlite's own
+    transaction handling breaks them."""
+    engine = sqlengine.create_engine(url, echo=False)
+    sqlalchemy.event.listen(engine, 'connect', disable_pysqlite_transactions)
+    return engine
+
+
+def migrate(engine):
+    """Add the columns and indexes that tables made by an older version of
+    the server lack, as create_all only creates missing tables. The write
+    lock keeps servers starting together from adding them twice."""
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            columns = set(row[1] for row in conn.execute(
+                'PRAGMA table_info("{0}")'.format(table.name)))
+            for column in table.columns:
+                if column.name not in columns:
+                    conn.execute('ALTER TABLE "{0}" ADD COLUMN {1}'.format(
+                        table.name, sqlalchemy.schema.CreateColumn(column)
+                        .compile(dialect=engine.dialect)))
+            indexes = set(name for name, in conn.execute(
+                "SELECT name FROM sqlite_master "
+                "WHERE type = 'index' AND tbl_name = ?", table.name))
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(conn)
+
+
+def createEngines(url):
+    """Return the engine for reading url and the one for group commits,
+    which takes the write lock when it begins."""
+    engine = sqlengine.create_engine(url, echo=False)
+    writeEngine = createAutocommitEngine(url)
+    sqlalchemy.event.listen(writeEngine, 'begin', begin_immediate)
+    tracer.instrument(engine)
+    tracer.instrument(writeEngine)
+    Base.metadata.create_all(engine)
+    migrate(writeEngine)
+    try:
+        engine.execute('CREATE VIRTUAL TABLE IF NOT EXISTS project_search '
+                       'USING fts5(sharedName, owners, content)')
+        return engine, writeEngine, True
+    except sqlalchemy.exc.OperationalError:
+        return engine, writeEngine, False
+
+
+if SHARDS:
+    shardEngines = {}
+    shardWriteEngines = {}
+    # Group commits read the other shards through these, without holding
+    # them locked.
+    shardPeekEngines = {}
+    for shard, url in zip(SHARD_IDS, SHARDS):
+        shardEngines[shard], shardWriteEngines[shard], searchAvailable = \
+            createEngines(url)
+        shardPeekEngines[shard] = createAutocommitEngine(url)
+    sql_engine = shardEngines[0]
+    write_engine = shardWriteEngines[0]
+    Session = sessionmaker(class_=RoutedSession, shards=shardEngines)
+else:
+    sql_engine, write_engine, searchAvailable = \
+        createEngines('sqlite:///snap.sqlite')
+    Session = sessionmaker(bind=sql_engine)
 sql_connection = sql_engine.connect()
-Session = sessionmaker(bind=sql_engine)
+WriteSession = sessionmaker(bind=write_engine)
+
+
+def newWriteSession(shard=None):
+    """Return a session for a group commit to shard, which reads the
+    other shards without taking their write locks."""
+    if shard is None:
+        return WriteSession()
+    engines = dict(shardPeekEngines)
+    engines[shard] = shardWriteEngines[shard]
+    session = RoutedSession(shards=engines)
+    session.info['shard'] = shard
+    return session
+
+
+@contextmanager
+def write_scope(shard=None):
+    """Provide a transactional scope that holds the write lock of shard,
+    or of the database, from its first statement."""
+    session = newWriteSession(shard)
+    try:
+        yield session
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
 
-Base.metadata.create_all(sql_engine)
+class API(falcon.API):
+    """falcon.API with each request traced by tracer. routes lists the
+    URI templates added to it, in order."""
 
-app = falcon.API(before=[set_access_control],
-                 media_type='application/xml; charset=utf-8')
+    def __init__(self, *args, **kwargs):
+        super(API, self).__init__(*args, **kwargs)
+        self.routes = []
+
+    def add_route(self, uri_template, resource, *args, **kwargs):
+        super(API, self).add_route(uri_template, resource, *args, **kwargs)
+        self.routes.append(uri_template)
+
+    def __call__(self, env, start_response):
+        return tracer.wsgi(super(API, self).__call__, env, start_response)
+
+
+app = API(before=[set_access_control],
+          after=[compress_response],
+          media_type='application/xml; charset=utf-8')
 
 app.add_sink(raise_unknown_url)
 app.add_route('/', NoMethod())
@@ -1164,12 +4028,19 @@ app.add_route('/{method}', UnknownMethod())
 
 app.add_route('/addStudent', AddStudent())
 app.add_route('/addTeacher', AddTeacher())
+app.add_route('/beginUpload', BeginUpload())
+app.add_route('/cacheStats', CacheStats())
 app.add_route('/changePassword', ChangePassword())
+app.add_route('/commitUpload', CommitUpload())
 app.add_route('/createAssignment', CreateAssignment())
 app.add_route('/createCourse', CreateCourse())
 app.add_route('/createProject', CreateProject())
 app.add_route('/createUser', CreateUser())
+app.add_route('/diffRevisions', DiffRevisions())
 app.add_route('/enroll', Enroll())
+app.add_route('/exportSubmissions', ExportSubmissions())
+app.add_route('/flushProject', FlushProject())
+app.add_route('/forkProject', ForkProject())
 app.add_route('/getProjectByName', GetProjectByName())
 app.add_route('/getRevision', GetRevision())
 app.add_route('/listAssignments', ListAssignments())
@@ -1180,12 +4051,15 @@ app.add_route('/listProjects', ListProjects())
 app.add_route('/listStudents', ListStudents())
 app.add_route('/listSubmissions', ListSubmissions())
 app.add_route('/listTeachers', ListTeachers())
+app.add_route('/listPublicProjects', ListPublicProjects())
+app.add_route('/listStorageUsage', ListStorageUsage())
 app.add_route('/loadProject', LoadProject())
 app.add_route('/makePublic', MakePublic())
 app.add_route('/removeStudent', RemoveStudent())
 app.add_route('/removeTeacher', RemoveTeacher())
 app.add_route('/resetPassword', ResetPassword())
 app.add_route('/saveProject', SaveProject())
+app.add_route('/searchProjects', SearchProjectsHandler())
 app.add_route('/shareProject', ShareProject())
 app.add_route('/shareProjectWithStudents', ShareProjectWithStudents())
 app.add_route('/shareProjectWithTeachers', ShareProjectWithTeachers())
@@ -1197,19 +4071,33 @@ app.add_route('/unmakePublic', UnMakePublic())
 app.add_route('/unshareProject', UnShareProject())
 app.add_route('/unshareProjectWithStudents', UnShareProjectWithStudents())
 app.add_route('/unshareProjectWithTeachers', UnShareProjectWithTeachers())
+app.add_route('/uploadChunk', UploadChunkHandler())
+app.add_route('/uploadStatus', UploadStatus())
+app.add_route('/watch', Watch())
 
 app.add_error_handler(Exception, handle_exception)
 app.add_error_handler(ServerException, ServerException.handle_callback)
 
 
 def main():
+    for interval, job in ((TIERING_INTERVAL, runTiering),
+                          (RECONCILE_INTERVAL, reconcileAllUsage),
+                          (EXPIRE_UPLOADS_INTERVAL, expireAllUploads)):
+        if interval > 0:
+            thread = threading.Thread(target=runPeriodically,
+                                      args=(interval, job))
+            thread.daemon = True
+            thread.start()
     try:
         import gevent.wsgi
         http = gevent.wsgi.WSGIServer(('', 5000), app)
     except ImportError:
         import wsgiref.simple_server
         http = wsgiref.simple_server.WSGIServer(('', 5000), app)
-    http.serve_forever()
+    try:
+        http.serve_forever()
+    finally:
+        autosaves.flushAll()
 
 
 if __name__ == '__main__':
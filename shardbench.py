@@ -0,0 +1,150 @@
+#!/usr/bin/env python2
+"""Measure how many saves a second several server processes can commit,
+with one database and with the data spread over several shards.
+
+Each configuration runs in a scratch directory. Every worker process
+signs up its own user, placed in shard worker % shards, and then saves
+its project as fast as it can for the same few seconds as the others:
+
+    python shardbench.py [--workers N] [--seconds N]
+                         [--commit-latency SECONDS] [shards ...]
+
+A shard count of 1 means a single unsharded snap.sqlite. The default is
+4 workers for 5 seconds, with 1, 2 and 4 shards.
+
+Sharding only helps writes that wait on a database's write lock. SQLite
+holds that lock until a commit is on disk, so on a disk that takes a
+while to sync, commits to one database queue up behind each other while
+the CPUs sit idle, and each shard adds a lock of its own. --commit-latency
+makes every commit hold its lock that much longer, as such a disk would,
+0.05 seconds by default; with 0, the saves are bound by the CPU, and on a
+machine with fewer CPUs than workers sharding only adds its own overhead.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import querybudget
+
+
+PASSWORD = 'secret'
+
+
+def slowCommits(server, latency):
+    """Make every commit to the server's databases hold the write lock
+    latency seconds longer."""
+    import sqlalchemy.event
+    engines = set([server.sql_engine, server.write_engine])
+    if server.SHARDS:
+        engines.update(server.shardEngines.values())
+        engines.update(server.shardWriteEngines.values())
+    for engine in engines:
+        sqlalchemy.event.listen(engine, 'commit',
+                                lambda conn: time.sleep(latency))
+
+
+def worker(index, shards, seconds, latency):
+    sys.path.insert(0, querybudget.HERE)
+    import server
+    import re
+    if latency:
+        slowCommits(server, latency)
+    name = 'worker{0}'.format(index)
+    if server.directory is not None:
+        server.directory.place('user', name, index % shards)
+    user = (name, PASSWORD)
+    querybudget.request(server.app, '/createUser',
+                        'userName={0}&password={1}'.format(name, PASSWORD))
+    _, _, body = querybudget.request(server.app, '/createProject', user=user)
+    projId = re.search(b'projId="(\\w+)"', body).group(1).decode('ascii')
+    print('ready')
+    sys.stdout.flush()
+    sys.stdin.readline()
+    saves = failures = 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        contents = '<project name="p{0}"><stage name="S{1}"/></project>' \
+            .format(index, saves + failures)
+        status, _, _ = querybudget.request(
+            server.app, '/saveProject', 'projId=' + projId, body=contents,
+            method='POST', user=user)
+        if status.startswith('200'):
+            saves += 1
+        else:
+            failures += 1
+    server.searchIndexer.join()
+    print(saves, failures)
+    sys.stdout.flush()
+    # Skip the interpreter's shutdown, during which the server's daemon
+    # threads would print spurious errors.
+    os._exit(0)
+
+
+def run(workers, seconds, shards, latency):
+    """Return the saves and failed saves of all workers together."""
+    scratch = tempfile.mkdtemp(prefix='shardbench')
+    os.mkdir(os.path.join(scratch, 'storage'))
+    env = dict(os.environ)
+    env.pop('SNAP_SHARDS', None)
+    env.pop('SNAP_DIRECTORY', None)
+    if shards > 1:
+        env['SNAP_SHARDS'] = ','.join('sqlite:///shard{0}.sqlite'.format(i)
+                                      for i in range(shards))
+    procs = []
+    # Started one at a time, so that only one of them creates the schema.
+    for index in range(workers):
+        proc = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), '--worker',
+             str(index), str(shards), str(seconds), str(latency)],
+            cwd=scratch, env=env, stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, universal_newlines=True)
+        if proc.stdout.readline().strip() != 'ready':
+            raise RuntimeError('worker {0} did not start'.format(index))
+        procs.append(proc)
+    for proc in procs:
+        proc.stdin.write('go\n')
+        proc.stdin.flush()
+    saves = failures = 0
+    for proc in procs:
+        counts = proc.stdout.readline().split()
+        proc.wait()
+        saves += int(counts[0])
+        failures += int(counts[1])
+    return saves, failures
+
+
+def report(workers=4, seconds=5, configurations=(1, 2, 4), latency=0.05,
+           out=sys.stdout):
+    print('Commits hold the write lock {0}s longer'.format(latency),
+          file=out)
+    print('{0:>6} {1:>7} {2:>8} {3:>8} {4:>9}'.format(
+        'shards', 'workers', 'saves', 'failed', 'saves/s'), file=out)
+    for shards in configurations:
+        saves, failures = run(workers, seconds, shards, latency)
+        print('{0:>6} {1:>7} {2:>8} {3:>8} {4:>9.1f}'.format(
+            shards, workers, saves, failures, saves / float(seconds)),
+            file=out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--seconds', type=int, default=5)
+    parser.add_argument('--commit-latency', type=float, default=0.05)
+    parser.add_argument('shards', type=int, nargs='*', default=[1, 2, 4])
+    args = parser.parse_args(argv)
+    report(args.workers, args.seconds, args.shards, args.commit_latency)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--worker']:
+        worker(*[int(arg) for arg in sys.argv[2:5]] +
+               [float(sys.argv[5])])
+    else:
+        main()
@@ -0,0 +1,112 @@
+"""Place tenant data in several SQLite databases.
+
+Every shard is a database with the full schema. A small directory
+database records which shard each user, project, course, assignment and
+upload was placed in, so a request can go straight to the shard holding
+the object it names:
+
+    directory = Directory('sqlite:///directory.sqlite')
+    directory.place('course', courseId, 2)
+    directory.lookup('course', courseId)        # 2
+
+Ids the directory does not know, such as those of rows written before
+sharding was turned on, have to be looked for in every shard.
+"""
+
+from __future__ import print_function
+
+import hashlib
+
+import sqlalchemy
+from sqlalchemy import Column, Integer, String, Table, and_
+
+
+metadata = sqlalchemy.MetaData()
+
+placements = Table(
+    'placements', metadata,
+    Column('kind', String, primary_key=True),
+    Column('key', String, primary_key=True),
+    Column('shard', Integer, nullable=False, index=True)
+    )
+
+
+def hashShard(key, count):
+    """Return the shard key is placed in when nothing else decides."""
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return int(digest[:8], 16) % count
+
+
+class Directory(object):
+
+    def __init__(self, url):
+        self.engine = sqlalchemy.create_engine(url, echo=False)
+        metadata.create_all(self.engine)
+
+    def lookup(self, kind, key):
+        """Return the shard key was placed in, or None."""
+        return self.engine.execute(
+            sqlalchemy.select([placements.c.shard])
+            .where(and_(placements.c.kind == kind, placements.c.key == key))
+        ).scalar()
+
+    def place(self, kind, key, shard):
+        self.placeMany([(kind, key)], shard)
+
+    def placeMany(self, items, shard):
+        """Place each (kind, key) in items in shard, in one transaction."""
+        if not items:
+            return
+        with self.engine.begin() as conn:
+            conn.execute(placements.insert().prefix_with('OR REPLACE'),
+                         [{'kind': kind, 'key': key, 'shard': shard}
+                          for kind, key in items])
+
+    def counts(self):
+        """Return {shard: {kind: count}}."""
+        counts = {}
+        rows = self.engine.execute(
+            sqlalchemy.select([placements.c.shard, placements.c.kind,
+                               sqlalchemy.func.count()])
+            .group_by(placements.c.shard, placements.c.kind))
+        for shard, kind, count in rows:
+            counts.setdefault(shard, {})[kind] = count
+        return counts
+
+
+def rowsOf(conn, table, where):
+    return set(tuple(row) for row in conn.execute(table.select().where(where)))
+
+
+def rowMatches(table, row):
+    return and_(*[column == value for column, value in zip(table.c, row)])
+
+
+def syncRows(source, target, table, where):
+    """Make the rows of table matching where in target the same as those
+    in source; return how many rows were inserted and deleted."""
+    wanted = rowsOf(source, table, where)
+    present = rowsOf(target, table, where)
+    extra = present - wanted
+    missing = wanted - present
+    for row in extra:
+        target.execute(table.delete().where(rowMatches(table, row)))
+    if missing:
+        target.execute(table.insert(),
+                       [dict(zip(table.c.keys(), row)) for row in missing])
+    return len(missing), len(extra)
+
+
+def copyStubs(source, target, table, columns, keys):
+    """Copy columns of the rows of table whose first column is in keys to
+    target, leaving any rows it already has alone."""
+    keys = list(keys)
+    if not keys:
+        return
+    key = table.c[columns[0]]
+    rows = source.execute(
+        sqlalchemy.select([table.c[name] for name in columns])
+        .where(key.in_(keys))).fetchall()
+    if rows:
+        target.execute(table.insert().prefix_with('OR IGNORE'),
+                       [dict(zip(columns, row)) for row in rows])
@@ -0,0 +1,79 @@
+"""Collapse concurrent calls for the same key into one.
+
+The first caller for a key runs the function; callers that arrive while
+it is running wait for its result instead of repeating the work, and get
+its exception if it fails.
+"""
+
+from __future__ import print_function
+
+import threading
+
+
+class Timeout(RuntimeError):
+    pass
+
+
+class _Call(object):
+
+    __slots__ = ('done', 'result', 'error', 'waiters')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight(object):
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.leaders = 0
+        self.collapsed = 0
+        self.timeouts = 0
+        self.errors = 0
+
+    def run(self, key, fn, *args):
+        """Return fn(*args), sharing the call with concurrent callers for
+        key. Waiters raise Timeout after self.timeout seconds."""
+        with self.lock:
+            call = self.calls.get(key)
+            if call is None:
+                call = self.calls[key] = _Call()
+                leader = True
+                self.leaders += 1
+            else:
+                call.waiters += 1
+                leader = False
+                self.collapsed += 1
+        if not leader:
+            if not call.done.wait(self.timeout):
+                self.timeouts += 1
+                raise Timeout('Timed out waiting for {0!r}'.format(key))
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn(*args)
+            return call.result
+        except Exception as e:
+            call.error = e
+            self.errors += 1
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+    def inFlight(self, key):
+        return key in self.calls
+
+    def stats(self):
+        return {'inFlight': len(self.calls),
+                'leaders': self.leaders,
+                'collapsed': self.collapsed,
+                'timeouts': self.timeouts,
+                'errors': self.errors}
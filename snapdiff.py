@@ -0,0 +1,189 @@
+"""Structural diff of Snap! project XML.
+
+Every element is given a hash of its tag, attributes, text and children, in
+one pass over each document, so sprites, scripts and media that did not
+change are recognized by comparing a single hash and not compared any
+further. Serialization ids and script positions are left out of the hashes
+because Snap! renumbers and moves them freely.
+"""
+
+from __future__ import print_function
+
+import collections
+import hashlib
+import xml.etree.ElementTree as etree
+
+
+IGNORED_ATTRIBUTES = {
+    'ref': ('id',),
+    'script': ('x', 'y'),
+    'comment': ('x', 'y'),
+}
+
+
+class Change(object):
+
+    __slots__ = ('kind', 'action', 'sprite', 'name')
+
+    def __init__(self, kind, action, sprite=None, name=None):
+        self.kind = kind
+        self.action = action
+        self.sprite = sprite
+        self.name = name
+
+    def attrib(self):
+        return {'kind': self.kind, 'action': self.action,
+                'sprite': self.sprite, 'name': self.name}
+
+
+def _text(value):
+    if isinstance(value, bytes):
+        return value
+    return value.encode('utf-8')
+
+
+class TreeHasher(object):
+
+    def __init__(self):
+        self._hashes = {}
+
+    def __call__(self, el, skip=()):
+        if not skip and id(el) in self._hashes:
+            return self._hashes[id(el)]
+        ignored = IGNORED_ATTRIBUTES.get(el.tag, ()) + ('id',)
+        sha1 = hashlib.sha1()
+        sha1.update(_text(el.tag))
+        for key in sorted(el.attrib):
+            if key not in ignored:
+                sha1.update(b'\0' + _text(key) + b'=' + _text(el.attrib[key]))
+        sha1.update(b'\1' + _text((el.text or '').strip()))
+        for child in el:
+            if child.tag not in skip:
+                sha1.update(b'\2' + _text(self(child)))
+        digest = sha1.hexdigest()
+        if not skip:
+            self._hashes[id(el)] = digest
+        return digest
+
+
+def _children(el, path):
+    found = el.find(path) if el is not None else None
+    return list(found) if found is not None else []
+
+
+def _sprites(project):
+    sprites = collections.OrderedDict()
+    stage = project.find('stage')
+    if stage is None:
+        return sprites
+    sprites[stage.get('name', 'Stage')] = stage
+    for sprite in _children(stage, 'sprites'):
+        if sprite.tag == 'sprite':
+            sprites[sprite.get('name')] = sprite
+    return sprites
+
+
+def _keyed(elements, tag, key):
+    return collections.OrderedDict((el.get(key), el) for el in elements
+                                   if el.tag == tag)
+
+
+def _items(owner, path, tag):
+    return [item.find(tag) for item in _children(owner, path)
+            if item.find(tag) is not None]
+
+
+def _compareKeyed(changes, kind, sprite, old, new, hasher):
+    for name in old:
+        if name not in new:
+            changes.append(Change(kind, 'removed', sprite, name))
+        elif hasher(old[name]) != hasher(new[name]):
+            changes.append(Change(kind, 'changed', sprite, name))
+    for name in new:
+        if name not in old:
+            changes.append(Change(kind, 'added', sprite, name))
+
+
+def _compareScripts(changes, sprite, old, new, hasher):
+    oldCounts = collections.Counter(hasher(el) for el in old)
+    newCounts = collections.Counter(hasher(el) for el in new)
+    removed = sum((oldCounts - newCounts).values())
+    added = sum((newCounts - oldCounts).values())
+    for _ in range(removed):
+        changes.append(Change('script', 'removed', sprite))
+    for _ in range(added):
+        changes.append(Change('script', 'added', sprite))
+
+
+def _compareOwner(changes, sprite, old, new, hasher):
+    """Compare the scripts, blocks, variables and media of a sprite."""
+    _compareScripts(changes, sprite, _children(old, 'scripts'),
+                    _children(new, 'scripts'), hasher)
+    _compareKeyed(changes, 'block', sprite,
+                  _keyed(_children(old, 'blocks'), 'block-definition', 's'),
+                  _keyed(_children(new, 'blocks'), 'block-definition', 's'),
+                  hasher)
+    _compareKeyed(changes, 'variable', sprite,
+                  _keyed(_children(old, 'variables'), 'variable', 'name'),
+                  _keyed(_children(new, 'variables'), 'variable', 'name'),
+                  hasher)
+    _compareKeyed(changes, 'costume', sprite,
+                  _keyed(_items(old, 'costumes/list', 'costume'),
+                         'costume', 'name'),
+                  _keyed(_items(new, 'costumes/list', 'costume'),
+                         'costume', 'name'),
+                  hasher)
+    _compareKeyed(changes, 'sound', sprite,
+                  _keyed(_items(old, 'sounds/list', 'sound'),
+                         'sound', 'name'),
+                  _keyed(_items(new, 'sounds/list', 'sound'),
+                         'sound', 'name'),
+                  hasher)
+    if old is not None and new is not None:
+        ignored = ('id', 'idx')
+        oldProps = dict((k, v) for k, v in old.attrib.items()
+                        if k not in ignored)
+        newProps = dict((k, v) for k, v in new.attrib.items()
+                        if k not in ignored)
+        if oldProps != newProps:
+            changes.append(Change('properties', 'changed', sprite))
+
+
+def diff(oldXML, newXML):
+    """Return a list of Changes turning project oldXML into newXML."""
+    old = etree.fromstring(oldXML)
+    new = etree.fromstring(newXML)
+    hasher = TreeHasher()
+    changes = []
+    if hasher(old) == hasher(new):
+        return changes
+    oldSprites = _sprites(old)
+    newSprites = _sprites(new)
+    for name, sprite in oldSprites.items():
+        if name not in newSprites:
+            changes.append(Change('sprite', 'removed', name=name))
+            continue
+        other = newSprites[name]
+        if hasher(sprite, skip=('sprites',)) != hasher(other,
+                                                       skip=('sprites',)):
+            count = len(changes)
+            _compareOwner(changes, name, sprite, other, hasher)
+            if len(changes) == count:
+                changes.append(Change('sprite', 'changed', name=name))
+    for name in newSprites:
+        if name not in oldSprites:
+            changes.append(Change('sprite', 'added', name=name))
+    _compareKeyed(changes, 'block', None,
+                  _keyed(_children(old, 'blocks'), 'block-definition', 's'),
+                  _keyed(_children(new, 'blocks'), 'block-definition', 's'),
+                  hasher)
+    _compareKeyed(changes, 'variable', None,
+                  _keyed(_children(old, 'variables'), 'variable', 'name'),
+                  _keyed(_children(new, 'variables'), 'variable', 'name'),
+                  hasher)
+    oldNotes = old.find('notes')
+    newNotes = new.find('notes')
+    if ((oldNotes is None) != (newNotes is None) or
+            (oldNotes is not None and hasher(oldNotes) != hasher(newNotes))):
+        changes.append(Change('notes', 'changed'))
+    return changes
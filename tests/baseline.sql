@@ -0,0 +1,96 @@
+CREATE TABLE users (
+	"userName" VARCHAR NOT NULL, 
+	password VARCHAR, 
+	email VARCHAR, 
+	PRIMARY KEY ("userName")
+);
+CREATE TABLE assignments (
+	"assignId" VARCHAR(40) NOT NULL, 
+	name VARCHAR, 
+	PRIMARY KEY ("assignId")
+);
+CREATE TABLE courses (
+	"courseId" VARCHAR(40) NOT NULL, 
+	name VARCHAR, 
+	PRIMARY KEY ("courseId")
+);
+CREATE TABLE revisions (
+	"revId" VARCHAR(40) NOT NULL, 
+	"prevId" VARCHAR(40), 
+	PRIMARY KEY ("revId"), 
+	FOREIGN KEY("prevId") REFERENCES revisions ("revId")
+);
+CREATE TABLE course_students (
+	student VARCHAR, 
+	course INTEGER, 
+	FOREIGN KEY(student) REFERENCES users ("userName"), 
+	FOREIGN KEY(course) REFERENCES courses ("courseId")
+);
+CREATE TABLE course_assignments (
+	course INTEGER, 
+	assignment INTEGER, 
+	FOREIGN KEY(course) REFERENCES courses ("courseId"), 
+	FOREIGN KEY(assignment) REFERENCES assignments ("assignId")
+);
+CREATE TABLE projects (
+	"projId" VARCHAR(40) NOT NULL, 
+	"headId" VARCHAR(40), 
+	"sharedName" VARCHAR, 
+	public BOOLEAN, 
+	PRIMARY KEY ("projId"), 
+	FOREIGN KEY("headId") REFERENCES revisions ("revId"), 
+	CHECK (public IN (0, 1))
+);
+CREATE TABLE course_teachers (
+	teacher VARCHAR, 
+	course INTEGER, 
+	FOREIGN KEY(teacher) REFERENCES users ("userName"), 
+	FOREIGN KEY(course) REFERENCES courses ("courseId")
+);
+CREATE TABLE submissions (
+	"submitId" VARCHAR(40) NOT NULL, 
+	"revisionId" VARCHAR(40), 
+	"projectId" VARCHAR(40), 
+	"submitterName" VARCHAR, 
+	time DATETIME, 
+	PRIMARY KEY ("submitId"), 
+	FOREIGN KEY("revisionId") REFERENCES revisions ("revId"), 
+	FOREIGN KEY("projectId") REFERENCES projects ("projId"), 
+	FOREIGN KEY("submitterName") REFERENCES users ("userName")
+);
+CREATE TABLE project_owners (
+	project VARCHAR, 
+	users VARCHAR, 
+	FOREIGN KEY(project) REFERENCES projects ("projId"), 
+	FOREIGN KEY(users) REFERENCES users ("userName")
+);
+CREATE TABLE shares (
+	"userName" VARCHAR, 
+	"projId" VARCHAR(40), 
+	FOREIGN KEY("userName") REFERENCES users ("userName"), 
+	FOREIGN KEY("projId") REFERENCES projects ("projId")
+);
+CREATE TABLE student_shares (
+	course VARCHAR, 
+	project VARCHAR, 
+	FOREIGN KEY(course) REFERENCES courses ("courseId"), 
+	FOREIGN KEY(project) REFERENCES projects ("projId")
+);
+CREATE TABLE teacher_shares (
+	course VARCHAR, 
+	project VARCHAR, 
+	FOREIGN KEY(course) REFERENCES courses ("courseId"), 
+	FOREIGN KEY(project) REFERENCES projects ("projId")
+);
+CREATE TABLE assignment_submissions (
+	assignment INTEGER, 
+	submissions INTEGER, 
+	FOREIGN KEY(assignment) REFERENCES assignments ("assignId"), 
+	FOREIGN KEY(submissions) REFERENCES submissions ("submitId")
+);
+CREATE TABLE submission_members (
+	submissions VARCHAR, 
+	users VARCHAR, 
+	FOREIGN KEY(submissions) REFERENCES submissions ("submitId"), 
+	FOREIGN KEY(users) REFERENCES users ("userName")
+);
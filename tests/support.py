@@ -0,0 +1,119 @@
+"""Helpers for the tests: a scratch server and requests against it.
+
+server.py reads its configuration when it is first imported, so a test
+process imports it once, in a scratch directory of its own, through
+importServer. Tests that need another configuration, such as shards, run
+a function of theirs in a child process with runIsolated.
+
+Run the tests from the top of the repository with
+
+    python -m unittest discover -s tests
+"""
+
+from __future__ import print_function
+
+import itertools
+import os
+import re
+import subprocess
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+import querybudget  # noqa: E402, needs ROOT on sys.path
+
+
+PASSWORD = 'secret'
+_names = itertools.count()
+
+
+def scratchDir():
+    path = tempfile.mkdtemp(prefix='snaptest')
+    os.mkdir(os.path.join(path, 'storage'))
+    return path
+
+
+def importServer():
+    if 'server' not in sys.modules:
+        os.chdir(scratchDir())
+    import server
+    return server
+
+
+def uniqueName(prefix):
+    """Return a name no other test in this process uses."""
+    return '{0}{1}'.format(prefix, next(_names))
+
+
+def call(path, query_string='', body='', method='GET', user=None,
+         headers=None):
+    """Run a request against the server; return (status, headers, body).
+    user is a user name, signed in with PASSWORD."""
+    server = importServer()
+    return querybudget.request(server.app, path, query_string, body, method,
+                               None if user is None else (user, PASSWORD),
+                               headers)
+
+
+def attribute(body, name):
+    match = re.search(name + b'="(\\w+)"', body)
+    return match and match.group(1).decode('ascii')
+
+
+def createUser(prefix='user'):
+    userName = uniqueName(prefix)
+    status, _, _ = call('/createUser', 'userName={0}&password={1}'.format(
+        userName, PASSWORD))
+    assert status.startswith('200'), status
+    return userName
+
+
+def createProject(user):
+    _, _, body = call('/createProject', user=user)
+    return attribute(body, b'projId')
+
+
+def createCourse(teacher, name='course'):
+    _, _, body = call('/createCourse', 'name=' + name, user=teacher)
+    return attribute(body, b'courseId')
+
+
+def createAssignment(teacher, courseId, name='hw'):
+    _, _, body = call('/createAssignment',
+                      'courseId={0}&name={1}'.format(courseId, name),
+                      user=teacher)
+    return attribute(body, b'assignId')
+
+
+def saveProject(user, projId, contents):
+    return call('/saveProject', 'projId=' + projId, body=contents,
+                method='POST', user=user)
+
+
+def projectXML(name, stage='Stage'):
+    return '<project name="{0}"><stage name="{1}"/></project>'.format(
+        name, stage).encode('ascii')
+
+
+def runIsolated(module, function, args=(), **environ):
+    """Call module.function(*args) in a child process that imports the
+    server in a scratch directory of its own with environ added to its
+    environment; raise AssertionError with its output if it fails."""
+    env = dict(os.environ)
+    env.update(environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [HERE, ROOT] + [path for path in [env.get('PYTHONPATH')] if path])
+    code = 'import {0}; {0}.{1}(*{2!r})'.format(module, function,
+                                                tuple(args))
+    proc = subprocess.Popen([sys.executable, '-c', code], cwd=scratchDir(),
+                            env=env, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT,
+                            universal_newlines=True)
+    output = proc.communicate()[0]
+    if proc.returncode != 0:
+        raise AssertionError('{0}.{1} failed:\n{2}'.format(
+            module, function, output))
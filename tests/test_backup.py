@@ -0,0 +1,168 @@
+import io
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import support
+from support import createUser, createProject, saveProject, projectXML
+
+import backup
+import blobstore
+
+TWO_SHARDS = {'SNAP_SHARDS': 'sqlite:///s0.sqlite,sqlite:///s1.sqlite'}
+
+
+def storesIn(root):
+    return {'hot': blobstore.LocalStore(os.path.join(root, 'storage')),
+            'cold': blobstore.LocalStore(os.path.join(root, 'storage',
+                                                      'cold'))}
+
+
+def rowCount(database, table):
+    conn = sqlite3.connect(database)
+    try:
+        return conn.execute('SELECT count(*) FROM ' + table).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def backupAndRestoreShards():
+    """Back up every shard and the directory, then restore them into an
+    empty directory."""
+    server = support.importServer()
+    for shard in (0, 1):
+        userName = support.uniqueName('user')
+        server.directory.place('user', userName, shard)
+        support.call('/createUser', 'userName={0}&password={1}'.format(
+            userName, support.PASSWORD))
+        saveProject(userName, createProject(userName),
+                    projectXML('p{0}'.format(shard)))
+    assert backup.configuredDatabases() == \
+        ['s0.sqlite', 's1.sqlite', 'directory.sqlite']
+    backupDir = tempfile.mkdtemp()
+    assert backup.main(['backup', backupDir]) == 0
+    assert backup.main(['verify', backupDir]) == 0
+    target = tempfile.mkdtemp()
+    os.chdir(target)
+    assert backup.main(['restore', backupDir]) == 0
+    for name in ('s0.sqlite', 's1.sqlite'):
+        assert rowCount(name, 'projects') == 1, name
+    assert rowCount('directory.sqlite', 'placements') > 0
+    hot = storesIn(target)['hot']
+    assert len([key for key in hot.keys()
+                if key.endswith('.segments')]) == 2
+
+
+class BackupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = support.importServer()
+        self.backupDir = tempfile.mkdtemp()
+        self.target = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.backupDir)
+        shutil.rmtree(self.target)
+
+    def output(self):
+        return io.BytesIO() if str is bytes else io.StringIO()
+
+    def backup(self):
+        return backup.backup(self.backupDir, storesIn('.'), ['snap.sqlite'],
+                             out=self.output())
+
+    def test_backup_and_restore(self):
+        user = createUser()
+        projId = createProject(user)
+        saveProject(user, projId, projectXML('backedup'))
+        name, missing = self.backup()
+        self.assertEqual(missing, [])
+        out = self.output()
+        self.assertEqual(backup.verify(self.backupDir, out=out), 0)
+        database = os.path.join(self.target, 'snap.sqlite')
+        stores = storesIn(self.target)
+        backup.restore(self.backupDir, stores, [database], out=out)
+        conn = sqlite3.connect(database)
+        try:
+            contentHash, = conn.execute(
+                'SELECT contentHash FROM revisions WHERE revId = '
+                '(SELECT headId FROM projects WHERE projId = ?)',
+                (projId,)).fetchone()
+        finally:
+            conn.close()
+        self.assertTrue(stores['hot'].exists(contentHash + '.segments'))
+
+    def test_restore_refuses_to_overwrite(self):
+        self.backup()
+        database = os.path.join(self.target, 'snap.sqlite')
+        open(database, 'w').close()
+        self.assertRaises(backup.BackupError, backup.restore,
+                          self.backupDir, storesIn(self.target), [database])
+
+    def test_content_moved_to_cold_storage(self):
+        user = createUser()
+        projId = createProject(user)
+        saveProject(user, projId, projectXML('moved'))
+        stores = storesIn('.')
+        with self.server.session_scope() as session:
+            key = session.query(self.server.Project).get(projId) \
+                .head.content.key()
+        coldKey = key[:-len('.segments')] + '.cold'
+        stores['cold'].put(coldKey, stores['hot'].get(key))
+        stores['hot'].delete(key)
+        name, missing = self.backup()
+        self.assertEqual(missing, [])
+        self.assertIn(('cold', coldKey), backup.snapshotKeys(
+            os.path.join(self.backupDir, 'snapshots', name)))
+
+    def test_missing_blob_leaves_no_snapshot(self):
+        user = createUser()
+        projId = createProject(user)
+        saveProject(user, projId, projectXML('lost'))
+        with self.server.session_scope() as session:
+            key = session.query(self.server.Project).get(projId) \
+                .head.content.key()
+        blobs = storesIn('.')['hot']
+        data = blobs.get(key)
+        blobs.delete(key)
+        try:
+            name, missing = self.backup()
+        finally:
+            blobs.put(key, data)
+        self.assertEqual(missing, [key])
+        self.assertEqual(backup.snapshotNames(self.backupDir), [])
+
+    def test_stepped_copy_restarts_after_a_write(self):
+        source = os.path.join(self.target, 'source.sqlite')
+        conn = sqlite3.connect(source)
+        conn.execute('CREATE TABLE t (x TEXT)')
+        conn.executemany('INSERT INTO t VALUES (?)',
+                         [('x' * 1000,)] * 200)
+        conn.commit()
+
+        class WritingThrottle(object):
+            def consume(self, size):
+                if rowCount(source, 't') == 200:
+                    conn.execute("INSERT INTO t VALUES ('late')")
+                    conn.commit()
+        pages = backup.PAGES_PER_STEP
+        backup.PAGES_PER_STEP = 4
+        target = os.path.join(self.target, 'copy.sqlite')
+        try:
+            backup.copyDatabase(sqlite3.connect(source), source, target,
+                                WritingThrottle())
+        finally:
+            backup.PAGES_PER_STEP = pages
+            conn.close()
+        backup.checkDatabase(target)
+        self.assertEqual(rowCount(target, 't'), 201)
+
+    def test_shards(self):
+        support.runIsolated('test_backup', 'backupAndRestoreShards',
+                            **TWO_SHARDS)
+
+
+if __name__ == '__main__':
+    unittest.main()
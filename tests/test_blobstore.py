@@ -0,0 +1,186 @@
+import io
+import os
+import shutil
+import threading
+import unittest
+
+import support
+
+import blobstore
+
+
+class ClientError(Exception):
+
+    def __init__(self, code):
+        Exception.__init__(self, code)
+        self.response = {'Error': {'Code': code}}
+
+
+class FakeS3Client(object):
+    """The part of the boto3 S3 client that S3Store uses, over a dict."""
+
+    def __init__(self):
+        self.objects = {}
+
+    def _object(self, Bucket, Key):
+        try:
+            return self.objects[(Bucket, Key)]
+        except KeyError:
+            raise ClientError('NoSuchKey')
+
+    def get_object(self, Bucket, Key):
+        return {'Body': io.BytesIO(self._object(Bucket, Key))}
+
+    def head_object(self, Bucket, Key):
+        return {'ContentLength': len(self._object(Bucket, Key))}
+
+    def upload_fileobj(self, fileobj, bucket, key):
+        self.objects[(bucket, key)] = fileobj.read()
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+
+    def get_paginator(self, operation):
+        assert operation == 'list_objects_v2'
+        return self
+
+    def paginate(self, Bucket, Prefix):
+        keys = sorted(key for bucket, key in self.objects
+                      if bucket == Bucket and key.startswith(Prefix))
+        for start in range(0, len(keys), 2):
+            yield {'Contents': [{'Key': key}
+                                for key in keys[start:start + 2]]}
+
+
+class StoreTests(object):
+    """Behaviour every store has; mixed into a TestCase per backend."""
+
+    def test_put_and_get(self):
+        self.store.put('a.segments', b'contents')
+        self.assertEqual(self.store.get('a.segments'), b'contents')
+        self.assertTrue(self.store.exists('a.segments'))
+
+    def test_missing_blob(self):
+        self.assertFalse(self.store.exists('missing'))
+        self.assertRaises(blobstore.BlobNotFound, self.store.get, 'missing')
+        self.assertRaises(blobstore.BlobNotFound, list,
+                          self.store.read_stream('missing'))
+
+    def test_streams_in_chunks(self):
+        data = b''.join(bytes(bytearray([i % 256])) for i in range(1000))
+        self.store.write_stream('big', [data[:300], data[300:]])
+        chunks = list(self.store.read_stream('big', chunk_size=256))
+        self.assertEqual(b''.join(chunks), data)
+        self.assertEqual([len(chunk) for chunk in chunks],
+                         [256, 256, 256, 232])
+
+    def test_overwrite(self):
+        self.store.put('key', b'old')
+        self.store.put('key', b'new')
+        self.assertEqual(self.store.get('key'), b'new')
+
+    def test_concurrent_puts_of_one_key(self):
+        start = threading.Event()
+        errors = []
+
+        def put():
+            start.wait()
+            try:
+                self.store.put('same', b'contents')
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=put) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(self.store.get('same'), b'contents')
+        self.assertEqual(list(self.store.keys()), ['same'])
+
+    def test_delete(self):
+        self.store.put('key', b'data')
+        self.store.delete('key')
+        self.store.delete('key')
+        self.assertFalse(self.store.exists('key'))
+
+    def test_get_many(self):
+        for key in ('x', 'y', 'z'):
+            self.store.put(key, key.encode('ascii') * 3)
+        self.assertEqual(self.store.get_many(['x', 'z', 'x']),
+                         {'x': b'xxx', 'z': b'zzz'})
+        self.assertRaises(blobstore.BlobNotFound, self.store.get_many,
+                          ['x', 'missing'])
+        self.assertEqual(self.store.prefetch(['y']).result(5),
+                         {'y': b'yyy'})
+
+    def test_keys(self):
+        for key in ('b', 'a', 'c'):
+            self.store.put(key, b'data')
+        self.store.delete('c')
+        self.assertEqual(sorted(self.store.keys()), ['a', 'b'])
+
+
+class LocalStoreTest(StoreTests, unittest.TestCase):
+
+    def setUp(self):
+        self.root = support.scratchDir()
+        self.store = blobstore.LocalStore(os.path.join(self.root, 'blobs'))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_ignores_partial_writes(self):
+        self.store.put('key', b'data')
+        open(self.store.path('other.tmp'), 'wb').close()
+        self.assertEqual(list(self.store.keys()), ['key'])
+
+
+class SQLiteStoreTest(StoreTests, unittest.TestCase):
+
+    def setUp(self):
+        self.root = support.scratchDir()
+        self.store = blobstore.SQLiteStore(os.path.join(self.root,
+                                                        'blobs.sqlite'))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+
+class S3StoreTest(StoreTests, unittest.TestCase):
+
+    def setUp(self):
+        self.client = FakeS3Client()
+        self.store = blobstore.S3Store('bucket', 'snap/', client=self.client)
+
+    def test_keys_are_prefixed(self):
+        self.store.put('key', b'data')
+        self.client.objects[('bucket', 'other/key')] = b'not ours'
+        self.assertIn(('bucket', 'snap/key'), self.client.objects)
+        self.assertEqual(list(self.store.keys()), ['key'])
+
+    def test_other_errors_propagate(self):
+        def fail(**kwargs):
+            raise ClientError('AccessDenied')
+        self.client.head_object = fail
+        self.assertRaises(ClientError, self.store.exists, 'key')
+
+
+class FromURLTest(unittest.TestCase):
+
+    def test_backends(self):
+        root = support.scratchDir()
+        try:
+            local = blobstore.from_url(os.path.join(root, 'storage'))
+            self.assertIsInstance(local, blobstore.LocalStore)
+            db = blobstore.from_url('sqlite:///' +
+                                    os.path.join(root, 'b.sqlite'))
+            self.assertIsInstance(db, blobstore.SQLiteStore)
+        finally:
+            shutil.rmtree(root)
+        self.assertRaises(ValueError, blobstore.from_url, 'ftp://host/x')
+
+
+if __name__ == '__main__':
+    unittest.main()
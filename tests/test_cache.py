@@ -0,0 +1,191 @@
+import json
+import unittest
+
+import support
+from support import call, createUser, createCourse, createAssignment, \
+    createProject, saveProject, projectXML
+
+import versioncache
+
+server = support.importServer()
+
+
+class VersionedCacheTest(unittest.TestCase):
+
+    def test_versions_are_bounded(self):
+        cache = versioncache.VersionedCache(1024, maxVersions=3)
+        stale = cache.key('list', [('roster', 'a')])
+        cache.put(stale, 'old')
+        for name in 'abcd':
+            cache.bump(('roster', name))
+        self.assertEqual(len(cache.versions), 0)
+        self.assertIsNone(cache.get(stale))
+        self.assertNotEqual(cache.key('list', [('roster', 'a')]), stale)
+        cache.bump(('roster', 'a'))
+        self.assertEqual(len(cache.versions), 1)
+
+
+class InvalidationTest(unittest.TestCase):
+    """Each handler that changes what a cached list shows makes the next
+    request for that list see the change."""
+
+    def setUp(self):
+        self.teacher = createUser('teacher')
+        self.student = createUser('student')
+        self.courseId = createCourse(self.teacher)
+
+    def listing(self, path, query_string='', user=None):
+        status, _, body = call(path, query_string, user=user)
+        self.assertTrue(status.startswith('200'), body)
+        return body
+
+    def courses(self, user):
+        return self.listing('/listCoursesEnrolled', user=user)
+
+    def teachers(self):
+        return self.listing('/listTeachers', 'courseId=' + self.courseId)
+
+    def teaching(self, user):
+        return self.listing('/listCoursesTeaching', 'userName=' + user)
+
+    def assignments(self):
+        return self.listing('/listAssignments', 'courseId=' + self.courseId)
+
+    def roster(self, path, user):
+        status, _, body = call(path, 'courseId={0}&userName={1}'.format(
+            self.courseId, user), user=self.teacher)
+        self.assertTrue(status.startswith('200'), body)
+
+    def assertChanges(self, listing, change, present):
+        """Check that a value of listing() is cached, then that change()
+        makes listing() include courseId if present, or leave it out."""
+        courseId = self.courseId.encode('ascii')
+        self.assertEqual(courseId in listing(), not present)
+        self.assertEqual(courseId in listing(), not present)
+        change()
+        self.assertEqual(courseId in listing(), present)
+
+    def test_enroll(self):
+        self.assertChanges(
+            lambda: self.courses(self.student),
+            lambda: call('/enroll', 'courseId=' + self.courseId,
+                         user=self.student), True)
+        self.assertChanges(
+            lambda: self.courses(self.student),
+            lambda: call('/unenroll', 'courseId=' + self.courseId,
+                         user=self.student), False)
+
+    def test_add_and_remove_student(self):
+        self.assertChanges(
+            lambda: self.courses(self.student),
+            lambda: self.roster('/addStudent', self.student), True)
+        self.assertChanges(
+            lambda: self.courses(self.student),
+            lambda: self.roster('/removeStudent', self.student), False)
+
+    def test_add_and_remove_teacher(self):
+        other = createUser('teacher')
+        self.assertChanges(
+            lambda: self.teaching(other),
+            lambda: self.roster('/addTeacher', other), True)
+        self.assertChanges(
+            lambda: self.teaching(other),
+            lambda: self.roster('/removeTeacher', other), False)
+        name = other.encode('ascii')
+        self.assertNotIn(name, self.teachers())
+        self.roster('/addTeacher', other)
+        self.assertIn(name, self.teachers())
+        self.roster('/removeTeacher', other)
+        self.assertNotIn(name, self.teachers())
+
+    def test_create_course(self):
+        before = self.teaching(self.teacher)
+        self.assertEqual(before, self.teaching(self.teacher))
+        courseId = createCourse(self.teacher)
+        self.assertNotIn(courseId.encode('ascii'), before)
+        self.assertIn(courseId.encode('ascii'), self.teaching(self.teacher))
+
+    def test_create_and_uncreate_assignment(self):
+        self.assertEqual(self.assignments(), self.assignments())
+        assignId = createAssignment(self.teacher, self.courseId)
+        self.assertIn(assignId.encode('ascii'), self.assignments())
+        call('/uncreateAssignment', 'assignId=' + assignId,
+             user=self.teacher)
+        self.assertNotIn(assignId.encode('ascii'), self.assignments())
+
+
+class GalleryTest(unittest.TestCase):
+    """listPublicProjects pages through public projects, most recently
+    updated first, and its cached first page follows every change."""
+
+    def setUp(self):
+        self.user = createUser()
+
+    def publicProject(self):
+        projId = createProject(self.user)
+        saveProject(self.user, projId, projectXML('gallery'))
+        call('/makePublic', 'projId=' + projId, user=self.user)
+        return projId
+
+    def page(self, cursor=None):
+        query_string = '' if cursor is None else 'cursor=' + cursor
+        status, _, body = call('/listPublicProjects', query_string,
+                               headers={'Accept': 'application/json'})
+        self.assertTrue(status.startswith('200'), body)
+        data = json.loads(body.decode('utf-8'))
+        return [project['projId'] for project in data['projects']], \
+            data['cursor']
+
+    def firstPage(self):
+        return self.page()[0]
+
+    def test_publishing_and_withdrawing(self):
+        projId = createProject(self.user)
+        saveProject(self.user, projId, projectXML('private'))
+        self.assertNotIn(projId, self.firstPage())
+        self.assertNotIn(projId, self.firstPage())
+        call('/makePublic', 'projId=' + projId, user=self.user)
+        self.assertEqual(self.firstPage()[0], projId)
+        call('/unmakePublic', 'projId=' + projId, user=self.user)
+        self.assertNotIn(projId, self.firstPage())
+
+    def test_saving_moves_a_project_first(self):
+        first = self.publicProject()
+        second = self.publicProject()
+        self.assertEqual(self.firstPage()[:2], [second, first])
+        saveProject(self.user, first, projectXML('updated'))
+        self.assertEqual(self.firstPage()[:2], [first, second])
+
+    def test_deleting(self):
+        projId = self.publicProject()
+        self.assertIn(projId, self.firstPage())
+        call('/uncreateProject', 'projId=' + projId, user=self.user)
+        self.assertNotIn(projId, self.firstPage())
+
+    def test_pages(self):
+        projIds = [self.publicProject() for _ in range(5)]
+        pageSize = server.GALLERY_PAGE_SIZE
+        server.GALLERY_PAGE_SIZE = 2
+        server.galleryCache.invalidate()
+        try:
+            seen = []
+            cursor = None
+            while True:
+                page, cursor = self.page(cursor)
+                self.assertLessEqual(len(page), 2)
+                seen.extend(page)
+                if cursor is None:
+                    break
+        finally:
+            server.GALLERY_PAGE_SIZE = pageSize
+            server.galleryCache.invalidate()
+        self.assertEqual(len(seen), len(set(seen)))
+        self.assertEqual(seen[:5], projIds[::-1])
+
+    def test_invalid_cursor(self):
+        status, _, _ = call('/listPublicProjects', 'cursor=nonsense')
+        self.assertTrue(status.startswith('400'), status)
+
+
+if __name__ == '__main__':
+    unittest.main()
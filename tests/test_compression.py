@@ -0,0 +1,138 @@
+import gzip
+import io
+import unittest
+import zlib
+
+import support
+from support import call, createUser, createProject, saveProject, \
+    projectXML, attribute
+
+import compression
+
+server = support.importServer()
+
+
+def gunzip(data):
+    return gzip.GzipFile(fileobj=io.BytesIO(data)).read()
+
+
+def header(headers, name):
+    for key, value in headers.items():
+        if key.lower() == name.lower():
+            return value
+
+
+class NegotiationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.user = createUser()
+        self.projId = createProject(self.user)
+        _, _, body = saveProject(self.user, self.projId,
+                                 projectXML('compressed'))
+        self.revId = attribute(body, b'revId')
+
+    def revision(self, acceptEncoding=None):
+        headers = {}
+        if acceptEncoding is not None:
+            headers['Accept-Encoding'] = acceptEncoding
+        status, headers, body = call('/getRevision', 'revId=' + self.revId,
+                                     user=self.user, headers=headers)
+        self.assertTrue(status.startswith('200'), body)
+        return headers, body
+
+    def listing(self, acceptEncoding=None):
+        for _ in range(20):
+            createProject(self.user)
+        headers = {}
+        if acceptEncoding is not None:
+            headers['Accept-Encoding'] = acceptEncoding
+        status, headers, body = call('/listProjects', user=self.user,
+                                     headers=headers)
+        self.assertTrue(status.startswith('200'), body)
+        return headers, body
+
+    def test_gzip_revisions(self):
+        _, identity = self.revision()
+        headers, body = self.revision('deflate, gzip;q=0.5')
+        self.assertEqual(header(headers, 'Content-Encoding'), 'gzip')
+        self.assertIn('Accept-Encoding', header(headers, 'Vary'))
+        self.assertEqual(gunzip(body), identity)
+        self.assertIn(b'<project name="compressed">', identity)
+
+    def test_refused_gzip(self):
+        headers, body = self.revision('gzip;q=0, identity')
+        self.assertIsNone(header(headers, 'Content-Encoding'))
+        self.assertIn(b'<project name="compressed">', body)
+
+    def test_stored_contents_are_not_recompressed(self):
+        compressed = []
+        compressSegment = compression.compress_segment
+
+        def recordingCompress(data, *args):
+            compressed.append(data)
+            return compressSegment(data, *args)
+        compression.compress_segment = recordingCompress
+        try:
+            headers, body = self.revision('gzip')
+        finally:
+            compression.compress_segment = compressSegment
+        self.assertIn(b'<stage name="Stage"/>', gunzip(body))
+        self.assertTrue(compressed)
+        self.assertFalse(any(b'<stage' in data for data in compressed),
+                         compressed)
+
+    def test_large_listings_are_compressed(self):
+        headers, body = self.listing('gzip')
+        self.assertEqual(header(headers, 'Content-Encoding'), 'gzip')
+        self.assertIn(self.projId.encode('ascii'), gunzip(body))
+
+    def test_small_responses_are_not_compressed(self):
+        _, headers, body = call('/listProjects', user=self.user,
+                                headers={'Accept-Encoding': 'gzip'})
+        self.assertLess(len(body), server.COMPRESS_MIN_SIZE)
+        self.assertIsNone(header(headers, 'Content-Encoding'))
+
+    def test_identity_revisions_vary(self):
+        headers, _ = self.revision()
+        self.assertIsNone(header(headers, 'Content-Encoding'))
+        self.assertIn('Accept-Encoding', header(headers, 'Vary'))
+
+    def test_identity_listings_vary(self):
+        headers, body = self.listing('identity')
+        self.assertGreater(len(body), server.COMPRESS_MIN_SIZE)
+        self.assertIsNone(header(headers, 'Content-Encoding'))
+        self.assertIn('Accept-Encoding', header(headers, 'Vary'))
+
+
+class SegmentTest(unittest.TestCase):
+
+    def test_segments_splice_into_one_gzip_member(self):
+        parts = [b'<project>', b'x' * 5000, b'', b'</project>']
+        segments = [compression.compress_segment(part) for part in parts]
+        data = b''.join(compression.gzip_stream(segments))
+        self.assertEqual(gunzip(data), b''.join(parts))
+        self.assertEqual(len(data), compression.gzip_length(segments))
+        self.assertEqual(compression.inflate(segments), b''.join(parts))
+
+    def test_crc32_combine(self):
+        first, second = b'hello, ', b'world'
+        self.assertEqual(
+            compression.crc32_combine(compression.crc32(first),
+                                      compression.crc32(second),
+                                      len(second)),
+            zlib.crc32(first + second) & 0xffffffff)
+
+    def test_parse_accept_encoding(self):
+        codings = compression.parse_accept_encoding(
+            'GZIP;q=0.5, br, identity;q=bad, ,*;q=0')
+        self.assertEqual(codings, {'gzip': 0.5, 'br': 1.0, 'identity': 0.0,
+                                   '*': 0.0})
+        self.assertTrue(compression.accepts(codings, 'gzip'))
+        self.assertFalse(compression.accepts(codings, 'deflate'))
+        self.assertIsNone(compression.choose_encoding('deflate'))
+        self.assertEqual(compression.choose_encoding('*'),
+                         'br' if compression.brotli else 'gzip')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,715 @@
+import base64
+import datetime
+import io
+import json
+import os
+import re
+import sqlite3
+import threading
+import unittest
+import zipfile
+
+import querybudget
+import support
+from support import call, attribute, createUser, createProject, \
+    createCourse, createAssignment, saveProject, projectXML
+
+server = support.importServer()
+
+
+class SaveAndLoadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.user = createUser()
+        self.projId = createProject(self.user)
+
+    def test_save_then_load(self):
+        status, _, body = saveProject(self.user, self.projId,
+                                      projectXML('first'))
+        self.assertTrue(status.startswith('200'), body)
+        revId = attribute(body, b'revId')
+        status, _, body = call('/loadProject',
+                               'projId={0}&includeRevision=1'.format(
+                                   self.projId), user=self.user)
+        self.assertTrue(status.startswith('200'))
+        self.assertIn(b'<project name="first">', body)
+        self.assertIn(revId.encode('ascii'), body)
+        status, _, body = call('/getRevision', 'revId=' + revId,
+                               user=self.user)
+        self.assertTrue(status.startswith('200'))
+        self.assertIn(b'<stage name="Stage"/>', body)
+
+    def test_saving_the_same_contents_twice(self):
+        saveProject(self.user, self.projId, projectXML('same'))
+        other = createProject(self.user)
+        saveProject(self.user, other, projectXML('other'))
+        saveProject(self.user, other, projectXML('same'))
+        with server.session_scope() as session:
+            heads = [session.query(server.Project).get(projId).head
+                     for projId in (self.projId, other)]
+            self.assertEqual(heads[0].contentHash, heads[1].contentHash)
+            self.assertEqual(heads[0].content.refCount, 2)
+
+    def test_reference_counts_are_not_lost(self):
+        saveProject(self.user, self.projId, projectXML('counted'))
+        with server.session_scope() as session:
+            content = session.query(server.Project).get(self.projId) \
+                .head.content
+            self.assertEqual(content.refCount, 1)
+            # Another request references the contents in the meantime.
+            other = createProject(self.user)
+            saveProject(self.user, other, projectXML('other'))
+            saveProject(self.user, other, projectXML('counted'))
+            self.assertEqual(server.addRefs(session, content, 1), 3)
+            session.rollback()
+
+    def test_adding_a_content_row_twice(self):
+        contentHash = server.sha1hex(b'twice')
+        with server.session_scope() as session:
+            first, created = server.insertOrGet(
+                session, server.Content, contentHash=contentHash, size=5,
+                refCount=1)
+            self.assertTrue(created)
+        with server.session_scope() as session:
+            second, created = server.insertOrGet(
+                session, server.Content, contentHash=contentHash, size=5,
+                refCount=1)
+            self.assertFalse(created)
+            self.assertEqual(second.refCount, 1)
+
+    def test_blobs_are_deleted_after_commit(self):
+        saveProject(self.user, self.projId, projectXML('discarded'))
+
+        def discardHead(session):
+            revision = session.query(server.Project).get(self.projId).head
+            revision.discard(session)
+            session.flush()
+            return revision.content.key()
+        with self.assertRaises(ZeroDivisionError):
+            with server.session_scope() as session:
+                key = discardHead(session)
+                1 / 0
+        self.assertTrue(server.blobs.exists(key))
+        with server.session_scope() as session:
+            discardHead(session)
+        self.assertFalse(server.blobs.exists(key))
+
+    def withUnits(self, wrap, contents):
+        """Save contents with each group commit unit wrapped by wrap."""
+        run = server.writes.run
+        server.writes.run = lambda work, shard=None: run(wrap(work), shard)
+        try:
+            return saveProject(self.user, self.projId, contents)
+        finally:
+            server.writes.run = run
+
+    def test_unit_writes_no_blobs(self):
+        def wrap(work):
+            def checked(session):
+                put = server.blobs.put
+                server.blobs.put = None
+                try:
+                    return work(session)
+                finally:
+                    server.blobs.put = put
+            return checked
+        status, _, body = self.withUnits(wrap, projectXML('staged'))
+        self.assertTrue(status.startswith('200'), body)
+
+    def test_failed_unit_leaves_no_blobs(self):
+        contents = projectXML('rolledback')
+
+        def wrap(work):
+            def failing(session):
+                work(session)
+                raise server.ShardMoved()
+            return failing
+        status, _, _ = self.withUnits(wrap, contents)
+        self.assertTrue(status.startswith('503'), status)
+        self.assertFalse(server.blobs.exists(
+            server.Content.keyFor(server.sha1hex(contents))))
+
+    def test_identical_saves_at_once(self):
+        contents = projectXML(support.uniqueName('starter'))
+        projIds = [createProject(self.user) for _ in range(8)]
+        start = threading.Event()
+        statuses = []
+
+        def save(projId):
+            start.wait()
+            statuses.append(saveProject(self.user, projId, contents)[0])
+        threads = [threading.Thread(target=save, args=(projId,))
+                   for projId in projIds]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([status[:3] for status in statuses], ['200'] * 8)
+        for projId in projIds:
+            _, _, body = call('/loadProject',
+                              'projId={0}&includeRevision=1'.format(projId),
+                              user=self.user)
+            self.assertIn(contents, body)
+
+    def test_failed_identical_save_keeps_the_blob(self):
+        contents = projectXML(support.uniqueName('raced'))
+        write = server.StagedContents.write
+
+        def racedWrite(staged, session):
+            write(staged, session)
+            # A save of the same contents wrote the same blobs, failed and
+            # discarded them before this save's unit ran.
+            failed = server.StagedContents(contents)
+            failed.written = set(staged.written)
+            failed.discard()
+        server.StagedContents.write = racedWrite
+        try:
+            status, _, body = saveProject(self.user, self.projId, contents)
+        finally:
+            server.StagedContents.write = write
+        self.assertTrue(status.startswith('200'), body)
+        _, _, body = call('/loadProject',
+                          'projId={0}&includeRevision=1'.format(self.projId),
+                          user=self.user)
+        self.assertIn(contents, body)
+
+    def test_rejects_invalid_project(self):
+        status, _, _ = saveProject(self.user, self.projId, b'<project><')
+        self.assertTrue(status.startswith('400'))
+
+    def test_only_members_may_save(self):
+        stranger = createUser('stranger')
+        status, _, _ = saveProject(stranger, self.projId, projectXML('x'))
+        self.assertTrue(status.startswith('403'))
+
+    def test_checks_members_before_parsing(self):
+        stranger = createUser('stranger')
+        status, _, _ = saveProject(stranger, self.projId, b'<project><')
+        self.assertTrue(status.startswith('403'), status)
+        status, _, _ = call('/saveProject', 'projId=' + self.projId,
+                            body=b'<project><', method='POST')
+        self.assertFalse(status.startswith('400'), status)
+
+    def test_diff(self):
+        _, _, body = saveProject(self.user, self.projId, projectXML('a', 'S'))
+        old = attribute(body, b'revId')
+        _, _, body = saveProject(self.user, self.projId, projectXML('a', 'T'))
+        new = attribute(body, b'revId')
+        status, _, body = call('/diffRevisions',
+                               'projId={0}&fromRevId={1}&toRevId={2}'
+                               .format(self.projId, old, new),
+                               user=self.user)
+        self.assertTrue(status.startswith('200'), body)
+        self.assertIn(b'<change', body)
+
+
+class MediaTest(unittest.TestCase):
+
+    def setUp(self):
+        self.user = createUser()
+
+    def dataURL(self, size):
+        prefix = b'data:image/png;base64,'
+        data = base64.b64encode(os.urandom(size))
+        return prefix + data[:size - len(prefix)]
+
+    def withMedia(self, name, url):
+        return projectXML(name).replace(
+            b'<stage name="Stage"/>',
+            b'<stage name="Stage" image="' + url + b'"/>')
+
+    def save(self, contents):
+        projId = createProject(self.user)
+        status, _, body = saveProject(self.user, projId, contents)
+        self.assertTrue(status.startswith('200'), body)
+        _, _, body = call('/loadProject',
+                          'projId={0}&includeRevision=1'.format(projId),
+                          user=self.user)
+        self.assertIn(contents, body)
+        with server.session_scope() as session:
+            content = session.query(server.Project).get(projId).head.content
+            return len(server.blobs.get(content.key()))
+
+    def media(self, url):
+        with server.session_scope() as session:
+            media = session.query(server.Media).get(server.sha1hex(url))
+            return media and (media.refCount,
+                              server.blobs.exists(media.key()))
+
+    def test_large_media_is_stored_once(self):
+        url = self.dataURL(server.MEDIA_MIN_SIZE)
+        for name in ('first', 'second'):
+            stored = self.save(self.withMedia(name, url))
+            self.assertLess(stored, server.MEDIA_MIN_SIZE / 2)
+        self.assertEqual(self.media(url), (2, True))
+
+    def test_small_media_stays_inline(self):
+        url = self.dataURL(server.MEDIA_MIN_SIZE - 100)
+        stored = self.save(self.withMedia('inline', url))
+        self.assertGreater(stored, server.MEDIA_MIN_SIZE / 2)
+        self.assertIsNone(self.media(url))
+
+
+class AutosaveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.window = server.AUTOSAVE_WINDOW
+        server.AUTOSAVE_WINDOW = 60
+        self.user = createUser()
+        self.projId = createProject(self.user)
+        _, _, body = saveProject(self.user, self.projId,
+                                 projectXML(support.uniqueName('first')))
+        self.first = attribute(body, b'revId')
+
+    def tearDown(self):
+        server.autosaves.flushAll()
+        server.AUTOSAVE_WINDOW = self.window
+
+    def autosave(self, name):
+        _, _, body = call('/saveProject',
+                          'projId={0}&autosave=1'.format(self.projId),
+                          body=projectXML(name), method='POST',
+                          user=self.user)
+        return attribute(body, b'revId')
+
+    def head(self):
+        with server.session_scope() as session:
+            head = session.query(server.Project).get(self.projId).head
+            return head.revId, head.prevId
+
+    def revisionExists(self, revId):
+        with server.session_scope() as session:
+            return session.query(server.Revision).get(revId) is not None
+
+    def test_coalesces_autosaves(self):
+        early = self.autosave(support.uniqueName('early'))
+        late = self.autosave(support.uniqueName('late'))
+        self.assertEqual(self.head(), (self.first, server.formatHash(0)))
+        call('/flushProject', 'projId=' + self.projId, user=self.user)
+        self.assertEqual(self.head(), (late, self.first))
+        self.assertFalse(self.revisionExists(early))
+
+    def test_revId_is_kept_when_the_head_moves(self):
+        revId = self.autosave(support.uniqueName('kept'))
+        with server.session_scope() as session:
+            project = session.query(server.Project).get(self.projId)
+            server.commitRevision(session, project, server.readProject(
+                [projectXML(support.uniqueName('elsewhere'))]))
+        server.autosaves.flush(self.projId)
+        self.assertEqual(self.head(), (revId, self.first))
+
+    def test_commit_upload_flushes(self):
+        revId = self.autosave(support.uniqueName('pending'))
+        contents = projectXML(support.uniqueName('uploaded'))
+        _, _, body = call('/beginUpload', 'projId={0}&size={1}'.format(
+            self.projId, len(contents)), user=self.user)
+        uploadId = attribute(body, b'uploadId')
+        call('/uploadChunk', 'uploadId={0}&offset=0&checksum={1}'.format(
+            uploadId, server.sha1hex(contents)), body=contents,
+            method='POST', user=self.user)
+        status, _, body = call('/commitUpload', 'uploadId=' + uploadId,
+                               user=self.user)
+        self.assertTrue(status.startswith('200'), body)
+        self.assertEqual(self.head()[1], revId)
+
+    def test_submit_flushes(self):
+        teacher = createUser('teacher')
+        courseId = createCourse(teacher)
+        call('/enroll', 'courseId=' + courseId, user=self.user)
+        assignId = createAssignment(teacher, courseId)
+        revId = self.autosave(support.uniqueName('submitted'))
+        status, _, body = call('/submitProject',
+                               'projId={0}&assignId={1}'.format(
+                                   self.projId, assignId), user=self.user)
+        self.assertTrue(status.startswith('200'), body)
+        with server.session_scope() as session:
+            submission = session.query(server.Submission).get(
+                attribute(body, b'submitId'))
+            self.assertEqual(submission.revisionId, revId)
+
+    def test_strangers_do_not_flush(self):
+        self.autosave(support.uniqueName('private'))
+        stranger = createUser('stranger')
+        for user in (None, stranger):
+            status, _, _ = call('/submitProject',
+                                'projId={0}&assignId=none'.format(
+                                    self.projId), user=user)
+            self.assertFalse(status.startswith('200'), status)
+        self.assertIsNotNone(server.autosaves.get(self.projId))
+
+
+class HistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.user = createUser()
+        self.projId = createProject(self.user)
+
+    def history(self, length):
+        revIds = []
+        for _ in range(length):
+            _, _, body = saveProject(
+                self.user, self.projId,
+                projectXML(support.uniqueName('history')))
+            revIds.append(attribute(body, b'revId'))
+        return revIds
+
+    def diff(self, fromRevId, toRevId):
+        return querybudget.measure(
+            server.app, '/diffRevisions',
+            query_string='projId={0}&fromRevId={1}&toRevId={2}'.format(
+                self.projId, fromRevId, toRevId),
+            user=(self.user, support.PASSWORD))
+
+    def test_queries_do_not_grow_with_history(self):
+        revIds = self.history(2)
+        short, (status, _, body) = self.diff(revIds[0], revIds[-1])
+        self.assertTrue(status.startswith('200'), body)
+        revIds += self.history(10)
+        long, (status, _, body) = self.diff(revIds[0], revIds[-1])
+        self.assertTrue(status.startswith('200'), body)
+        self.assertEqual(len(long), len(short), long.format())
+
+    def test_other_projects_revisions(self):
+        revId, = self.history(1)
+        other = createProject(self.user)
+        _, _, body = saveProject(self.user, other,
+                                 projectXML(support.uniqueName('other')))
+        saveProject(self.user, other,
+                    projectXML(support.uniqueName('other')))
+        _, (status, _, _) = self.diff(attribute(body, b'revId'), revId)
+        self.assertTrue(status.startswith('403'), status)
+
+    def test_strangers_do_not_start_reads(self):
+        revIds = self.history(2)
+        stranger = createUser('stranger')
+        prefetch = server.Revision.prefetch
+        started = []
+
+        def recordedPrefetch(revision):
+            started.append(revision.revId)
+            return prefetch(revision)
+        server.Revision.prefetch = recordedPrefetch
+        try:
+            status, _, _ = call('/diffRevisions',
+                                'fromRevId={0}&toRevId={1}'.format(*revIds),
+                                user=stranger)
+        finally:
+            server.Revision.prefetch = prefetch
+        self.assertTrue(status.startswith('403'), status)
+        self.assertEqual(started, [])
+
+
+class UploadTest(unittest.TestCase):
+
+    def test_chunked_upload(self):
+        user = createUser()
+        projId = createProject(user)
+        contents = projectXML('uploaded')
+        _, _, body = call('/beginUpload', 'projId={0}&size={1}'.format(
+            projId, len(contents)), user=user)
+        uploadId = attribute(body, b'uploadId')
+        for offset in (0, 10):
+            chunk = contents[offset:offset + 10] if offset == 0 \
+                else contents[offset:]
+            status, _, _ = call('/uploadChunk',
+                                'uploadId={0}&offset={1}&checksum={2}'.format(
+                                    uploadId, offset, server.sha1hex(chunk)),
+                                body=chunk, method='POST', user=user)
+            self.assertTrue(status.startswith('200'))
+        status, _, body = call('/commitUpload', 'uploadId=' + uploadId,
+                               user=user)
+        self.assertTrue(status.startswith('200'), body)
+        _, _, body = call('/loadProject',
+                          'projId={0}&includeRevision=1'.format(projId),
+                          user=user)
+        self.assertIn(b'<project name="uploaded">', body)
+
+    def test_empty_uploads_are_refused(self):
+        user = createUser()
+        projId = createProject(user)
+        status, _, body = call('/beginUpload', 'projId={0}&size=0'.format(
+            projId), user=user)
+        self.assertTrue(status.startswith('400'), status)
+        self.assertIn(b'empty', body)
+        with server.session_scope() as session:
+            self.assertEqual(session.query(server.Upload)
+                             .filter_by(projectId=projId).count(), 0)
+
+    def test_expired_uploads_are_swept(self):
+        user = createUser()
+        projId = createProject(user)
+        _, _, body = call('/beginUpload', 'projId={0}&size=10'.format(
+            projId), user=user)
+        uploadId = attribute(body, b'uploadId')
+        chunk = b'0123456789'
+        call('/uploadChunk', 'uploadId={0}&offset=0&checksum={1}'.format(
+            uploadId, server.sha1hex(chunk)), body=chunk, method='POST',
+            user=user)
+        with server.session_scope() as session:
+            upload = session.query(server.Upload).get(uploadId)
+            filename = upload.filename()
+            upload.expires = datetime.datetime.utcnow()
+        self.assertTrue(os.path.exists(filename))
+        server.expireAllUploads()
+        with server.session_scope() as session:
+            self.assertIsNone(session.query(server.Upload).get(uploadId))
+        self.assertFalse(os.path.exists(filename))
+
+
+class UsageTest(unittest.TestCase):
+
+    def usage(self, projId):
+        with server.session_scope() as session:
+            return session.query(server.Usage).get(('project', projId)) \
+                .bytes
+
+    def withQuota(self, name, limit, function, *args):
+        saved = getattr(server, name)
+        setattr(server, name, limit)
+        try:
+            return function(*args)
+        finally:
+            setattr(server, name, saved)
+
+    def test_project_quota(self):
+        user = createUser()
+        projId = createProject(user)
+        _, _, body = saveProject(user, projId, projectXML('small'))
+        revId = attribute(body, b'revId')
+        limit = self.usage(projId) + 10
+        status, _, body = self.withQuota(
+            'PROJECT_QUOTA', limit, saveProject, user, projId,
+            projectXML('x' * 20))
+        self.assertTrue(status.startswith('413'), status)
+        self.assertIn(b'project storage quota', body)
+        with server.session_scope() as session:
+            self.assertEqual(
+                session.query(server.Project).get(projId).headId, revId)
+        status, _, _ = self.withQuota(
+            'PROJECT_QUOTA', limit, call, '/beginUpload',
+            'projId={0}&size=20'.format(projId), '', 'GET', user)
+        self.assertTrue(status.startswith('413'), status)
+        status, _, _ = self.withQuota(
+            'PROJECT_QUOTA', limit * 3, saveProject, user, projId,
+            projectXML('x' * 20))
+        self.assertTrue(status.startswith('200'), status)
+
+    def test_user_quota_spans_projects(self):
+        user = createUser()
+        first, second = createProject(user), createProject(user)
+        saveProject(user, first, projectXML(support.uniqueName('first')))
+        limit = self.usage(first) + 10
+        status, _, body = self.withQuota(
+            'USER_QUOTA', limit, saveProject, user, second,
+            projectXML(support.uniqueName('second')))
+        self.assertTrue(status.startswith('413'), status)
+        self.assertIn(b'user storage quota', body)
+
+    def test_course_quota(self):
+        teacher = createUser('teacher')
+        courseId = createCourse(teacher)
+        assignId = createAssignment(teacher, courseId)
+        student = createUser('student')
+        call('/enroll', 'courseId=' + courseId, user=student)
+        projId = createProject(student)
+        saveProject(student, projId, projectXML('homework'))
+        status, _, body = self.withQuota(
+            'COURSE_QUOTA', 1, call, '/submitProject',
+            'projId={0}&assignId={1}'.format(projId, assignId), '', 'GET',
+            student)
+        self.assertTrue(status.startswith('413'), status)
+        self.assertIn(b'course storage quota', body)
+
+    def test_list_storage_usage(self):
+        admin = createUser('admin')
+        user = createUser()
+        projId = createProject(user)
+        saveProject(user, projId, projectXML(support.uniqueName('listed')))
+        status, _, _ = call('/listStorageUsage', user=admin)
+        self.assertTrue(status.startswith('403'), status)
+        server.ADMINS.add(admin)
+        try:
+            status, _, body = call('/listStorageUsage', 'kind=user&limit=1000',
+                                   user=admin,
+                                   headers={'Accept': 'application/json'})
+        finally:
+            server.ADMINS.discard(admin)
+        self.assertTrue(status.startswith('200'), body)
+        usage = json.loads(body.decode('utf-8'))['usage']
+        self.assertEqual(set(entry['kind'] for entry in usage), set(['user']))
+        self.assertEqual(usage, sorted(usage, key=lambda entry:
+                                       -entry['bytes']))
+        [mine] = [entry for entry in usage if entry['name'] == user]
+        self.assertEqual(mine['bytes'], self.usage(projId))
+
+    def test_reconcile_repairs_drift(self):
+        user = createUser()
+        projId = createProject(user)
+        saveProject(user, projId,
+                    projectXML(support.uniqueName('counted')))
+        counted = self.usage(projId)
+        with server.session_scope() as session:
+            session.query(server.Usage).get(('project', projId)).bytes = 1
+        self.assertGreater(server.reconcileUsage(), 0)
+        self.assertEqual(self.usage(projId), counted)
+
+    def test_reconcile_counts_under_the_write_lock(self):
+        sizes = server.revisionSizes
+        locked = []
+
+        def checkedSizes(session, revIds):
+            conn = sqlite3.connect('snap.sqlite', timeout=0)
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                conn.rollback()
+            except sqlite3.OperationalError:
+                locked.append(True)
+            finally:
+                conn.close()
+            return sizes(session, revIds)
+        server.revisionSizes = checkedSizes
+        try:
+            server.reconcileUsage()
+        finally:
+            server.revisionSizes = sizes
+        self.assertEqual(locked, [True])
+
+
+class CourseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.teacher = createUser('teacher')
+        self.student = createUser('student')
+        self.courseId = createCourse(self.teacher)
+        call('/enroll', 'courseId=' + self.courseId, user=self.student)
+        self.assignId = createAssignment(self.teacher, self.courseId)
+
+    def test_submit_and_export(self):
+        projId = createProject(self.student)
+        saveProject(self.student, projId, projectXML('homework'))
+        status, _, body = call('/submitProject',
+                               'projId={0}&assignId={1}'.format(
+                                   projId, self.assignId), user=self.student)
+        self.assertTrue(status.startswith('200'), body)
+        status, _, body = call('/listSubmissions',
+                               'assignId=' + self.assignId,
+                               user=self.teacher,
+                               headers={'Accept': 'application/json'})
+        self.assertTrue(status.startswith('200'))
+        self.assertEqual(len(json.loads(body)['submissions']), 1)
+        status, _, body = call('/exportSubmissions',
+                               'assignId=' + self.assignId,
+                               user=self.teacher)
+        self.assertTrue(status.startswith('200'))
+        archive = zipfile.ZipFile(io.BytesIO(body))
+        names = archive.namelist()
+        self.assertIn('manifest.xml', names)
+        submitted = [name for name in names if name != 'manifest.xml']
+        self.assertIn(b'homework', archive.read(submitted[0]))
+
+    def test_students_cannot_list_submissions(self):
+        status, _, _ = call('/listSubmissions', 'assignId=' + self.assignId,
+                            user=self.student)
+        self.assertTrue(status.startswith('403'))
+
+
+class ForkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.owner = createUser('owner')
+        self.projId = createProject(self.owner)
+        contents = projectXML(support.uniqueName('forked'))
+        _, _, body = saveProject(self.owner, self.projId, contents)
+        self.revId = attribute(body, b'revId')
+
+    def fork(self, user, query_string=''):
+        status, _, body = call('/forkProject', 'projId={0}{1}'.format(
+            self.projId, query_string), user=user)
+        return status, re.findall(
+            b'<project projId="(\\w+)" userName="(\\w+)"', body)
+
+    def head(self, projId):
+        with server.session_scope() as session:
+            return session.query(server.Project).get(projId).headId
+
+    def test_fork_for_oneself(self):
+        status, forks = self.fork(self.owner, '&sharedName=copy')
+        self.assertTrue(status.startswith('200'), status)
+        [(projId, userName)] = forks
+        self.assertEqual(userName.decode('ascii'), self.owner)
+        self.assertNotEqual(projId.decode('ascii'), self.projId)
+        self.assertEqual(self.head(projId.decode('ascii')), self.revId)
+        _, _, body = call('/getProjectByName', 'userName={0}&projectName='
+                          'copy'.format(self.owner), user=self.owner)
+        self.assertIn(projId, body)
+
+    def test_strangers_fork_only_public_projects(self):
+        stranger = createUser('stranger')
+        status, _ = self.fork(stranger)
+        self.assertTrue(status.startswith('403'), status)
+        call('/makePublic', 'projId=' + self.projId, user=self.owner)
+        status, forks = self.fork(stranger)
+        self.assertTrue(status.startswith('200'), status)
+        self.assertEqual(forks[0][1].decode('ascii'), stranger)
+
+    def test_fork_for_a_course(self):
+        courseId = createCourse(self.owner)
+        students = [createUser('student') for _ in range(3)]
+        for student in students:
+            call('/enroll', 'courseId=' + courseId, user=student)
+        status, _ = self.fork(students[0], '&courseId=' + courseId)
+        self.assertTrue(status.startswith('403'), status)
+        status, forks = self.fork(self.owner, '&courseId=' + courseId)
+        self.assertTrue(status.startswith('200'), status)
+        self.assertEqual(sorted(userName.decode('ascii')
+                                for _, userName in forks),
+                         sorted(students))
+        for projId, _ in forks:
+            self.assertEqual(self.head(projId.decode('ascii')), self.revId)
+
+
+class NegotiationTest(unittest.TestCase):
+
+    def vary(self, path, query_string, user):
+        _, headers, _ = call(path, query_string, user=user,
+                             headers={'Accept': 'application/json'})
+        return dict((name.lower(), value)
+                    for name, value in headers.items()).get('vary', '')
+
+    def test_vary_on_accept(self):
+        teacher = createUser('teacher')
+        courseId = createCourse(teacher)
+        # The second response comes from the response cache.
+        for _ in range(2):
+            self.assertIn('Accept', self.vary(
+                '/listTeachers', 'courseId=' + courseId, teacher).split(
+                    ', '))
+        self.assertIn('Accept', self.vary('/listTeachers', 'courseId=none',
+                                          teacher).split(', '))
+
+
+def saveAndLoad():
+    """Save and load a project with the server's blobs in the backend
+    named by SNAP_STORAGE_URL."""
+    server = support.importServer()
+    user = createUser()
+    projId = createProject(user)
+    status, _, _ = saveProject(user, projId, projectXML('stored'))
+    assert status.startswith('200'), status
+    status, _, body = call('/loadProject',
+                           'projId={0}&includeRevision=1'.format(projId),
+                           user=user)
+    assert b'<project name="stored">' in body, body
+    assert any(key.endswith('.segments') for key in server.blobs.keys())
+
+
+class StorageBackendTest(unittest.TestCase):
+
+    def test_sqlite_blobs(self):
+        support.runIsolated('test_handlers', 'saveAndLoad',
+                            SNAP_STORAGE_URL='sqlite:///blobs.sqlite')
+
+
+if __name__ == '__main__':
+    unittest.main()
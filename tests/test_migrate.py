@@ -0,0 +1,52 @@
+import os
+import sqlite3
+import unittest
+
+import support
+from support import createUser, createProject, saveProject, projectXML
+
+BASELINE = os.path.join(support.HERE, 'baseline.sql')
+
+
+def columns(conn, table):
+    return set(row[1] for row in
+               conn.execute('PRAGMA table_info("{0}")'.format(table)))
+
+
+def upgradeBaseline():
+    """Start the server on a database made by the first version of the
+    schema, save a project in it and migrate it again."""
+    os.chdir(support.scratchDir())
+    conn = sqlite3.connect('snap.sqlite')
+    with open(BASELINE) as f:
+        conn.executescript(f.read())
+    conn.close()
+    import server
+    conn = sqlite3.connect('snap.sqlite')
+    try:
+        assert set(['contentHash', 'ancestorId', 'created', 'projectId',
+                    'byteSize', 'spriteCount', 'mediaSize']) <= \
+            columns(conn, 'revisions')
+        assert 'updated' in columns(conn, 'projects')
+        assert 'cold' in columns(conn, 'contents')
+        indexes = set(name for name, in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'"))
+        assert 'ix_projects_public_updated' in indexes, indexes
+        assert 'ix_revisions_projectId' in indexes, indexes
+    finally:
+        conn.close()
+    user = createUser()
+    projId = createProject(user)
+    status, _, body = saveProject(user, projId, projectXML('upgraded'))
+    assert status.startswith('200'), body
+    server.migrate(server.write_engine)
+
+
+class MigrateTest(unittest.TestCase):
+
+    def test_baseline_schema(self):
+        support.runIsolated('test_migrate', 'upgradeBaseline')
+
+
+if __name__ == '__main__':
+    unittest.main()
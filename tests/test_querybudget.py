@@ -0,0 +1,95 @@
+import threading
+import unittest
+try:
+    from urllib import urlencode
+except ImportError:
+    from urllib.parse import urlencode
+
+import support
+from support import createUser, createProject, projectXML
+
+import querybudget
+
+server = support.importServer()
+
+
+class QueryBudgetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.user = createUser()
+        self.projId = createProject(self.user)
+
+    def save(self, budget):
+        return querybudget.assert_query_budget(
+            server.app, budget, '/saveProject',
+            query_string='projId=' + self.projId, method='POST',
+            body=projectXML('budget'), user=(self.user, support.PASSWORD))
+
+    def test_reports_a_request_over_budget(self):
+        with self.assertRaises(AssertionError) as raised:
+            self.save(1)
+        self.assertIn('over its budget of 1', str(raised.exception))
+
+    def test_counts_group_commit_statements(self):
+        log, (status, _, _) = querybudget.measure(
+            server.app, '/saveProject', query_string='projId=' + self.projId,
+            method='POST', body=projectXML('grouped'),
+            user=(self.user, support.PASSWORD))
+        self.assertTrue(status.startswith('200'), status)
+        self.assertTrue(any(sql.startswith('INSERT INTO revisions')
+                            for sql, _, _ in log.statements), log.format())
+
+    def test_routes(self):
+        paths = querybudget.routes(server.app)
+        self.assertIn('/listProjects', paths)
+        self.assertNotIn('/{method}', paths)
+        self.assertGreater(paths.index('/unenroll'), paths.index('/watch'))
+
+    def test_concurrent_measurements(self):
+        errors = []
+
+        def measure():
+            try:
+                for _ in range(20):
+                    log, (status, _, _) = querybudget.measure(
+                        server.app, '/listProjects',
+                        user=(self.user, support.PASSWORD))
+                    assert status.startswith('200'), status
+                    assert len(log) > 0
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=measure) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+
+class ListBudgetTest(unittest.TestCase):
+    """Routes that list things run as many queries for ten as for one."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.user, params, _ = querybudget.build_fixture(
+            server, support.uniqueName('budget'), 10)
+        cls.query_string = urlencode(sorted(params.items()))
+
+    def assertBudget(self, budget, path):
+        status, _, _ = querybudget.assert_query_budget(
+            server.app, budget, path, query_string=self.query_string,
+            user=self.user)
+        self.assertTrue(status.startswith('200'), status)
+
+    def test_list_projects(self):
+        self.assertBudget(4, '/listProjects')
+
+    def test_get_project_by_name(self):
+        self.assertBudget(4, '/getProjectByName')
+
+    def test_export_submissions(self):
+        self.assertBudget(6, '/exportSubmissions')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,36 @@
+import json
+import os
+import unittest
+
+import support
+from support import createUser, createProject, saveProject, projectXML
+
+
+def scrubbed(rate):
+    import scrub
+    with open(os.devnull, 'w') as out:
+        problems = scrub.scrub(['snap.sqlite'], workers=1, rate=rate,
+                               out=out)
+    with open(scrub.REPORT) as f:
+        return problems, json.load(f)
+
+
+def countBytesRead():
+    """The report counts the bytes read with and without a rate."""
+    support.importServer()
+    user = createUser()
+    saveProject(user, createProject(user), projectXML('scrubbed'))
+    problems, report = scrubbed(0)
+    assert problems == [], problems
+    assert report['bytesRead'] > 0, report
+    assert scrubbed(10 ** 9)[1]['bytesRead'] == report['bytesRead']
+
+
+class ScrubTest(unittest.TestCase):
+
+    def test_counts_bytes_read(self):
+        support.runIsolated('test_scrub', 'countBytesRead')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+import re
+import sqlite3
+import unittest
+
+import support
+from support import call, createUser, createProject, saveProject, \
+    createCourse
+
+server = support.importServer()
+
+
+def searchFor(user, query):
+    status, _, body = call('/searchProjects', 'query=' + query, user=user)
+    assert status.startswith('200'), body
+    return body
+
+
+def searchAcrossShards():
+    """A teacher finds projects shared with their course from both
+    shards, and nothing else."""
+    server = support.importServer()
+    if not server.searchAvailable:
+        return
+    teacher = createUser('teacher')
+    courseId = createCourse(teacher)
+    projIds = []
+    for shard in (0, 1):
+        student = support.uniqueName('student')
+        server.directory.place('user', student, shard)
+        call('/createUser', 'userName={0}&password={1}'.format(
+            student, support.PASSWORD))
+        call('/enroll', 'courseId=' + courseId, user=student)
+        for shared in (True, False):
+            projId = createProject(student)
+            saveProject(student, projId,
+                        b'<project name="p"><stage name="Stage"/>'
+                        b'<sprite name="Zebrafish"/></project>')
+            if shared:
+                call('/shareProjectWithTeachers',
+                     'projId={0}&courseId={1}'.format(projId, courseId),
+                     user=student)
+                projIds.append(projId.encode('ascii'))
+    server.searchIndexer.join()
+    body = searchFor(teacher, 'zebra')
+    assert sorted(re.findall(br'<projId>(\w+)<', body)) == \
+        sorted(projIds), body
+
+
+class SearchTest(unittest.TestCase):
+
+    def setUp(self):
+        if not server.searchAvailable:
+            self.skipTest('SQLite was built without FTS5')
+        self.user = createUser()
+        self.projId = createProject(self.user)
+        saveProject(self.user, self.projId,
+                    b'<project name="p"><stage name="Stage"/>'
+                    b'<sprite name="Zebrafish"/></project>')
+        server.searchIndexer.join()
+
+    def test_finds_sprite_names(self):
+        self.assertIn(self.projId.encode('ascii'),
+                      searchFor(self.user, 'zebra'))
+
+    def found(self, user):
+        return self.projId.encode('ascii') in searchFor(user, 'zebra')
+
+    def share(self, path, courseId):
+        status, _, _ = call(path, 'projId={0}&courseId={1}'.format(
+            self.projId, courseId), user=self.user)
+        self.assertTrue(status.startswith('200'), status)
+
+    def test_only_readable_projects(self):
+        stranger = createUser('stranger')
+        self.assertFalse(self.found(stranger))
+        call('/shareProject', 'projId={0}&userName={1}'.format(
+            self.projId, stranger), user=self.user)
+        self.assertTrue(self.found(stranger))
+
+    def test_shared_with_a_course(self):
+        student, teacher = createUser('student'), createUser('teacher')
+        courseId = createCourse(teacher)
+        call('/enroll', 'courseId=' + courseId, user=student)
+        call('/enroll', 'courseId=' + courseId, user=self.user)
+        self.share('/shareProjectWithTeachers', courseId)
+        self.assertTrue(self.found(teacher))
+        self.assertFalse(self.found(student))
+        ownCourse = createCourse(self.user)
+        call('/enroll', 'courseId=' + ownCourse, user=student)
+        self.share('/shareProjectWithStudents', ownCourse)
+        self.assertTrue(self.found(student))
+        call('/unshareProjectWithTeachers', 'projId={0}&courseId={1}'.format(
+            self.projId, courseId), user=self.user)
+        self.assertFalse(self.found(teacher))
+
+    def test_reads_revision_before_locking(self):
+        load = server.Revision.load
+        locked = []
+
+        def checkedLoad(revision):
+            conn = sqlite3.connect('snap.sqlite', timeout=0)
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                conn.rollback()
+            except sqlite3.OperationalError:
+                locked.append(revision.revId)
+            finally:
+                conn.close()
+            return load(revision)
+        server.Revision.load = checkedLoad
+        try:
+            server.reindexProject(self.projId)
+        finally:
+            server.Revision.load = load
+        self.assertEqual(locked, [])
+
+    def test_shards(self):
+        support.runIsolated('test_search', 'searchAcrossShards',
+                            SNAP_SHARDS='sqlite:///s0.sqlite,'
+                                        'sqlite:///s1.sqlite')
+
+
+if __name__ == '__main__':
+    unittest.main()
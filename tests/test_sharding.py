@@ -0,0 +1,101 @@
+import unittest
+
+import support
+from support import call, createProject, saveProject, projectXML
+
+TWO_SHARDS = {'SNAP_SHARDS': 'sqlite:///s0.sqlite,sqlite:///s1.sqlite'}
+
+
+def shardedUser(server, prefix, shard):
+    userName = support.uniqueName(prefix)
+    server.directory.place('user', userName, shard)
+    call('/createUser', 'userName={0}&password={1}'.format(
+        userName, support.PASSWORD))
+    return userName
+
+
+def expect(response, status):
+    assert response[0].startswith(status), response
+
+
+def twoShardCourse(teacherShard, studentShard):
+    """A course in its teacher's shard whose student lives in the other
+    shard, before and after the course moves to the student's shard."""
+    server = support.importServer()
+    teacher = shardedUser(server, 'teacher', teacherShard)
+    student = shardedUser(server, 'student', studentShard)
+    courseId = support.createCourse(teacher)
+    assert server.directory.lookup('course', courseId) == teacherShard
+    expect(call('/enroll', 'courseId=' + courseId, user=student), '200')
+    assignId = support.createAssignment(teacher, courseId)
+    projId = createProject(student)
+    assert server.directory.lookup('project', projId) == studentShard
+    expect(saveProject(student, projId, projectXML('homework')), '200')
+    submit = 'projId={0}&assignId={1}'.format(projId, assignId)
+    expect(call('/submitProject', submit, user=student), '200')
+    expect(call('/listSubmissions', 'assignId=' + assignId, user=teacher),
+           '200')
+    expect(call('/listStudents', 'courseId=' + courseId, user=teacher),
+           '200')
+    expect(call('/shareProjectWithTeachers',
+                'projId={0}&courseId={1}'.format(projId, courseId),
+                user=student), '200')
+    expect(call('/loadProject', 'projId=' + projId, user=teacher), '403')
+    status, _, body = call('/listSubmissions', 'assignId=' + assignId,
+                           user=student)
+    assert status.startswith('403'), status
+
+    server.moveCourse(courseId, studentShard)
+    assert server.directory.lookup('course', courseId) == studentShard
+    expect(call('/submitProject', submit, user=student), '200')
+    _, _, body = call('/listSubmissions', 'assignId=' + assignId,
+                      user=teacher)
+    assert body.count(b'submitId') == 2, body
+    expect(call('/listStudents', 'courseId=' + courseId, user=teacher),
+           '200')
+    expect(call('/removeStudent',
+                'courseId={0}&userName={1}'.format(courseId, student),
+                user=teacher), '200')
+    expect(call('/submitProject', submit, user=student), '400')
+
+
+def staleGroupCommit():
+    """A submission queued for the shard a course was in before it moved
+    fails with ShardMoved instead of being written to the old shard."""
+    server = support.importServer()
+    teacher = shardedUser(server, 'teacher', 0)
+    student = shardedUser(server, 'student', 0)
+    courseId = support.createCourse(teacher)
+    call('/enroll', 'courseId=' + courseId, user=student)
+    assignId = support.createAssignment(teacher, courseId)
+    projId = createProject(student)
+    saveProject(student, projId, projectXML('homework'))
+    server.moveCourse(courseId, 1)
+    run = server.writes.run
+    # As if the directory had been switched after the handler looked the
+    # assignment up and before its unit ran.
+    server.writes.run = lambda work, shard=None: run(work, 0)
+    try:
+        expect(call('/submitProject', 'projId={0}&assignId={1}'.format(
+            projId, assignId), user=student), '503')
+    finally:
+        server.writes.run = run
+    with server.session_scope() as session:
+        assert server.everyShard(
+            session.query(server.Submission.submitId)) == []
+
+
+class ShardingTest(unittest.TestCase):
+
+    def test_group_commit_after_move(self):
+        support.runIsolated('test_sharding', 'staleGroupCommit',
+                            **TWO_SHARDS)
+
+    def test_course_and_student_in_different_shards(self):
+        for shards in ((0, 1), (1, 0)):
+            support.runIsolated('test_sharding', 'twoShardCourse', shards,
+                                **TWO_SHARDS)
+
+
+if __name__ == '__main__':
+    unittest.main()
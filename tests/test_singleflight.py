@@ -0,0 +1,132 @@
+import threading
+import time
+import unittest
+
+import support
+from support import call, createUser, createProject, saveProject, \
+    projectXML, attribute
+
+import singleflight
+
+server = support.importServer()
+
+
+def waitFor(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError('timed out')
+        time.sleep(0.01)
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    def setUp(self):
+        self.flight = singleflight.SingleFlight()
+        self.release = threading.Event()
+        self.calls = []
+
+    def slow(self, value):
+        self.calls.append(value)
+        self.release.wait(5)
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+    def runConcurrently(self, value, count):
+        """Call slow(value) under one key from count threads at once;
+        return what each got, a result or an exception."""
+        outcomes = []
+
+        def run():
+            try:
+                outcomes.append(self.flight.run('key', self.slow, value))
+            except Exception as e:
+                outcomes.append(e)
+        threads = [threading.Thread(target=run) for _ in range(count)]
+        threads[0].start()
+        waitFor(lambda: self.flight.inFlight('key'))
+        for thread in threads[1:]:
+            thread.start()
+        waitFor(lambda: self.flight.calls['key'].waiters == count - 1)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        return outcomes
+
+    def test_concurrent_calls_share_one_run(self):
+        self.assertEqual(self.runConcurrently('result', 5), ['result'] * 5)
+        self.assertEqual(self.calls, ['result'])
+        self.assertFalse(self.flight.inFlight('key'))
+        stats = self.flight.stats()
+        self.assertEqual((stats['leaders'], stats['collapsed']), (1, 4))
+
+    def test_waiters_get_the_error(self):
+        error = ValueError('failed')
+        self.assertEqual(self.runConcurrently(error, 3), [error] * 3)
+        self.assertEqual(self.flight.stats()['errors'], 1)
+
+    def test_later_calls_run_again(self):
+        self.release.set()
+        self.flight.run('key', self.slow, 'first')
+        self.flight.run('key', self.slow, 'second')
+        self.assertEqual(self.calls, ['first', 'second'])
+
+    def test_waiters_time_out(self):
+        self.flight.timeout = 0.05
+        leader = threading.Thread(target=self.flight.run,
+                                  args=('key', self.slow, 'slow'))
+        leader.start()
+        waitFor(lambda: self.flight.inFlight('key'))
+        try:
+            self.assertRaises(singleflight.Timeout, self.flight.run, 'key',
+                              self.slow, 'waiting')
+            self.assertEqual(
+                server.singleFlight(self.flight, 'key', lambda: 'own'), 'own')
+        finally:
+            self.release.set()
+            leader.join()
+        self.assertEqual(self.flight.stats()['timeouts'], 2)
+
+
+class RevisionLoadTest(unittest.TestCase):
+
+    def test_concurrent_reads_load_once(self):
+        user = createUser()
+        projId = createProject(user)
+        _, _, body = saveProject(user, projId,
+                                 projectXML(support.uniqueName('shared')))
+        revId = attribute(body, b'revId')
+        server.revisionCache.clear()
+        load = server.Revision.loadSegmentsFor
+        loads = []
+        start = threading.Event()
+
+        def slowLoad(*args):
+            loads.append(threading.current_thread())
+            time.sleep(0.2)
+            return load(*args)
+        statuses = []
+
+        def read():
+            start.wait()
+            statuses.append(call('/getRevision', 'revId=' + revId,
+                                 user=user)[0])
+        threads = [threading.Thread(target=read) for _ in range(6)]
+        server.Revision.loadSegmentsFor = staticmethod(slowLoad)
+        try:
+            for thread in threads:
+                thread.start()
+            start.set()
+            for thread in threads:
+                thread.join()
+        finally:
+            server.Revision.loadSegmentsFor = staticmethod(load)
+        self.assertEqual([status[:3] for status in statuses], ['200'] * 6)
+        # The search indexer may load it too, on a thread of its own.
+        self.assertEqual(len([thread for thread in loads
+                              if thread in threads]), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import datetime
+import unittest
+
+import support
+from support import attribute, createUser, createProject, saveProject, \
+    projectXML
+
+
+def saveRevisions(names):
+    user = createUser()
+    projId = createProject(user)
+    revIds = []
+    for name in names:
+        _, _, body = saveProject(user, projId, projectXML(name))
+        revIds.append(attribute(body, b'revId'))
+    return user, projId, revIds
+
+
+def later(days):
+    return datetime.datetime.utcnow() + datetime.timedelta(days=days)
+
+
+def thinInBatches():
+    """Thinning deletes in batches all the revisions it walked."""
+    server = support.importServer()
+    server.TIERING_BATCH_SIZE = 1
+    user, projId, revIds = saveRevisions(['a', 'b', 'c', 'd'])
+    assert server.thinRevisions(later(60)) == 3
+    with server.session_scope() as session:
+        left = [revId for revId, in session.query(server.Revision.revId)]
+    assert left == revIds[-1:], left
+    status, _, _ = support.call('/loadProject', 'projId=' + projId,
+                                user=user)
+    assert status.startswith('200'), status
+
+
+def keepUndated():
+    """Tiering leaves revisions saved before they were dated in hot
+    storage."""
+    server = support.importServer()
+    _, _, revIds = saveRevisions(['undated', 'head'])
+    with server.session_scope() as session:
+        session.query(server.Revision) \
+               .filter(server.Revision.revId == revIds[0]) \
+               .update({'created': None}, synchronize_session=False)
+    assert server.tierContents(later(60)) == 0
+    with server.session_scope() as session:
+        session.query(server.Revision) \
+               .filter(server.Revision.revId == revIds[0]) \
+               .update({'created': datetime.datetime(2000, 1, 1)},
+                       synchronize_session=False)
+    assert server.tierContents(later(60)) == 1
+
+
+class TieringTest(unittest.TestCase):
+
+    def test_thin_in_batches(self):
+        support.runIsolated('test_tiering', 'thinInBatches')
+
+    def test_undated_revisions_stay_hot(self):
+        support.runIsolated('test_tiering', 'keepUndated')
+
+
+if __name__ == '__main__':
+    unittest.main()
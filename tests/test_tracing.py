@@ -0,0 +1,169 @@
+import io
+import os
+import re
+import unittest
+
+import support
+from support import call, createUser, createProject, saveProject, \
+    projectXML
+
+import tracing
+
+server = support.importServer()
+
+
+def header(headers, name):
+    for key, value in headers.items():
+        if key.lower() == name.lower():
+            return value
+
+
+class TracerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(support.scratchDir(), 'traces.jsonl')
+        self.tracer = tracing.Tracer(self.path, sampleRate=1.0)
+
+    def traces(self):
+        return list(tracing.readTraces(self.tracer.output.paths()))
+
+    def request(self, app, traceId=None):
+        env = {'PATH_INFO': '/route', 'REQUEST_METHOD': 'GET'}
+        if traceId is not None:
+            env['HTTP_X_TRACE_ID'] = traceId
+        sent = {}
+
+        def start_response(status, headers, *excInfo):
+            sent.update(headers)
+        body = b''.join(self.tracer.wsgi(app, env, start_response))
+        return sent[tracing.TRACE_HEADER], body
+
+    def app(self, env, start_response):
+        with self.tracer.span('outer', kind='test'):
+            with self.tracer.span('inner'):
+                pass
+        start_response('201 Created', [])
+        return [b'done']
+
+    def test_spans_nest(self):
+        traceId, body = self.request(self.app)
+        self.assertEqual(body, b'done')
+        [trace] = self.traces()
+        self.assertEqual(trace['traceId'], traceId)
+        self.assertEqual((trace['route'], trace['method'], trace['status']),
+                         ('/route', 'GET', 201))
+        root, outer, inner = trace['spans']
+        self.assertEqual([span['name'] for span in trace['spans']],
+                         ['request', 'outer', 'inner'])
+        self.assertNotIn('parent', root)
+        self.assertEqual(outer['parent'], root['id'])
+        self.assertEqual(inner['parent'], outer['id'])
+        self.assertEqual(outer['attrs'], {'kind': 'test'})
+
+    def test_streamed_bodies_end_the_trace_when_sent(self):
+        def app(env, start_response):
+            start_response('200 OK', [])
+
+            def chunks():
+                with self.tracer.span('stream'):
+                    yield b'chunk'
+            return chunks()
+        env = {'PATH_INFO': '/stream', 'REQUEST_METHOD': 'GET'}
+        body = self.tracer.wsgi(app, env, lambda status, headers: None)
+        self.assertEqual(self.traces(), [])
+        self.assertEqual(b''.join(body), b'chunk')
+        [trace] = self.traces()
+        self.assertEqual([span['name'] for span in trace['spans']],
+                         ['request', 'stream'])
+
+    def test_errors_are_recorded(self):
+        def app(env, start_response):
+            with self.tracer.span('failing'):
+                raise ValueError('failed')
+        self.assertRaises(ValueError, self.request, app)
+        [trace] = self.traces()
+        self.assertEqual(trace['spans'][1]['attrs'], {'error': 'ValueError'})
+
+    def test_trace_ids(self):
+        self.assertEqual(self.request(self.app, 'given-id.1')[0],
+                         'given-id.1')
+        made = self.request(self.app, 'not a usable id')[0]
+        self.assertNotEqual(made, 'not a usable id')
+        self.assertTrue(re.match('^[0-9a-f]{32}$', made), made)
+
+    def test_unsampled_requests_get_ids_but_no_trace(self):
+        self.tracer.sampleRate = 0
+        self.assertEqual(self.request(self.app, 'id')[0], 'id')
+        self.assertIs(self.tracer.span('outer'), tracing.NULL_SPAN)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_files_rotate(self):
+        output = tracing.RotatingFile(self.path, maxBytes=10, backupCount=2)
+        for line in (b'first\n', b'second\n', b'third\n', b'fourth\n'):
+            output.write(line)
+        self.assertEqual([os.path.basename(path) for path in output.paths()],
+                         ['traces.jsonl.2', 'traces.jsonl.1',
+                          'traces.jsonl'])
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), b'fourth\n')
+
+    def test_summarize(self):
+        self.request(self.app)
+        out = io.StringIO() if str is not bytes else io.BytesIO()
+        tracing.summarize(self.traces(), out=out)
+        summary = out.getvalue()
+        self.assertIn('/route  1 requests', summary)
+        self.assertIn('outer', summary)
+
+
+class ServerTracingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.user = createUser()
+        self.projId = createProject(self.user)
+        self.output = server.tracer.output
+        self.sampleRate = server.tracer.sampleRate
+        self.path = os.path.join(support.scratchDir(), 'traces.jsonl')
+        server.tracer.output = tracing.RotatingFile(self.path)
+        server.tracer.sampleRate = 1.0
+
+    def tearDown(self):
+        server.tracer.output = self.output
+        server.tracer.sampleRate = self.sampleRate
+
+    def test_requests_are_traced(self):
+        status, headers, body = saveProject(self.user, self.projId,
+                                            projectXML('traced'))
+        self.assertTrue(status.startswith('200'), body)
+        traceId = header(headers, tracing.TRACE_HEADER)
+        [trace] = [trace for trace in tracing.readTraces([self.path])
+                   if trace['traceId'] == traceId]
+        self.assertEqual(trace['route'], '/saveProject')
+        names = set(span['name'] for span in trace['spans'])
+        self.assertTrue(set(['auth', 'sql', 'storage.write']) <= names,
+                        names)
+        # Statements the group commit thread runs for the request are
+        # children of the span it waits in.
+        commit = [span for span in trace['spans']
+                  if span['name'] == 'db.commit'][0]
+        inserts = [span for span in trace['spans']
+                   if span['name'] == 'sql' and
+                   span['attrs']['statement'].startswith(
+                       'INSERT INTO revisions')]
+        self.assertTrue(inserts)
+        self.assertTrue(all(span['parent'] == commit['id']
+                            for span in inserts))
+
+    def test_untraced_requests_get_an_id(self):
+        server.tracer.sampleRate = 0
+        status, headers, _ = call('/listProjects', user=self.user,
+                                  headers={tracing.TRACE_HEADER: 'abc'})
+        self.assertTrue(status.startswith('200'), status)
+        self.assertEqual(header(headers, tracing.TRACE_HEADER), 'abc')
+        self.assertIn(tracing.TRACE_HEADER,
+                      header(headers, 'Access-Control-Expose-Headers'))
+        self.assertFalse(os.path.exists(self.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
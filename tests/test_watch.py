@@ -0,0 +1,129 @@
+import json
+import threading
+import time
+import unittest
+
+import support
+from support import call, createUser, createProject, saveProject, \
+    projectXML, attribute
+
+server = support.importServer()
+
+
+class WatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.user = createUser()
+        self.projId = createProject(self.user)
+
+    def watch(self, query_string='', headers=None):
+        return call('/watch', 'projId=' + self.projId + query_string,
+                    user=self.user, headers=headers)
+
+    def poll(self, query_string='', headers=None):
+        headers = dict(headers or {}, Accept='application/json')
+        status, _, body = self.watch(query_string, headers)
+        self.assertTrue(status.startswith('200'), body)
+        data = json.loads(body.decode('utf-8'))
+        return data['events'], data['lastEventId']
+
+    def save(self, name):
+        """Save the project; return the revId and the id of the event
+        announcing it."""
+        lastId = server.bus.lastId
+        _, _, body = saveProject(self.user, self.projId, projectXML(name))
+        # The event is published once the save has committed.
+        deadline = time.time() + 5
+        while server.bus.lastId == lastId and time.time() < deadline:
+            time.sleep(0.01)
+        return attribute(body, b'revId'), server.bus.lastId
+
+    def configure(self, **settings):
+        for name, value in settings.items():
+            self.addCleanup(setattr, server, name, getattr(server, name))
+            setattr(server, name, value)
+
+    def test_events_since(self):
+        since = server.bus.lastId
+        revId, eventId = self.save('since')
+        events, lastId = self.poll('&since={0}'.format(since))
+        self.assertEqual(events, [{'type': 'head', 'projId': self.projId,
+                                   'revId': revId, 'id': eventId}])
+        self.assertGreaterEqual(lastId, eventId)
+        events, _ = self.poll(headers={'Last-Event-ID': str(since)})
+        self.assertEqual([event['revId'] for event in events], [revId])
+
+    def test_long_poll_times_out(self):
+        self.configure(WATCH_TIMEOUT=0.05)
+        events, lastId = self.poll()
+        self.assertEqual(events, [])
+        self.assertEqual(lastId, server.bus.lastId)
+
+    def test_long_poll_wakes_on_an_event(self):
+        self.configure(WATCH_TIMEOUT=5)
+        polled = []
+        poller = threading.Thread(target=lambda: polled.append(self.poll()))
+        poller.start()
+        deadline = time.time() + 5
+        while not server.watchers.counts.get(self.user) and \
+                time.time() < deadline:
+            time.sleep(0.01)
+        revId, _ = self.save('woken')
+        poller.join()
+        [(events, _)] = polled
+        self.assertEqual([event['revId'] for event in events], [revId])
+        self.assertNotIn(self.user, server.watchers.counts)
+
+    def test_forgotten_events_reset(self):
+        events, _ = self.poll('&since={0}'.format(server.bus.lastId + 10))
+        self.assertEqual(events, [{'type': 'reset'}])
+
+    def test_event_stream(self):
+        self.configure(WATCH_MAX_DURATION=0.2, WATCH_HEARTBEAT=0.05)
+        since = server.bus.lastId
+        revId, eventId = self.save('streamed')
+        status, headers, body = self.watch(
+            '&since={0}'.format(since), {'Accept': 'text/event-stream'})
+        self.assertTrue(status.startswith('200'), body)
+        self.assertIn('text/event-stream', headers['content-type'])
+        frames = body.decode('utf-8').split('\n\n')
+        self.assertEqual(frames[0], ': connected')
+        self.assertEqual(frames[1].split('\n')[:2],
+                         ['id: {0}'.format(eventId), 'event: head'])
+        self.assertIn(revId, frames[1])
+        self.assertIn(': heartbeat', frames)
+        self.assertNotIn(self.user, server.watchers.counts)
+
+    def test_open_watches_are_limited(self):
+        for _ in range(server.WATCH_MAX_PER_USER):
+            server.watchers.acquire(self.user)
+        try:
+            status, _, _ = self.watch()
+        finally:
+            for _ in range(server.WATCH_MAX_PER_USER):
+                server.watchers.release(self.user)
+        self.assertTrue(status.startswith('429'), status)
+
+    def test_strangers_may_not_watch(self):
+        stranger = createUser('stranger')
+        status, _, _ = call('/watch', 'projId=' + self.projId, user=stranger)
+        self.assertTrue(status.startswith('403'), status)
+        status, _, _ = call('/watch', user=self.user)
+        self.assertTrue(status.startswith('400'), status)
+
+    def test_failed_subscription_releases_the_slot(self):
+        subscribe = server.bus.subscribe
+
+        def failingSubscribe(topics, since=None):
+            raise RuntimeError('no subscriptions')
+        server.bus.subscribe = failingSubscribe
+        try:
+            status, _, _ = self.watch()
+        finally:
+            server.bus.subscribe = subscribe
+        self.assertTrue(status.startswith('500'), status)
+        self.assertNotIn(self.user, server.watchers.counts)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,333 @@
+#!/usr/bin/env python2
+"""Trace where the time of each request goes.
+
+Every request gets a trace id, taken from its X-Trace-Id header if it has
+a usable one and made up otherwise, and sent back in the same header. A
+sample of requests is traced: code marks the phases it wants timed with
+
+    with tracer.span('auth'):
+        ...
+
+and the statements run on instrumented SQLAlchemy engines are recorded as
+child spans of whatever span is open. Finished traces are appended as one
+JSON object per line to a file that is rotated once it grows too large.
+
+Running this module summarizes the slowest spans of each route:
+
+    python tracing.py traces.jsonl [count]
+"""
+
+from __future__ import print_function
+
+import binascii
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+TRACE_HEADER = 'X-Trace-Id'
+MAX_BYTES = 16 * 1024 * 1024
+BACKUP_COUNT = 4
+MAX_STATEMENT = 200
+
+_traceIdPattern = re.compile(r'^[0-9A-Za-z_.-]{1,64}$')
+
+
+def newTraceId():
+    return binascii.hexlify(os.urandom(16)).decode('ascii')
+
+
+class Span(object):
+
+    __slots__ = ('trace', 'spanId', 'parentId', 'name', 'start', 'duration',
+                 'attrs')
+
+    def __init__(self, trace, name, attrs):
+        self.trace = trace
+        self.name = name
+        self.attrs = attrs
+        self.duration = None
+
+    def open(self):
+        trace = self.trace
+        self.spanId = len(trace.spans)
+        self.parentId = trace.stack[-1].spanId if trace.stack else None
+        trace.spans.append(self)
+        self.start = time.time()
+
+    def close(self):
+        self.duration = time.time() - self.start
+
+    def __enter__(self):
+        self.open()
+        self.trace.stack.append(self)
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        self.close()
+        if excType is not None:
+            self.attrs['error'] = excType.__name__
+        self.trace.stack.pop()
+
+    def set(self, key, value):
+        self.attrs[key] = value
+
+    def toData(self, origin):
+        data = {'id': self.spanId, 'name': self.name,
+                'start': round((self.start - origin) * 1000, 3),
+                'duration': round((self.duration or 0) * 1000, 3)}
+        if self.parentId is not None:
+            data['parent'] = self.parentId
+        if self.attrs:
+            data['attrs'] = self.attrs
+        return data
+
+
+class _NullSpan(object):
+    """Stands in for a span when the request is not being traced."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        pass
+
+    def set(self, key, value):
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Trace(object):
+
+    def __init__(self, traceId):
+        self.traceId = traceId
+        self.spans = []
+        self.stack = []
+
+    def toData(self):
+        root = self.spans[0]
+        data = {'traceId': self.traceId,
+                'start': root.start,
+                'spans': [span.toData(root.start) for span in self.spans]}
+        data.update(root.attrs)
+        data['duration'] = round((root.duration or 0) * 1000, 3)
+        return data
+
+
+class RotatingFile(object):
+    """Appends lines to a file, renaming it to path.1, path.2 and so on
+    once it is larger than maxBytes."""
+
+    def __init__(self, path, maxBytes=MAX_BYTES, backupCount=BACKUP_COUNT):
+        self.path = path
+        self.maxBytes = maxBytes
+        self.backupCount = backupCount
+        self.lock = threading.Lock()
+
+    def write(self, line):
+        with self.lock:
+            try:
+                size = os.path.getsize(self.path)
+            except OSError:
+                size = 0
+            if size and size + len(line) > self.maxBytes:
+                self.rotate()
+            with open(self.path, 'ab') as f:
+                f.write(line)
+
+    def rotate(self):
+        for i in range(self.backupCount - 1, 0, -1):
+            older = '{0}.{1}'.format(self.path, i)
+            if os.path.exists(older):
+                os.rename(older, '{0}.{1}'.format(self.path, i + 1))
+        if self.backupCount > 0:
+            os.rename(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+
+    def paths(self):
+        """Return the existing files, oldest first."""
+        candidates = ['{0}.{1}'.format(self.path, i)
+                      for i in range(self.backupCount, 0, -1)]
+        return [path for path in candidates + [self.path]
+                if os.path.exists(path)]
+
+
+class Tracer(object):
+
+    def __init__(self, path, sampleRate=0.0, maxBytes=MAX_BYTES,
+                 backupCount=BACKUP_COUNT):
+        self.output = RotatingFile(path, maxBytes, backupCount)
+        self.sampleRate = sampleRate
+        self.local = threading.local()
+
+    def current(self):
+        return getattr(self.local, 'trace', None)
+
+    @contextmanager
+    def attached(self, trace):
+        """Record the spans opened on this thread in trace, for work done
+        on behalf of a request that is waiting for it."""
+        previous = getattr(self.local, 'trace', None)
+        self.local.trace = trace
+        try:
+            yield
+        finally:
+            self.local.trace = previous
+
+    def span(self, name, **attrs):
+        """Return a context manager timing name as a child of the open
+        span, or one that does nothing if the request is not traced."""
+        trace = getattr(self.local, 'trace', None)
+        if trace is None:
+            return NULL_SPAN
+        return Span(trace, name, attrs)
+
+    def sampled(self):
+        return self.sampleRate > 0 and random.random() < self.sampleRate
+
+    def export(self, trace):
+        line = json.dumps(trace.toData(), separators=(',', ':'),
+                          sort_keys=True) + '\n'
+        self.output.write(line.encode('utf-8'))
+
+    def wsgi(self, app, env, start_response):
+        """Call the WSGI app app, tracing the request if it is sampled."""
+        traceId = env.get('HTTP_' + TRACE_HEADER.upper().replace('-', '_'))
+        if traceId is None or not _traceIdPattern.match(traceId):
+            traceId = newTraceId()
+
+        def startResponse(status, headers, *excInfo):
+            headers = list(headers) + [(TRACE_HEADER, traceId)]
+            if root is not None:
+                root.set('status', int(status.split()[0]))
+            return start_response(status, headers, *excInfo)
+
+        if not self.sampled():
+            root = None
+            return app(env, startResponse)
+        trace = Trace(traceId)
+        root = Span(trace, 'request',
+                    {'route': env.get('PATH_INFO', ''),
+                     'method': env.get('REQUEST_METHOD', '')})
+        self.local.trace = trace
+        root.__enter__()
+        try:
+            body = app(env, startResponse)
+        except Exception:
+            self.finish(trace, root, sys.exc_info())
+            raise
+        finally:
+            self.local.trace = None
+        if isinstance(body, list):
+            self.finish(trace, root)
+            return body
+        return _TracedBody(self, trace, root, body)
+
+    def finish(self, trace, root, excInfo=(None, None, None)):
+        if root.duration is None:
+            root.__exit__(*excInfo)
+            self.export(trace)
+
+    def instrument(self, engine):
+        """Record the statements run on engine as spans named sql."""
+        import sqlalchemy.event
+
+        def before(conn, cursor, statement, parameters, context,
+                   executemany):
+            trace = getattr(self.local, 'trace', None)
+            if trace is not None:
+                statement = ' '.join(statement.split())[:MAX_STATEMENT]
+                span = Span(trace, 'sql', {'statement': statement})
+                span.open()
+                conn.info.setdefault('tracing.spans', {})[id(cursor)] = span
+
+        def after(conn, cursor, statement, parameters, context,
+                  executemany):
+            span = conn.info.get('tracing.spans', {}).pop(id(cursor), None)
+            if span is not None:
+                span.close()
+
+        sqlalchemy.event.listen(engine, 'before_cursor_execute', before)
+        sqlalchemy.event.listen(engine, 'after_cursor_execute', after)
+
+
+class _TracedBody(object):
+    """A streamed response body that ends its trace once it has been
+    sent."""
+
+    def __init__(self, tracer, trace, root, body):
+        self.tracer = tracer
+        self.trace = trace
+        self.root = root
+        self.body = body
+
+    def __iter__(self):
+        self.tracer.local.trace = self.trace
+        try:
+            for chunk in self.body:
+                yield chunk
+        finally:
+            self.tracer.local.trace = None
+        self.tracer.finish(self.trace, self.root)
+
+    def close(self):
+        if hasattr(self.body, 'close'):
+            self.body.close()
+        self.tracer.finish(self.trace, self.root)
+
+
+def readTraces(paths):
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+
+def summarize(traces, count=5, out=sys.stdout):
+    """Print, for each route, its request times and its count slowest
+    kinds of span by total time."""
+    routes = {}
+    for trace in traces:
+        route = routes.setdefault(trace.get('route', ''),
+                                  {'durations': [], 'spans': {}})
+        route['durations'].append(trace['duration'])
+        for span in trace['spans'][1:]:
+            times = route['spans'].setdefault(span['name'], [])
+            times.append(span['duration'])
+    for name in sorted(routes):
+        durations = sorted(routes[name]['durations'])
+        print('{0}  {1} requests  p50 {2:.1f}ms  p95 {3:.1f}ms  '
+              'max {4:.1f}ms'.format(name, len(durations),
+                                     percentile(durations, 0.5),
+                                     percentile(durations, 0.95),
+                                     durations[-1]), file=out)
+        spans = sorted(routes[name]['spans'].items(),
+                       key=lambda item: -sum(item[1]))
+        for spanName, times in spans[:count]:
+            print('    {0:24} {1:>6} calls  total {2:>9.1f}ms  '
+                  'max {3:>8.1f}ms'.format(spanName, len(times), sum(times),
+                                           max(times)), file=out)
+
+
+def percentile(values, fraction):
+    """Return the value at fraction of the way through sorted values."""
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(__doc__.strip(), file=sys.stderr)
+        sys.exit(2)
+    output = RotatingFile(sys.argv[1])
+    summarize(readTraces(output.paths()),
+              *[int(arg) for arg in sys.argv[2:3]])
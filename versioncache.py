@@ -0,0 +1,89 @@
+"""Cache values under the versions of the data they were built from.
+
+Each piece of data a value depends on is named by a key, such as
+('roster', courseId), with a counter that starts at 0. Writers bump the
+counters of the data they changed, once their change is visible to
+readers; a reader looks its value up under the current counters, so it
+never sees a value built before the last bump:
+
+    cacheKey = cache.key(('listTeachers', courseId), [('roster', courseId)])
+    value = cache.get(cacheKey)
+    if value is None:
+        value = build()
+        cache.put(cacheKey, value)
+
+Counters have to be read before the data is, so that a value built from
+data older than a bump is filed under a key nobody looks up again. Values
+are evicted least recently used first, keeping their total size under
+maxSize. Once more than maxVersions counters have been bumped, they are
+all dropped together with the values, and the keys handed out from then
+on carry a new epoch, so that no value built before is found again. Only
+bumps made in the same process are seen.
+"""
+
+from __future__ import print_function
+
+import threading
+
+import lru
+
+
+MAX_VERSIONS = 100000
+
+
+class VersionedCache(object):
+
+    def __init__(self, maxSize, sizeof=None, maxVersions=MAX_VERSIONS):
+        self.entries = lru.LRUCache(maxSize, sizeof)
+        self.lock = threading.Lock()
+        self.versions = {}
+        self.maxVersions = maxVersions
+        self.epoch = 0
+        self.bumps = 0
+        self.names = {}
+
+    def version(self, key):
+        return self.versions.get(key, 0)
+
+    def bump(self, *keys):
+        with self.lock:
+            for key in keys:
+                self.versions[key] = self.versions.get(key, 0) + 1
+                self.bumps += 1
+            if len(self.versions) > self.maxVersions:
+                self.versions.clear()
+                self.epoch += 1
+                self.entries.clear()
+
+    def key(self, name, dependencies):
+        """Return the key to cache the value named name under, given the
+        keys of the data it depends on."""
+        with self.lock:
+            return (name, self.epoch,
+                    tuple(self.versions.get(key, 0)
+                          for key in dependencies))
+
+    def get(self, cacheKey):
+        value = self.entries.get(cacheKey)
+        with self.lock:
+            counts = self.names.setdefault(cacheKey[0][0], [0, 0])
+            if value is None:
+                counts[1] += 1
+            else:
+                counts[0] += 1
+        return value
+
+    def put(self, cacheKey, value):
+        self.entries.put(cacheKey, value)
+
+    def stats(self):
+        """Return the stats of the cache as a whole, with the hits and
+        misses of each kind of value, by the first item of its name."""
+        stats = self.entries.stats()
+        stats['versions'] = len(self.versions)
+        stats['epoch'] = self.epoch
+        stats['bumps'] = self.bumps
+        stats['byName'] = dict((name, {'hits': hits, 'misses': misses})
+                               for name, (hits, misses)
+                               in self.names.items())
+        return stats
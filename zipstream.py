@@ -0,0 +1,84 @@
+"""Write zip archives incrementally from pre-compressed deflate segments.
+
+Entries are written with their crc and sizes in the local header, which is
+possible because segments carry the crc32 and size of their contents. The
+archive is produced as a sequence of byte strings so it can be streamed to
+the client without holding more than one entry in memory.
+"""
+
+from __future__ import print_function
+
+import struct
+
+import compression
+
+
+ZIP64_LIMIT = 0xffffffff
+VERSION = 20
+VERSION_ZIP64 = 45
+FLAG_UTF8 = 0x0800
+DEFLATED = 8
+
+
+def dos_date_time(when):
+    date = ((when.year - 1980) << 9) | (when.month << 5) | when.day
+    time = (when.hour << 11) | (when.minute << 5) | (when.second // 2)
+    return date, time
+
+
+class ZipStream(object):
+
+    def __init__(self):
+        self.offset = 0
+        self.entries = []
+
+    def _emit(self, data):
+        self.offset += len(data)
+        return data
+
+    def add_segments(self, name, segments, when):
+        """Yield the bytes of an entry holding the contents of segments."""
+        segments = list(segments)
+        name = name.encode('utf-8')
+        crc, size = compression.combine(segments)
+        csize = (sum(len(seg.data) for seg in segments) +
+                 len(compression.FINAL_BLOCK))
+        date, time = dos_date_time(when)
+        self.entries.append((name, crc, csize, size, date, time, self.offset))
+        yield self._emit(struct.pack(
+            '<IHHHHHIIIHH', 0x04034b50, VERSION, FLAG_UTF8, DEFLATED,
+            time, date, crc, csize, size, len(name), 0) + name)
+        for seg in segments:
+            yield self._emit(seg.data)
+        yield self._emit(compression.FINAL_BLOCK)
+
+    def add_bytes(self, name, data, when):
+        return self.add_segments(name, [compression.compress_segment(data)],
+                                 when)
+
+    def finish(self):
+        """Yield the central directory that ends the archive."""
+        start = self.offset
+        for name, crc, csize, size, date, time, offset in self.entries:
+            extra = b''
+            needed = VERSION
+            if offset >= ZIP64_LIMIT:
+                extra = struct.pack('<HHQ', 0x0001, 8, offset)
+                offset = 0xffffffff
+                needed = VERSION_ZIP64
+            yield self._emit(struct.pack(
+                '<IHHHHHHIIIHHHHHII', 0x02014b50, VERSION_ZIP64, needed,
+                FLAG_UTF8, DEFLATED, time, date, crc, csize, size, len(name),
+                len(extra), 0, 0, 0, 0, offset) + name + extra)
+        count = len(self.entries)
+        cdSize = self.offset - start
+        if start >= ZIP64_LIMIT or count >= 0xffff:
+            end64 = self.offset
+            yield self._emit(struct.pack(
+                '<IQHHIIQQQQ', 0x06064b50, 44, VERSION_ZIP64, VERSION_ZIP64,
+                0, 0, count, count, cdSize, start))
+            yield self._emit(struct.pack('<IIQI', 0x07064b50, 0, end64, 1))
+            count = min(count, 0xffff)
+            start = 0xffffffff
+        yield self._emit(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, count,
+                                     count, cdSize, start, 0))